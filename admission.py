@@ -0,0 +1,221 @@
+# =============================================================================
+# Admission Control for Generation Endpoints
+# =============================================================================
+# Every generation request costs upload disk writes and, once its job runs,
+# an upstream slot. Nothing used to stop one user from firing dozens in
+# parallel. Before a tool endpoint reads its upload it now calls
+#
+#     error = admission.admit(current_user.id, "specs-tryon")
+#     if error:
+#         return error
+#
+# which checks, in this order:
+#
+#   1. a token bucket per (user, tool): ADMISSION_RATE requests per minute
+#      with bursts of up to ADMISSION_BURST. Over budget -> 429 with a
+#      Retry-After of when the next token is due. Per-tool overrides go in
+#      ADMISSION_LIMITS, e.g. "specs-tryon=6/3,haircut-preview=6/3"
+#      (rate per minute / burst). A request that does the work of several
+#      passes cost=n and takes n tokens, all or none: a batch of n
+#      generations is charged like n requests. A cost above the burst can
+#      never fit and is rejected outright, so a batch endpoint registers a
+#      default burst of its largest batch with set_default();
+#      ADMISSION_LIMITS still overrides it.
+#   2. a process-wide cap on admitted requests still being handled
+#      (ADMISSION_MAX_IN_FLIGHT). Over it -> 503 + Retry-After, shedding load
+#      before the upload is read. The slot is released when the request ends.
+#
+# Buckets live in memory by default, so a check costs a lock and a dict
+# lookup. With several worker processes, set ADMISSION_BACKEND=sqlite to
+# share them through a small SQLite file (ADMISSION_DB); the in-flight cap
+# stays per process.
+
+import os
+import math
+import time
+import sqlite3
+import logging
+import threading
+
+from flask import g, jsonify
+
+from lru import LRUCache
+
+log = logging.getLogger(__name__)
+
+ADMISSION_ENABLED = os.environ.get("ADMISSION_ENABLED", "1") == "1"
+ADMISSION_RATE = float(os.environ.get("ADMISSION_RATE", 10))          # per minute
+ADMISSION_BURST = float(os.environ.get("ADMISSION_BURST", 5))
+ADMISSION_LIMITS = os.environ.get("ADMISSION_LIMITS", "")
+ADMISSION_MAX_IN_FLIGHT = int(os.environ.get("ADMISSION_MAX_IN_FLIGHT", 32))
+ADMISSION_BACKEND = os.environ.get("ADMISSION_BACKEND", "memory")     # memory | sqlite
+ADMISSION_DB = os.environ.get("ADMISSION_DB")
+ADMISSION_MAX_KEYS = int(os.environ.get("ADMISSION_MAX_KEYS", 100000))
+
+
+def parse_limits(spec):
+    """"tool=rate/burst,..." -> {tool: (rate per minute, burst)}"""
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        try:
+            tool, value = item.rsplit("=", 1)
+            rate, burst = value.split("/")
+            limits[tool.strip()] = (float(rate), float(burst))
+        except ValueError:
+            log.warning("Ignoring malformed ADMISSION_LIMITS entry %r", item)
+    return limits
+
+
+# =============================================================================
+# BUCKET BACKENDS
+# =============================================================================
+# take(key, rate_per_sec, burst, cost=1) -> 0 if cost tokens were taken,
+# otherwise the seconds until that many will be available. Nothing is taken
+# unless all of them are.
+
+class MemoryBuckets:
+    def __init__(self, max_keys=ADMISSION_MAX_KEYS):
+        # An entry that expired (or was evicted) is a full bucket again
+        self._buckets = LRUCache(maxsize=max_keys)
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, cost=1):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= cost:
+                self._buckets.set(key, (tokens - cost, now), ttl=(burst - tokens + cost) / rate)
+                return 0
+            self._buckets.set(key, (tokens, now), ttl=(burst - tokens) / rate)
+            return (cost - tokens) / rate
+
+
+class SQLiteBuckets:
+    """Buckets shared by every process using the same file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                " key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+            )
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")     # losing a refill on a crash is harmless
+            self._local.conn = conn
+        return conn
+
+    def take(self, key, rate, burst, cost=1):
+        now = time.time()
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens, updated = row if row else (burst, now)
+            tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+            wait = 0 if tokens >= cost else (cost - tokens) / rate
+            if not wait:
+                tokens -= cost
+            conn.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                         (key, tokens, now))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+
+# =============================================================================
+# ADMISSION
+# =============================================================================
+
+class Admission:
+    def __init__(self, rate=ADMISSION_RATE, burst=ADMISSION_BURST, limits=ADMISSION_LIMITS,
+                 max_in_flight=ADMISSION_MAX_IN_FLIGHT, backend=ADMISSION_BACKEND,
+                 enabled=ADMISSION_ENABLED):
+        self.default_limit = (rate, burst)
+        self.limits = parse_limits(limits) if isinstance(limits, str) else dict(limits)
+        self.max_in_flight = max_in_flight
+        self.backend = backend
+        self.enabled = enabled
+        self.buckets = MemoryBuckets()
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self.rejected = 0
+        self.shed = 0
+
+    def init_app(self, app):
+        if self.backend == "sqlite" and not isinstance(self.buckets, SQLiteBuckets):
+            path = ADMISSION_DB or os.path.join(app.instance_path, "admission.db")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.buckets = SQLiteBuckets(path)
+        app.teardown_request(self._release)
+
+    # ---------------- PUBLIC API ----------------
+
+    def set_default(self, tool_name, rate, burst):
+        """Limit for tool_name unless ADMISSION_LIMITS sets one."""
+        self.limits.setdefault(tool_name, (rate, burst))
+
+    def admit(self, user_id, tool_name, cost=1):
+        """
+        None if the request may go ahead, else the 429 / 503 response to return.
+        cost: tokens the request takes from the user's bucket, e.g. one per
+        generation in a batch; all or nothing.
+        """
+        if not self.enabled:
+            return None
+
+        rate, burst = self.limits.get(tool_name, self.default_limit)
+        if rate > 0:
+            burst = max(burst, 1)
+            if cost > burst:
+                # Would never fit, however long the client waited
+                self.rejected += 1
+                return self._reject(429, f"Too many items for this tool's rate limit (max {int(burst)} at once)", 60 / rate)
+            wait = self.buckets.take(f"{user_id}:{tool_name}", rate / 60, burst, cost)
+            if wait:
+                self.rejected += 1
+                return self._reject(429, "Too many requests for this tool, slow down", wait)
+
+        with self._lock:
+            if self._in_flight >= self.max_in_flight:
+                self.shed += 1
+                return self._reject(503, "Server busy, try again shortly", 1)
+            self._in_flight += 1
+        g.admission_slots = getattr(g, "admission_slots", 0) + 1
+        return None
+
+    def in_flight(self):
+        return self._in_flight
+
+    def stats(self):
+        return {
+            "in_flight": self._in_flight,
+            "max_in_flight": self.max_in_flight,
+            "rejected": self.rejected,
+            "shed": self.shed,
+            "backend": self.backend
+        }
+
+    # ---------------- INTERNALS ----------------
+
+    @staticmethod
+    def _reject(status, message, retry_after):
+        retry_after = max(1, math.ceil(retry_after))
+        response = jsonify({"success": False, "error": message, "retry_after": retry_after})
+        response.headers["Retry-After"] = str(retry_after)
+        return response, status
+
+    def _release(self, exc=None):
+        slots = g.pop("admission_slots", 0)
+        if slots:
+            with self._lock:
+                self._in_flight -= slots
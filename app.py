@@ -1,41 +1,78 @@
-print("🔥 THIS app.py FILE IS RUNNING 🔥")
+# =============================================================================
+# ImageWorks backend
+# =============================================================================
+# create_app() builds the Flask app; every route lives on the "main"
+# blueprint below. Importing this module does no database work and doesn't
+# load the Gemini SDK (upstream.py imports it on first use), so workers and
+# tests start fast.
+#
+#   flask --app app migrate           create tables + apply migrations.py
+#   flask --app app run               serve (python app.py migrates first)
+#   flask --app app startup-report    where import / startup time goes
+
+import time
+_IMPORT_STARTED = time.perf_counter()
 
-from flask import Flask, request, jsonify, send_from_directory , render_template, send_file
-from flask_cors import CORS
 import os
-from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
-from flask import url_for
-import requests
-from datetime import datetime
+
+# Before the local modules below: they read their settings at import time
+load_dotenv()
+
+from flask import Flask, Blueprint, current_app, request, jsonify, send_from_directory , render_template
+from flask_cors import CORS
+from werkzeug.utils import secure_filename
+from flask import url_for, redirect, stream_with_context
+import sys
 import json
 import base64
-import google.generativeai as genai
-from models import db, History ,User
+import logging
+import subprocess
+import threading
+from urllib.parse import urlencode
+import click
+from flask.cli import with_appcontext
+from models import db, History ,User, HistoryAsset
 import traceback
+from jobs import JobQueue, QueueFull, QueueUnavailable
+import upstream
+import events
+from events_server import EventServer, EVENTS_SERVER_ENABLED
+from prompt_enhancer import PromptEnhancer, PromptRejected, ENHANCE_BATCH_MAX
+import inline_image
+from result_cache import ResultCache
+from upload_store import UploadStore
+from upload_stream import parse_upload_request, UploadRejected, MAX_UPLOAD_REQUEST_BYTES
+from thumbnails import ThumbnailService, SIZE_CLASSES
+from preprocess import ImagePreprocessor
+from storage_gc import StorageGC
+from asset_index import OUTPUT_ROLE, asset_view
+import history_search
+from assets import AssetServer
+
+from sqlalchemy import or_, and_, type_coerce, String
+from sqlalchemy.orm import joinedload
+from sqlalchemy.exc import OperationalError
+from migrations import run_migrations
+from database import init_db
+from history_recorder import HistoryRecorder
+from fanout import fan_out
+from admission import Admission
+import metrics
+from auth import hash_password, verify_password, password_needs_rehash, create_token, get_current_user, start_hash_pool, \
+    verify_token, load_user, HashingUnavailable
+
+IMPORT_SECONDS = time.perf_counter() - _IMPORT_STARTED
+
+log = logging.getLogger(__name__)
 
-from sqlalchemy import text
-from auth import hash_password, verify_password, create_token, get_current_user
-
-
-
-
-
-load_dotenv()
 # 1. Get the path to the 'backend' folder
 BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
 
 # 2. Go up one level to 'ImageWorks-Master' and then into 'frontend'
 FRONTEND_DIR = os.path.abspath(os.path.join(BACKEND_DIR, '..', 'frontend'))
 
-app = Flask(__name__, 
-            static_folder=os.path.join(FRONTEND_DIR, 'static'), 
-            static_url_path='/static')
-
-# CORS(app)  # allow frontend JS calls
-CORS(app, resources={r"/api/*": {"origins": "*"}})
-
-
+bp = Blueprint("main", __name__)
 
 
 # ---------------- CONFIG ----------------
@@ -45,49 +82,36 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 GENERATED_DIR = os.path.join(BASE_DIR, "generated")
 UPLOAD_FOLDER = os.path.join(BASE_DIR, "uploads")
 OUTPUT_FOLDER = os.path.join(BASE_DIR, "outputs")
+THUMBNAIL_DIR = os.path.join(BASE_DIR, "thumbnails")
+PREPARED_DIR = os.path.join(BASE_DIR, "prepared")
 
 
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "webp"}
 
-os.makedirs(GENERATED_DIR, exist_ok=True)
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-os.makedirs(OUTPUT_FOLDER, exist_ok=True)
-
-NANOBANANA_KEY = os.environ.get("NANOBANANA_KEY")
-
-# Configure Gemini API
-genai.configure(api_key=NANOBANANA_KEY)
-
-os.makedirs(GENERATED_DIR, exist_ok=True)
+# Base used in the image URLs we hand back / store in history
+PUBLIC_BASE_URL = os.environ.get("PUBLIC_BASE_URL", "http://127.0.0.1:5000")
 
-print(f"[INFO] Flask app started")
-print(f"[INFO] Generated dir: {GENERATED_DIR}")
-print(f"[INFO] API Key exists: {bool(NANOBANANA_KEY)}")
+# Run migrations inside create_app() (tests, quick local runs); otherwise use `flask migrate`
+AUTO_MIGRATE = os.environ.get("AUTO_MIGRATE", "0") == "1"
 
 # ---------------- ROOT ----------------
-# @app.route("/", methods=["GET"])
+# @bp.route("/", methods=["GET"])
 # def index():
 #     return jsonify({
 #         "success": True,
 #         "message": "Server is running"
 #     })
 
-#============================================================================
-# ---------------- DATABASE CONFIG ----------------
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///imageai.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db.init_app(app)
+# History rows are written in batches by a background thread (history_recorder.py)
+history_recorder = HistoryRecorder()
 
-with app.app_context():
-    db.create_all()
-    print(f"Current Database Path: {app.config['SQLALCHEMY_DATABASE_URI']}")
-    count = db.session.execute(text("SELECT count(*) FROM history")).scalar()
-    print(f"--- SUCCESS: Total records found in ROOT database: {count} ---")
+# Token buckets per (user, tool) and an in-flight cap for generation endpoints (admission.py)
+admission = Admission()
 # DATABASE CONFIGURATION
 # =============================================================================
 
 
-@app.route('/test-db')
+@bp.route('/test-db')
 def test_db():
 #     """
 #     Test route to verify database is working.
@@ -111,13 +135,13 @@ def test_db():
           return render_template('test_db.html', users=all_users)
       
 
-# @app.route('/')
+# @bp.route('/')
 # def index():
 #     html_path = os.path.join(os.path.dirname(__file__), '..', 'frontend', 'index.html')
 #     return send_file(html_path)
 
 # Route for the Main Dashboard (index.html)
-# @app.route('/dashboard')
+# @bp.route('/dashboard')
 # def dashboard():
 #     # This looks for index.html inside the "frontend" folder, one level up from "backend"
 #     frontend_dir = os.path.join(os.path.dirname(BASE_DIR), 'frontend')
@@ -128,26 +152,26 @@ def test_db():
 
 
 # 1. The Public Landing Page (Home)
-@app.route('/')
+@bp.route('/')
 def home():
     return send_from_directory(FRONTEND_DIR, 'home.html')
 
 # 2. The Private Dashboard
-@app.route('/dashboard')
+@bp.route('/dashboard')
 def dashboard():
     return send_from_directory(FRONTEND_DIR, 'index.html')
 
 # 3. Handle Login/Register specifically (if they are in templates folder)
-@app.route('/login')
+@bp.route('/login')
 def login_page():
     return send_from_directory(os.path.join(FRONTEND_DIR, 'templates'), 'login.html')
 
-@app.route('/register')
+@bp.route('/register')
 def register_page():
     return send_from_directory(os.path.join(FRONTEND_DIR, 'templates'), 'register.html')
 
 # Catch-all route for tools (like tool-prompt-to-image.html)
-@app.route('/<path:filename>')
+@bp.route('/<path:filename>')
 def serve_frontend(filename):
     # Try serving from 'frontend/templates' first (for login/register)
     template_path = os.path.join(FRONTEND_DIR, 'templates')
@@ -160,7 +184,14 @@ def serve_frontend(filename):
 # AUTH API ROUTES
 # =============================================================================
 
-@app.route('/api/register', methods=['POST'])
+def hashing_unavailable(error):
+    """503 for a login / registration the password hashing pool couldn't take (auth.py)."""
+    response = jsonify({'error': 'Server busy, try again shortly', 'retry_after': error.retry_after})
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, 503
+
+
+@bp.route('/api/register', methods=['POST'])
 def api_register():
     data = request.get_json()
     if not data:
@@ -176,10 +207,15 @@ def api_register():
     if User.query.filter_by(email=email).first():
         return jsonify({'error': 'Email already registered'}), 400
 
+    try:
+        password_hash = hash_password(password)
+    except HashingUnavailable as e:
+        return hashing_unavailable(e)
+
     new_user = User(
         username=username,
         email=email,
-        password_hash=hash_password(password)
+        password_hash=password_hash
     )
     db.session.add(new_user)
     db.session.commit()
@@ -187,7 +223,7 @@ def api_register():
     return jsonify({'message': 'Registration successful!'}), 201
 
 
-@app.route('/api/login', methods=['POST'])
+@bp.route('/api/login', methods=['POST'])
 def api_login():
     data = request.get_json()
     if not data:
@@ -197,8 +233,20 @@ def api_login():
     password = data.get('password')
 
     user = User.query.filter_by(email=email).first()
-    if not user or not verify_password(user.password_hash, password):
-        return jsonify({'error': 'Invalid credentials'}), 401
+    try:
+        if not user or not verify_password(user.password_hash, password):
+            return jsonify({'error': 'Invalid credentials'}), 401
+    except HashingUnavailable as e:
+        return hashing_unavailable(e)
+
+    # Upgrade hashes made with an older method / cost factor (at the next
+    # login instead if the hashing pool is busy right now)
+    if password_needs_rehash(user.password_hash):
+        try:
+            user.password_hash = hash_password(password)
+            db.session.commit()
+        except HashingUnavailable:
+            pass
 
     token = create_token(user.id, user.is_admin)
 
@@ -216,16 +264,22 @@ def api_login():
 
 
 
-# ---------------- SERVE GENERATED ----------------
-@app.route("/generated/<filename>")
+# ---------------- SERVE GENERATED / UPLOADS / THUMBNAILS ----------------
+# ETags, 304s, Range and long-lived caching for content-addressed files: see assets.py
+assets = AssetServer({
+    "generated": GENERATED_DIR,
+    "uploads": UPLOAD_FOLDER,
+    "thumbnails": THUMBNAIL_DIR
+}, cors=True)
+
+
+@bp.route("/generated/<filename>")
 def serve_generated_image(filename):
-    response = send_from_directory(GENERATED_DIR, filename, as_attachment=False)
-    response.headers["Access-Control-Allow-Origin"] = "*"
-    return send_from_directory(GENERATED_DIR, filename)
+    return assets.serve("generated", filename)
 
-@app.route('/uploads/<path:filename>')
+@bp.route('/uploads/<path:filename>')
 def serve_uploads(filename):
-    return send_from_directory("uploads", filename)
+    return assets.serve("uploads", filename)
 
 SYSTEM_PROMPTS = {
     "prompt-to-image": (
@@ -257,54 +311,294 @@ SYSTEM_PROMPTS = {
     )
 }
 # ---------------- IMAGE GENERATION ----------------
-def generate_nano_banana_image(prompt, style):
+def generate_nano_banana_image(prompt, style="", images=()):
+    """images: preprocess.PreparedImage inputs, sent inline after the prompt."""
     try:
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-image:generateContent?key={NANOBANANA_KEY}"
-        headers = {'Content-Type': 'application/json'}
-
         payload = {
             "contents": [
                 {
                     "parts": [
-                        {"text": f"{prompt} {style}"}
+                        {"text": f"{prompt} {style}".strip()},
+                        *({"inline_data": {"mime_type": image.mime,
+                                           "data": base64.b64encode(image.data).decode("ascii")}}
+                          for image in images)
                     ]
                 }
             ]
         }
 
-        response = requests.post(url, headers=headers, json=payload)
-        print("Gemini status:", response.status_code)
-        print("Gemini response:", response.text)
+        # Pooled session, timeouts, in-flight cap and retries live in upstream.py.
+        # The body is decoded as it streams in, straight to generated/<sha256>.<ext>
+        events.emit("upstream-started")
+        with upstream.client.stream_content(payload) as response:
+            events.emit("decoding")
+            saved = inline_image.save_inline_image(response.iter_content(inline_image.CHUNK_SIZE), GENERATED_DIR)
 
-        if response.status_code != 200:
-            return None
+        if saved:
+            return saved[0]
 
-        data = response.json()
+        print("❌ No image returned by Gemini")
+        return None
 
-        parts = data.get("candidates", [{}])[0].get("content", {}).get("parts", [])
+    except (upstream.UpstreamError, inline_image.InlineImageError) as e:
+        log.warning("Gemini request failed: %s", e, exc_info=True)
+        return None
 
-        for part in parts:
-            if "inline_data" in part:
-                image_data = part["inline_data"]["data"]
+    except Exception:
+        log.exception("Image generation failed")
+        return None
 
-                os.makedirs("generated", exist_ok=True)
-                file_path = "generated/generated_image.png"
 
-                with open(file_path, "wb") as f:
-                    f.write(base64.b64decode(image_data))
+def generated_url(filename):
+    return f"{PUBLIC_BASE_URL}/generated/{filename}"
 
-                return "http://127.0.0.1:5000/generated/generated_image.png"
 
-        print("❌ No image returned by Gemini")
-        return None
+# ---------------- UPLOAD STORE ----------------
+# One file per content digest: uploads/ab/cd/<sha256>.<ext>
+upload_store = UploadStore(UPLOAD_FOLDER)
 
-    except Exception as e:
-        print("🔥 Backend crash:", str(e))
-        return None
+
+# ---------------- RESULT CACHE ----------------
+# Same tool + formatted prompt + aspect/style + input images => same output.
+result_cache = ResultCache(GENERATED_DIR)
+
+
+def wants_fresh_result(form=None):
+    """
+    Per-request cache bypass: ?no_cache=1, "no_cache": true in the body, or
+    Cache-Control: no-cache. Upload endpoints pass their streamed form fields.
+    """
+    if "no-cache" in request.headers.get("Cache-Control", ""):
+        return True
+    if form is None:
+        form = request.get_json(silent=True) or {}
+    flag = request.args.get("no_cache") or form.get("no_cache")
+    return str(flag).lower() in ("1", "true", "yes")
+
+
+def receive_uploads(*file_fields):
+    """Stream the multipart body into the upload store (see upload_stream.py)."""
+    upload = parse_upload_request(upload_store, file_fields, ALLOWED_EXTENSIONS)
+    thumbnails.schedule(stored.path for stored in upload.files.values())
+    preprocessor.schedule(upload.files.values())
+    return upload
+
+
+# ---------------- INPUT PREPROCESSING ----------------
+# Uploads go upstream downscaled + re-encoded, prepared once per digest (see preprocess.py)
+preprocessor = ImagePreprocessor(PREPARED_DIR)
+
+
+def prepared_inputs(upload_ids):
+    """PreparedImage for each upload store id, in order."""
+    return [preprocessor.prepare(UploadStore.digest_of(upload_id), upload_store.abs_path(upload_id))
+            for upload_id in upload_ids]
+
+
+# ---------------- THUMBNAILS ----------------
+# Small WebP/JPEG copies of outputs and uploads for the history cards.
+thumbnails = ThumbnailService(THUMBNAIL_DIR, {
+    "generated": GENERATED_DIR,
+    "uploads": UPLOAD_FOLDER
+}, PUBLIC_BASE_URL)
+
+
+def history_thumbs(record):
+    """{"image": {"sm": url, "md": url}, "face": {...}, ...} for a History row."""
+    if record.assets:
+        links = sorted(record.assets, key=lambda link: link.role != OUTPUT_ROLE)
+        thumbs = {}
+        for link in links:
+            urls = thumbnails.thumb_urls(link.asset.path)
+            if urls:
+                thumbs["image" if link.role == OUTPUT_ROLE else link.role] = urls
+        return thumbs
+
+    # Rows with no indexed files: "Text Input" rows, or written before asset_index.py
+    thumbs = {}
+    if record.output_image:
+        urls = thumbnails.thumb_urls(record.output_image)
+        if urls:
+            thumbs["image"] = urls
+
+    try:
+        inputs = json.loads(record.input_image) if record.input_image else {}
+    except ValueError:
+        inputs = {}          # "Text Input" and other plain values
+    if isinstance(inputs, dict):
+        for role, ref in inputs.items():
+            urls = thumbnails.thumb_urls(ref)
+            if urls:
+                thumbs[role] = urls
+    return thumbs
+
+
+@bp.route("/thumbs/<size>/<path:ref>")
+def serve_thumbnail(size, ref):
+    normalized = thumbnails.normalize_ref(ref)
+    if size not in SIZE_CLASSES or not normalized:
+        return jsonify({"success": False, "error": "Not found"}), 404
+
+    rel = f"{size}/{normalized}.{thumbnails.ext}"
+
+    # Thumbnails of content-addressed files never change: once the asset
+    # layer knows the file, serve it without checking the source again
+    if UploadStore.digest_of(normalized) is None or assets.metadata("thumbnails", rel) is None:
+        path = thumbnails.ensure(normalized, size)
+        if not path:
+            # Thumbnails unavailable (no Pillow, unreadable image): serve the original
+            if os.path.isfile(thumbnails.source_path(normalized) or ""):
+                return redirect(f"/{normalized}")
+            return jsonify({"success": False, "error": "Not found"}), 404
+        assets.forget(path)
+
+    return assets.serve("thumbnails", rel)
+
+
+@bp.route("/api/cache/stats", methods=["GET"])
+def cache_stats():
+
+    current_user, error = get_current_user()
+    if error:
+        return error
+    if not current_user.is_admin:
+        return jsonify({"success": False, "error": "Admin only"}), 403
+
+    return jsonify({
+        "success": True,
+        "result_cache": result_cache.stats(),
+        "admission": admission.stats(),
+        "storage_gc": storage_gc.stats()
+    }), 200
+
+
+# ---------------- GENERATION JOBS ----------------
+# Tool endpoints only validate + save uploads, then queue a job and return 202.
+# The worker runs the matching handler below (see JOB_HANDLERS at the bottom).
+job_queue = JobQueue()
+
+
+def queue_generation(tool_name, user_id, payload):
+    try:
+        job = job_queue.submit(tool_name, user_id, payload)
+    except QueueFull:
+        return jsonify({"success": False, "error": "Server busy, try again shortly"}), 503
+    except QueueUnavailable:
+        log.error("%s request on a process without job workers", tool_name)
+        return jsonify({"success": False, "error": "Generation is unavailable on this server"}), 503
+
+    return jsonify({
+        "success": True,
+        "job_id": job.id,
+        "status": job.status,
+        "status_url": url_for("main.get_job", job_id=job.id),
+        "events_url": url_for("main.event_stream")
+    }), 202
+
+
+def run_generation(tool_name, final_prompt, aspect=None, style=None, input_digests=(), bypass_cache=False,
+                   input_uploads=()):
+    """
+    Returns the public URL of the output image. Served from the result cache
+    when the same request was generated before (unless bypass_cache).
+    input_digests are the upload store digests of the input images;
+    input_uploads their upload store ids, sent to the model (prepared) on a miss.
+    """
+    key = ResultCache.make_key(tool_name, final_prompt, aspect, style, input_digests)
+
+    if not bypass_cache:
+        filename = result_cache.get(key)
+        if filename:
+            return generated_url(filename)
+
+    file_path = generate_nano_banana_image(final_prompt, images=prepared_inputs(input_uploads))
+    if not file_path:
+        raise RuntimeError("Image generation failed")
+
+    url = generated_url(result_cache.put(key, tool_name, file_path))
+    thumbnails.schedule([url], on_ready=events.bind("thumbnail-ready"))
+    return url
+
+
+@bp.route("/api/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+
+    current_user, error = get_current_user()
+    if error:
+        return error
+
+    job = job_queue.get(job_id, current_user.id)
+    if not job:
+        return jsonify({"success": False, "error": "Job not found"}), 404
+
+    return jsonify({"success": True, **JobQueue.to_dict(job)}), 200
+
+
+# ---------------- PROGRESS EVENTS ----------------
+# One SSE stream per signed-in user with the lifecycle of all their jobs
+# (events.py). EventSource can't send headers, so the token may also be
+# passed as ?token=. Reconnects resume from the Last-Event-ID header.
+# Streams are held by the asyncio server in events_server.py, not by
+# request threads: this route only authenticates and redirects there.
+def stream_user_id(token):
+    """User id for an event stream token, or None (events_server.py)."""
+    data = verify_token(token)
+    user = load_user(data["user_id"]) if data else None
+    return user.id if user else None
+
+
+event_server = EventServer(events.broker, stream_user_id)
+
+
+@bp.route("/api/events", methods=["GET"])
+def event_stream():
+    current_user, error = get_current_user(allow_query_token=True)
+    if error:
+        return error
+
+    if EVENTS_SERVER_ENABLED and event_server.ensure_started():
+        token = request.args.get("token") or request.headers.get("Authorization", "").split(" ")[-1]
+        params = {"token": token}
+        last_event_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+        if last_event_id:
+            params["last_event_id"] = last_event_id
+        return redirect(f"{event_server.public_url(request)}/api/events?{urlencode(params)}", code=307)
+
+    # Fallback: stream from this request thread
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_event_id = None
+
+    response = current_app.response_class(events.broker.stream(current_user.id, last_event_id),
+                                  mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
 
 
 #----------------------Prompt to image history--------------------------------------
-@app.route("/api/get-history", methods=["GET"])
+HISTORY_PAGE_SIZE = 5
+HISTORY_MAX_PAGE_SIZE = 50
+
+
+def encode_history_cursor(created_raw, record_id):
+    return base64.urlsafe_b64encode(f"{created_raw}|{record_id}".encode()).decode().rstrip("=")
+
+
+def decode_history_cursor(cursor):
+    """Returns (created_at as stored, id) or None if cursor is missing/invalid."""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_raw, record_id = raw.rsplit("|", 1)
+        return created_raw, int(record_id)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+@bp.route("/api/get-history", methods=["GET"])
 def get_history():
 
     current_user, error = get_current_user()
@@ -315,17 +609,44 @@ def get_history():
     target_tool = request.args.get("tool")
     if not target_tool:
         return jsonify({"success": False, "error": "tool required"}), 400
-    
-    
 
-    records = (
-        History.query
-        .filter(History.tool_name == target_tool, History.user_id == current_user.id)
-        .order_by(History.created_at.desc())
-        .limit(5)
+    # Keyset pagination: ?limit=N&before=<next_cursor from the previous page>
+    limit = min(max(request.args.get("limit", HISTORY_PAGE_SIZE, type=int), 1), HISTORY_MAX_PAGE_SIZE)
+    cursor = decode_history_cursor(request.args.get("before"))
+    if request.args.get("before") and not cursor:
+        return jsonify({"success": False, "error": "invalid cursor"}), 400
+
+    # created_at is compared as stored text so the cursor matches rows exactly
+    # (rows hold both "YYYY-MM-DD HH:MM:SS" and "... .ffffff" timestamps)
+    created_raw = type_coerce(History.created_at, String)
+
+    # Assets come in the same statement (LEFT JOIN on the limited page of rows)
+    query = (
+        db.session.query(History, created_raw)
+        .options(joinedload(History.assets).joinedload(HistoryAsset.asset))
+        .filter(History.user_id == current_user.id, History.tool_name == target_tool)
+    )
+    if cursor:
+        cursor_created, cursor_id = cursor
+        query = query.filter(or_(
+            created_raw < cursor_created,
+            and_(created_raw == cursor_created, History.id > cursor_id)
+        ))
+
+    # Same order as ix_history_user_tool_created (created_at DESC, id), so
+    # SQLite walks the index with no sort step
+    rows = (
+        query
+        .order_by(History.created_at.desc(), History.id.asc())
+        .limit(limit + 1)
         .all()
     )
 
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_history_cursor(rows[-1][1], rows[-1][0].id)
+
     return jsonify({
         "success": True,
         "history": [{
@@ -333,78 +654,234 @@ def get_history():
             "input": r.input_text,         # Keeps old tools working
             "image": r.output_image,       # Keeps old tools working
             "raw_input_img": r.input_image, # New: for Specs/Hair logic
+            "thumbs": history_thumbs(r),   # Small versions of image + inputs for the cards
+            "assets": {link.role: asset_view(link.asset, PUBLIC_BASE_URL) for link in r.assets},
             "date": r.created_at.strftime("%Y-%m-%d %H:%M")
-        } for r in records]
+        } for r, _ in rows],
+        "next_cursor": next_cursor
     }),200
+
+
+# ---------------- HISTORY SEARCH ----------------
+# ?q=<words>&tool=<optional>&limit=N&cursor=<next_cursor>: the user's rows
+# whose prompts match every word (the last one as a prefix), best match
+# first, with the matches wrapped in <mark> (history_search.py).
+SEARCH_MAX_QUERY_LENGTH = 200
+
+
+@bp.route("/api/history/search", methods=["GET"])
+def search_history():
+
+    current_user, error = get_current_user()
+    if error:
+        return error
+
+    query_text = request.args.get("q", "")[:SEARCH_MAX_QUERY_LENGTH]
+    target_tool = request.args.get("tool") or None
+
+    limit = min(max(request.args.get("limit", HISTORY_PAGE_SIZE, type=int), 1), HISTORY_MAX_PAGE_SIZE)
+    cursor = history_search.decode_cursor(request.args.get("cursor"))
+    if request.args.get("cursor") and not cursor:
+        return jsonify({"success": False, "error": "invalid cursor"}), 400
+
+    try:
+        found = history_search.search(current_user.id, query_text, target_tool, limit, cursor)
+    except OperationalError as e:
+        db.session.rollback()
+        if "no such table" in str(e):
+            return jsonify({"success": False, "error": "Search index not built yet (run: flask migrate)"}), 503
+        raise
+    if found is None:
+        return jsonify({"success": False, "error": "q required"}), 400
+    results, next_cursor = found
+
+    return jsonify({
+        "success": True,
+        "results": [{
+            "id": r.id,
+            "tool": r.tool_name,
+            "input": r.input_text,
+            "image": r.output_image,
+            "thumbs": history_thumbs(r),
+            "highlight": {
+                "input": history_search.marked(input_hl),
+                "output": history_search.marked(output_hl)
+            },
+            # bm25, higher is a better match; None when sorted newest first
+            "score": round(-rank, 4) if rank is not None else None,
+            "date": r.created_at.strftime("%Y-%m-%d %H:%M") if r.created_at else None
+        } for r, rank, input_hl, output_hl in results],
+        "next_cursor": next_cursor
+    }), 200
 # ---------------- PROMPT TO IMAGE ----------------
 
 
 
-@app.route("/api/prompt-to-image", methods=["POST"])
+@bp.route("/api/prompt-to-image", methods=["POST"])
 def prompt_to_image():
 
     current_user, error = get_current_user()
-    print("hello current user")
     if error:
         return error
-    print("error -------------------")
+
+    # Per-user rate limit + global load shedding, before any upload is read
+    error = admission.admit(current_user.id, "prompt-to-image")
+    if error:
+        return error
     
     try:
-        # 1. RECEIVE
-        data = request.json
-        user_prompt = data.get("prompt", "").strip()
-        user_style = data.get("imgstyle", "clean")
-        user_aspect = data.get("aspect", "1:1")
-
-        if not user_prompt:
-            return jsonify({"success": False, "error": "Prompt is required"}), 400
-
-        # 2. ENHANCE (The Format Logic)
-        # Injects user data into the "Professional" recipe
-        final_prompt = SYSTEM_PROMPTS["prompt-to-image"].format(
-            style=user_style, 
-            prompt=user_prompt
-        )
-        # Add aspect ratio instruction to the prompt
-        final_prompt += f" Final Aspect Ratio: {user_aspect}."
-
-        # 3. GENERATE (AI Call)
-        # Replace this with your actual Gemini function later
-        generated_url = "http://127.0.0.1:5000/generated/test.jpg" 
-
-        # 4. RECORD (Save to History Table)
-        new_entry = History(
-            tool_name="prompt-to-image",
-            input_text=f"[Aspect Ratio: {user_aspect}] |  Prompt: {user_prompt}",
-            output_text=final_prompt,
-            output_image=generated_url,
-            
-            user_id=current_user.id  # User ID from token (secure!)
-        )
-        db.session.add(new_entry)
-        db.session.commit()
+        # 1. RECEIVE + 2. ENHANCE (see prompt_to_image_spec)
+        spec, spec_error = prompt_to_image_spec(request.json)
+        if spec_error:
+            return jsonify({"success": False, "error": spec_error}), 400
 
-        print(f"DEBUG: Saved to DB. ID is: {new_entry.id}")
-        print(f"DEBUG: DB Path is: {app.config['SQLALCHEMY_DATABASE_URI']}")
-
-        
-
-        # 5. RESPOND
-        return jsonify({
-            "success": True,
-            "image_url": generated_url
-            
-        }), 201
+        # 3. GENERATE + RECORD happen in the job worker (run_prompt_to_image)
+        spec["bypass_cache"] = wants_fresh_result()
+        return queue_generation("prompt-to-image", current_user.id, spec)
 
     except Exception as e:
         db.session.rollback()
         return jsonify({"success": False, "error": str(e)}), 500
+
+
+def prompt_to_image_spec(data):
+    """Job payload for one prompt/imgstyle/aspect request, or (None, error message)."""
+    if not isinstance(data, dict):
+        return None, "Expected a JSON object"
+
+    user_prompt = str(data.get("prompt") or "").strip()
+    user_style = data.get("imgstyle", "clean")
+    user_aspect = data.get("aspect", "1:1")
+
+    if not user_prompt:
+        return None, "Prompt is required"
+
+    # Injects user data into the "Professional" recipe
+    final_prompt = SYSTEM_PROMPTS["prompt-to-image"].format(
+        style=user_style,
+        prompt=user_prompt
+    )
+    # Add aspect ratio instruction to the prompt
+    final_prompt += f" Final Aspect Ratio: {user_aspect}."
+
+    return {
+        "prompt": user_prompt,
+        "style": user_style,
+        "aspect": user_aspect,
+        "final_prompt": final_prompt
+    }, None
+
+
+def prompt_to_image_history(spec, image_url, user_id):
+    return dict(
+        tool_name="prompt-to-image",
+        input_text=f"[Aspect Ratio: {spec['aspect']}] |  Prompt: {spec['prompt']}",
+        output_text=spec["final_prompt"],
+        output_image=image_url,
+        user_id=user_id
+    )
+
+
+def run_prompt_to_image(payload, user_id):
+    image_url = run_generation("prompt-to-image", payload["final_prompt"],
+                               aspect=payload["aspect"], style=payload.get("style"),
+                               bypass_cache=payload.get("bypass_cache", False))
+
+    history_recorder.record(**prompt_to_image_history(payload, image_url, user_id))
+
+    return {"image_url": image_url}
+
+
+# ---------------- PROMPT TO IMAGE: BATCH ----------------
+# {"items": [{"prompt", "imgstyle", "aspect"}, ...], "concurrency": n}
+# One job for the whole batch: items are generated PROMPT_BATCH_CONCURRENCY
+# at a time, history rows for every success are written in one transaction,
+# and the job result lists every item (success or error) in input order.
+PROMPT_BATCH_MAX = int(os.environ.get("PROMPT_BATCH_MAX", 100))
+PROMPT_BATCH_CONCURRENCY = int(os.environ.get("PROMPT_BATCH_CONCURRENCY", 4))
+
+# Admission charges a batch one token per item: the bucket holds a whole
+# batch and refills at the per-generation rate
+admission.set_default("prompt-to-image/batch", admission.default_limit[0], PROMPT_BATCH_MAX)
+
+
+@bp.route("/api/prompt-to-image/batch", methods=["POST"])
+def prompt_to_image_batch():
+
+    current_user, error = get_current_user()
+    if error:
+        return error
+
+    data = request.get_json(silent=True) or {}
+    items = data.get("items")
+    if not isinstance(items, list) or not items:
+        return jsonify({"success": False, "error": "items must be a non-empty list"}), 400
+    if len(items) > PROMPT_BATCH_MAX:
+        return jsonify({"success": False, "error": f"Too many items (max {PROMPT_BATCH_MAX})"}), 400
+
+    # Per-user rate limit, one token per generation, + global load shedding
+    error = admission.admit(current_user.id, "prompt-to-image/batch", cost=len(items))
+    if error:
+        return error
+
+    try:
+        concurrency = int(data.get("concurrency", PROMPT_BATCH_CONCURRENCY))
+    except (TypeError, ValueError):
+        return jsonify({"success": False, "error": "concurrency must be a number"}), 400
+
+    # Invalid items are reported in the results, they don't fail the batch
+    specs = []
+    for item in items:
+        spec, spec_error = prompt_to_image_spec(item)
+        specs.append(spec if spec else {"error": spec_error})
+
+    return queue_generation("prompt-to-image/batch", current_user.id, {
+        "items": specs,
+        "concurrency": max(1, min(concurrency, PROMPT_BATCH_CONCURRENCY)),
+        "bypass_cache": wants_fresh_result()
+    })
+
+
+def run_prompt_to_image_batch(payload, user_id):
+    specs = payload["items"]
+    bypass_cache = payload.get("bypass_cache", False)
+    results = [None] * len(specs)
+
+    valid = [i for i, spec in enumerate(specs) if "error" not in spec]
+    for i, spec in enumerate(specs):
+        if "error" in spec:
+            results[i] = {"index": i, "success": False, "error": spec["error"]}
+
+    def generate(index):
+        spec = specs[index]
+        return run_generation("prompt-to-image", spec["final_prompt"],
+                              aspect=spec["aspect"], style=spec.get("style"),
+                              bypass_cache=bypass_cache)
+
+    rows = []
+    for n, image_url, gen_error in fan_out(current_app._get_current_object(), generate, valid, payload["concurrency"]):
+        index = valid[n]
+        if gen_error:
+            results[index] = {"index": index, "success": False, "error": str(gen_error)}
+            continue
+        results[index] = {"index": index, "success": True, "image_url": image_url,
+                          "prompt": specs[index]["prompt"]}
+        rows.append(prompt_to_image_history(specs[index], image_url, user_id))
+
+    # All history rows of the batch land in one transaction
+    history_recorder.record_many(rows)
+
+    return {
+        "results": results,
+        "succeeded": len(rows),
+        "failed": len(specs) - len(rows)
+    }
     
 
         
 #-------------------------------delete history--------------------------------------------------------------
 # 3. DELETE RECORD
-@app.route("/api/delete-history/<int:record_id>", methods=["DELETE"])
+@bp.route("/api/delete-history/<int:record_id>", methods=["DELETE"])
 def delete_history(record_id):
     # Step 1: Check if user is logged in
     current_user, error = get_current_user()
@@ -431,51 +908,53 @@ def delete_history(record_id):
     # return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 #---------------------------------------------------------------------------- x --------------------------------------------------- x ---------------------------------
 # ---------------- IMAGE TO STYLE ----------------
-@app.route("/api/image-style", methods=["POST"])
+@bp.route("/api/image-style", methods=["POST"])
 def api_image_style():
 
     current_user, error = get_current_user()
     if error:
         return error
+
+    # Per-user rate limit + global load shedding, before any upload is read
+    error = admission.admit(current_user.id, "image-to-style")
+    if error:
+        return error
     
     try:
-        # 1. Mandatory File Check
-        if "image" not in request.files:
-            return jsonify({"success": False, "error": "Image is required"}), 400
-
-        image = request.files["image"]
-        if image.filename == "":
-            return jsonify({"success": False, "error": "No image selected"}), 400
-
-        # 2. Extract Data (Text is optional)
-        style = request.form.get("style", "Cinematic")
-        instruction = request.form.get("instruction", "").strip()
-        aspect = request.form.get("aspect", "1:1")
-
-        # Save the uploaded file safely
-        filename = secure_filename(image.filename)
-        image.save(os.path.join(UPLOAD_FOLDER, filename))
-
-        # 3. Logic Fix: Return the test.jpg result
-        generated_url = "http://127.0.0.1:5000/generated/test.jpg"
-
-        # 4. Record to Database History
-        new_entry = History(
-            tool_name="image-to-style",
-            input_text=f"[Aspect ratio : {aspect}] | Style: {style}  | Prompt : (File: {filename})",
-            output_text=instruction if instruction else f"Stylized as {style}",
-            output_image=generated_url,
-            user_id=current_user.id  # User ID from token (secure!)
-
-        )
-        db.session.add(new_entry)
-        db.session.commit()
+        # 1. Stream the upload to disk (size + type checked while reading)
+        try:
+            upload = receive_uploads("image")
+        except UploadRejected as e:
+            return jsonify({"success": False, "error": e.message}), e.status
 
-        
+        # 2. Mandatory File Check
+        if "image" not in upload.files:
+            return jsonify({"success": False, "error": "Image is required"}), 400
 
-        return jsonify({
-            "success": True,
-            "output_url": generated_url
+        stored = upload.files["image"]
+        filename = secure_filename(upload.filenames["image"])
+
+        # 3. Extract Data (Text is optional)
+        style = upload.form.get("style", "Cinematic")
+        instruction = upload.form.get("instruction", "").strip()
+        aspect = upload.form.get("aspect", "1:1")
+
+        final_prompt = SYSTEM_PROMPTS["image-to-style"].format(style=style)
+        if instruction:
+            final_prompt += f" {instruction}"
+        final_prompt += f" Final Aspect Ratio: {aspect}."
+
+        # 4. Generation + history are done by the job worker (run_image_style)
+        return queue_generation("image-to-style", current_user.id, {
+            "style": style,
+            "instruction": instruction,
+            "aspect": aspect,
+            "filename": filename,
+            "input_image": json.dumps({"image": stored.path}),
+            "input_digests": [stored.digest],
+            "input_uploads": [stored.id],
+            "final_prompt": final_prompt,
+            "bypass_cache": wants_fresh_result(upload.form)
         })
 
     except Exception as e:
@@ -483,34 +962,52 @@ def api_image_style():
         return jsonify({"success": False, "error": str(e)}), 500
 
 
+def run_image_style(payload, user_id):
+    output_url = run_generation("image-to-style", payload["final_prompt"],
+                                aspect=payload["aspect"], style=payload["style"],
+                                input_digests=payload["input_digests"],
+                                input_uploads=payload.get("input_uploads", ()),
+                                bypass_cache=payload.get("bypass_cache", False))
+
+    history_recorder.record(
+        tool_name="image-to-style",
+        input_text=f"[Aspect ratio : {payload['aspect']}] | Style: {payload['style']}  | Prompt : (File: {payload['filename']})",
+        output_text=payload["instruction"] if payload["instruction"] else f"Stylized as {payload['style']}",
+        input_image=payload["input_image"],
+        output_image=output_url,
+        user_id=user_id
+    )
+
+    return {"output_url": output_url}
+
+
 #----------------------Specs Try On--------------------------------------------------------------------
 
-@app.route("/api/specs-tryon", methods=["POST"])
+@bp.route("/api/specs-tryon", methods=["POST"])
 def specs_tryon():
 
     current_user, error = get_current_user()
     if error:
         return error
-    try:
-        # 1. Validation
-        if "face" not in request.files or "specs" not in request.files:
-            return jsonify({"success": False, "error": "Missing files"}), 400
 
-        face = request.files["face"]
-        specs = request.files["specs"]
-        user_instruction = request.form.get("prompt", "")
+    # Per-user rate limit + global load shedding, before any upload is read
+    error = admission.admit(current_user.id, "specs-tryon")
+    if error:
+        return error
+    try:
+        # 1. Stream uploads to disk (content-addressed, size + type checked while reading)
+        try:
+            upload = receive_uploads("face", "specs")
+        except UploadRejected as e:
+            return jsonify({"success": False, "error": e.message}), e.status
 
-        # 2. Setup Paths
-        ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-        f_fn = f"face_{ts}_{secure_filename(face.filename)}"
-        s_fn = f"specs_{ts}_{secure_filename(specs.filename)}"
-        
-        # Ensure directories exist
-        os.makedirs("uploads", exist_ok=True)
-        os.makedirs("generated", exist_ok=True)
+        # 2. Validation
+        if "face" not in upload.files or "specs" not in upload.files:
+            return jsonify({"success": False, "error": "Missing files"}), 400
 
-        face.save(os.path.join("uploads", f_fn))
-        specs.save(os.path.join("uploads", s_fn))
+        face_upload = upload.files["face"]
+        specs_upload = upload.files["specs"]
+        user_instruction = upload.form.get("prompt", "")
 
         # 3. SYSTEM PROMPT FORMATTING
         # This combines your preset instructions with the user's text
@@ -518,75 +1015,76 @@ def specs_tryon():
             prompt=user_instruction if user_instruction else "natural fit"
         )
 
-        # 3. Pack JSON
+        # 4. Pack JSON
         input_history_data = json.dumps({
-            "face": f"uploads/{f_fn}",
-            "specs": f"uploads/{s_fn}"
+            "face": face_upload.path,
+            "specs": specs_upload.path
         })
 
-        
-
-        # 4. Result Path
-        output_url = "http://127.0.0.1:5000/generated/test.jpg"
-
-        # 5. Database Insertion 
-        # NOTE: I am using 'input_image' and 'output_image'. 
-        # If your table uses 'image', change 'output_image' to 'image' below.
-        # 5. Database Insertion 
-        new_entry = History(
-            tool_name='specs-tryon',
-            # USE final_prompt HERE so you save the full AI instructions
-            input_text=user_instruction if user_instruction else "natural fit", 
-            input_image=input_history_data, 
-            output_image=output_url,
-            created_at=datetime.utcnow(),
-            user_id=current_user.id  # User ID from token (secure!)
-
-        )
-        
-        db.session.add(new_entry)
-        db.session.commit()
-
-        return jsonify({"success": True, "output_url": output_url})
+        # 5. Generation + history are done by the job worker (run_specs_tryon)
+        return queue_generation("specs-tryon", current_user.id, {
+            "instruction": user_instruction if user_instruction else "natural fit",
+            "input_image": input_history_data,
+            "input_digests": [face_upload.digest, specs_upload.digest],
+            "input_uploads": [face_upload.id, specs_upload.id],
+            "final_prompt": final_prompt,
+            "bypass_cache": wants_fresh_result(upload.form)
+        })
 
-    except Exception as e:
+    except Exception:
         print("--- SERVER CRASH LOG ---")
         traceback.print_exc() # Check your VS Code / CMD terminal for this output!
         db.session.rollback()
         return jsonify({"success": False, "error": "Database or Server Error"}), 500
+
+
+def run_specs_tryon(payload, user_id):
+    output_url = run_generation("specs-tryon", payload["final_prompt"],
+                                input_digests=payload["input_digests"],
+                                input_uploads=payload.get("input_uploads", ()),
+                                bypass_cache=payload.get("bypass_cache", False))
+
+    history_recorder.record(
+        tool_name='specs-tryon',
+        input_text=payload["instruction"],
+        input_image=payload["input_image"],
+        output_image=output_url,
+        user_id=user_id
+    )
+
+    return {"output_url": output_url}
     
 
 #------------------------------------------Haircut Previeew-----------------------------------------
 # =========================================================
 # HAIRCUT PREVIEW (DUMMY AI)
 # =========================================================
-@app.route("/api/haircut-preview", methods=["POST"])
+@bp.route("/api/haircut-preview", methods=["POST"])
 def haircut_preview():
 
     current_user, error = get_current_user()
     if error:
         return error
-    try:
-        # 1. Validation - matching HTML names 'you' and 'sample'
-        if "you" not in request.files or "sample" not in request.files:
-            return jsonify({"success": False, "error": "Missing files"}), 400
 
-        user_photo = request.files["you"]
-        hair_sample = request.files["sample"]
-        # prompt = request.form.get("prompt", "")
+    # Per-user rate limit + global load shedding, before any upload is read
+    error = admission.admit(current_user.id, "haircut-preview")
+    if error:
+        return error
+    try:
+        # 1. Stream uploads to disk (content-addressed, size + type checked while reading)
+        try:
+            upload = receive_uploads("you", "sample")
+        except UploadRejected as e:
+            return jsonify({"success": False, "error": e.message}), e.status
 
-        user_instruction_prompt = request.form.get("prompt", "").strip()
+        # 2. Validation - matching HTML names 'you' and 'sample'
+        if "you" not in upload.files or "sample" not in upload.files:
+            return jsonify({"success": False, "error": "Missing files"}), 400
 
-        # 2. Setup Paths
-        ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-        u_fn = f"user_{ts}_{secure_filename(user_photo.filename)}"
-        h_fn = f"hair_{ts}_{secure_filename(hair_sample.filename)}"
-        
-        os.makedirs("uploads", exist_ok=True)
-        os.makedirs("generated", exist_ok=True)
+        user_upload = upload.files["you"]
+        hair_upload = upload.files["sample"]
 
-        user_photo.save(os.path.join("uploads", u_fn))
-        hair_sample.save(os.path.join("uploads", h_fn))
+        user_instruction_prompt = upload.form.get("prompt", "").strip()
 
         # ✅ 3. SYSTEM PROMPT MODIFICATION
         # This injects the user's request into the professional hair stylist template
@@ -594,43 +1092,48 @@ def haircut_preview():
         prompt=user_instruction_prompt if user_instruction_prompt  else "seamless blend with natural lighting"
         )
 
-        # 3. Pack JSON for history
+        # 4. Pack JSON for history
         input_history_data = json.dumps({
-            "face": f"uploads/{u_fn}",
-            "sample": f"uploads/{h_fn}"
+            "face": user_upload.path,
+            "sample": hair_upload.path
         })
 
-        # 4. Result Path (Mocking the AI output)
-        output_url = "http://127.0.0.1:5000/generated/test.jpg"
-
-        # 5. Database Insertion
-        # ✅ 6. Database Insertion (Modified to use final_prompt)
-        new_entry = History(
-            tool_name='haircut-preview',
-            input_text=user_instruction_prompt if user_instruction_prompt  else "seamless blend with natural lighting", # Store the full engineered prompt here
-            input_image=input_history_data,
-            output_image=output_url,
-            created_at=datetime.utcnow(),
-            user_id=current_user.id  # User ID from token (secure!)
-
-        )
-
-        
-        db.session.add(new_entry)
-        db.session.commit()
-
-        return jsonify({"success": True, "output_url": output_url})
+        # 5. Generation + history are done by the job worker (run_haircut_preview)
+        return queue_generation("haircut-preview", current_user.id, {
+            "instruction": user_instruction_prompt if user_instruction_prompt else "seamless blend with natural lighting",
+            "input_image": input_history_data,
+            "input_digests": [user_upload.digest, hair_upload.digest],
+            "input_uploads": [user_upload.id, hair_upload.id],
+            "final_prompt": final_prompt,
+            "bypass_cache": wants_fresh_result(upload.form)
+        })
 
     except Exception as e:
         print("--- HAIRCUT ERROR ---")
         traceback.print_exc()
         db.session.rollback()
         return jsonify({"success": False, "error": str(e)}), 500
-    
+
+
+def run_haircut_preview(payload, user_id):
+    output_url = run_generation("haircut-preview", payload["final_prompt"],
+                                input_digests=payload["input_digests"],
+                                input_uploads=payload.get("input_uploads", ()),
+                                bypass_cache=payload.get("bypass_cache", False))
+
+    history_recorder.record(
+        tool_name='haircut-preview',
+        input_text=payload["instruction"],
+        input_image=payload["input_image"],
+        output_image=output_url,
+        user_id=user_id
+    )
+
+    return {"output_url": output_url}
+
 #--------------------------------------------Insta-story-template--------------------------------
-GENERATED_FOLDER = os.path.join(os.getcwd(), "generated")
 
-@app.route("/api/insta-story", methods=["POST", "OPTIONS"])
+@bp.route("/api/insta-story", methods=["POST", "OPTIONS"])
 def api_insta_story():
 
     current_user, error = get_current_user()
@@ -640,6 +1143,11 @@ def api_insta_story():
     if request.method == "OPTIONS":
         return jsonify({"success": True}), 200
 
+    # Per-user rate limit + global load shedding, before any upload is read
+    error = admission.admit(current_user.id, "insta-story")
+    if error:
+        return error
+
     try:
         # 1. Safely get the data from your JS fetch
         data = request.get_json() or {}
@@ -655,38 +1163,35 @@ def api_insta_story():
         else:
             final_prompt = f"{template} {user_text}"
 
-        output_url = "http://127.0.0.1:5000/generated/test.jpg"
-
-        # 4. Database logic (wrapped so it never crashes the main response)
-        try:
-            new_entry = History(
-                tool_name='insta-story',
-                input_text=f"Prompt : {user_text}",
-                input_image="Text Input",
-                output_image=output_url,
-                created_at=datetime.utcnow(),
-                user_id=current_user.id  # User ID from token (secure!)
-
-            )
-            db.session.add(new_entry)
-            db.session.commit()
-        except Exception as db_e:
-            db.session.rollback()
-            print(f"DB Error: {db_e}")
-
-        # 5. Send back exactly what JS is waiting for
-        return jsonify({
-            "success": True,
-            "output_url": output_url
+        # 4. Generation + history are done by the job worker (run_insta_story)
+        return queue_generation("insta-story", current_user.id, {
+            "overlay_text": user_text,
+            "final_prompt": final_prompt,
+            "bypass_cache": wants_fresh_result()
         })
 
     except Exception as e:
         print(f"CRITICAL ERROR: {e}")
         return jsonify({"success": False, "error": str(e)}), 500
+
+
+def run_insta_story(payload, user_id):
+    output_url = run_generation("insta-story", payload["final_prompt"],
+                                bypass_cache=payload.get("bypass_cache", False))
+
+    history_recorder.record(
+        tool_name='insta-story',
+        input_text=f"Prompt : {payload['overlay_text']}",
+        input_image="Text Input",
+        output_image=output_url,
+        user_id=user_id
+    )
+
+    return {"output_url": output_url}
     
 #-------------------------------------Social media post generator------------------------------------------
 
-@app.route("/api/social/generate", methods=["POST", "OPTIONS"])
+@bp.route("/api/social/generate", methods=["POST", "OPTIONS"])
 def generate_social_post():
 
     current_user, error = get_current_user()
@@ -695,6 +1200,11 @@ def generate_social_post():
     
     if request.method == "OPTIONS":
         return jsonify({"success": True}), 200
+
+    # Per-user rate limit + global load shedding, before any upload is read
+    error = admission.admit(current_user.id, "social/generate")
+    if error:
+        return error
     
     try:
         # FIX: Define platform and prompt from the request
@@ -710,35 +1220,37 @@ def generate_social_post():
         template = SYSTEM_PROMPTS.get("social-post", "A {platform} post: {prompt}")
         final_prompt = template.format(platform=platform, prompt=prompt if prompt else "Aesthetic visual")
 
-        output_url = "http://127.0.0.1:5000/generated/test.jpg"
-
-        # Database save logic
-        try:
-            new_entry = History(
-                tool_name='social/generate', 
-                input_text=f"Platform: {platform} | Prompt: {prompt if prompt else 'Aesthetic visual'}",
-                input_image="Text Input",
-                output_image=output_url,
-                created_at=datetime.utcnow(),
-                user_id=current_user.id  # User ID from token (secure!)
-
-            )
-            db.session.add(new_entry)
-            db.session.commit()
-        except Exception as db_e:
-            db.session.rollback()
-            print(f"DB Error: {db_e}")
-
-        return jsonify({
-            "success": True,
-            "image_url": output_url,
-            "caption": "Your AI generated caption here...",
-            "hashtags": "#AI #Generated",
-            "tips": "Post this at 10 AM."
+        # Generation + history are done by the job worker (run_social_post)
+        return queue_generation("social/generate", current_user.id, {
+            "platform": platform,
+            "prompt": prompt if prompt else "Aesthetic visual",
+            "final_prompt": final_prompt,
+            "bypass_cache": wants_fresh_result()
         })
     except Exception as e:
         # This catch-all will now catch errors properly without crashing the server
         return jsonify({"success": False, "error": str(e)}), 500
+
+
+def run_social_post(payload, user_id):
+    output_url = run_generation("social/generate", payload["final_prompt"],
+                                style=payload["platform"],
+                                bypass_cache=payload.get("bypass_cache", False))
+
+    history_recorder.record(
+        tool_name='social/generate',
+        input_text=f"Platform: {payload['platform']} | Prompt: {payload['prompt']}",
+        input_image="Text Input",
+        output_image=output_url,
+        user_id=user_id
+    )
+
+    return {
+        "image_url": output_url,
+        "caption": "Your AI generated caption here...",
+        "hashtags": "#AI #Generated",
+        "tips": "Post this at 10 AM."
+    }
 #--------------------------------------Story Animation-----------------------------------------
 # Tool-specific generated folders
 TOOL_FOLDERS = {
@@ -746,97 +1258,253 @@ TOOL_FOLDERS = {
     "post_generator": os.path.join(BASE_DIR, "generated_post")
 }
 
-# Ensure folders exist
-for folder in TOOL_FOLDERS.values():
-    os.makedirs(folder, exist_ok=True)
 
 
 # ----------- Story Image Generator API -----------
 # ---------- STORY IMAGE API ----------
-@app.route("/api/story-image", methods=["POST"])
+# {"prompt": "...", "scenes": 4 | ["scene text", ...], "style": "...",
+#  "concurrency": n, "order": "scene" | "completion", "format": "json" | "ndjson" | "sse"}
+#
+# Scenes are generated concurrently (STORY_CONCURRENCY at a time). With
+# "ndjson" or "sse" (or an Accept header asking for either) every scene is
+# sent as soon as it's ready: in scene order by default, or as they finish
+# with "order": "completion". "json" keeps the old single response.
+STORY_SCENES = int(os.environ.get("STORY_SCENES", 4))
+STORY_MAX_SCENES = int(os.environ.get("STORY_MAX_SCENES", 8))
+STORY_CONCURRENCY = int(os.environ.get("STORY_CONCURRENCY", 4))
+
+STORY_SCENE_PROMPT = (
+    "Scene {scene} of {total} of an illustrated story, in {style} style. "
+    "Keep the characters, color palette and art style consistent across all scenes. "
+    "Story: {prompt}. Show this scene: {scene_text}"
+)
+
+
+@bp.route("/api/story-image", methods=["POST"])
 def story_image_api():
 
-    scenes = []
-    for i in range(1, 5):
-        scenes.append({
-            "scene": i,
-            "image_url": f"/api/story-image/file/test.jpg"
+    current_user, error = get_current_user()
+    if error:
+        return error
+
+    # Per-user rate limit + global load shedding, before any upload is read
+    error = admission.admit(current_user.id, "story-image")
+    if error:
+        return error
+
+    data = request.get_json(silent=True) or {}
+    story = str(data.get("prompt") or data.get("story") or "").strip()
+    style = str(data.get("style") or "storybook illustration")
+    scenes = data.get("scenes", STORY_SCENES)
+
+    if not story:
+        return jsonify({"success": False, "error": "Prompt is required"}), 400
+
+    # Either a number of scenes or the text of each scene
+    if isinstance(scenes, list):
+        scene_texts = [str(text).strip() for text in scenes]
+    else:
+        try:
+            scene_texts = [f"part {i} of the story" for i in range(1, int(scenes) + 1)]
+        except (TypeError, ValueError):
+            return jsonify({"success": False, "error": "scenes must be a number or a list"}), 400
+    if not 1 <= len(scene_texts) <= STORY_MAX_SCENES:
+        return jsonify({"success": False, "error": f"Between 1 and {STORY_MAX_SCENES} scenes"}), 400
+
+    try:
+        concurrency = max(1, min(int(data.get("concurrency", STORY_CONCURRENCY)), STORY_CONCURRENCY))
+    except (TypeError, ValueError):
+        return jsonify({"success": False, "error": "concurrency must be a number"}), 400
+
+    order = data.get("order", "scene")
+    if order not in ("scene", "completion"):
+        return jsonify({"success": False, "error": "order must be 'scene' or 'completion'"}), 400
+
+    stream_format = data.get("format") or story_stream_format()
+    if stream_format not in ("json", "ndjson", "sse"):
+        return jsonify({"success": False, "error": "format must be 'json', 'ndjson' or 'sse'"}), 400
+
+    prompts = [
+        STORY_SCENE_PROMPT.format(scene=i, total=len(scene_texts), style=style,
+                                  prompt=story, scene_text=text)
+        for i, text in enumerate(scene_texts, start=1)
+    ]
+    bypass_cache = wants_fresh_result()
+
+    def generate(index):
+        return run_generation("story-image", prompts[index], style=style, bypass_cache=bypass_cache)
+
+    def scenes_done():
+        """Scene dicts as they become available, in the requested order."""
+        ready, next_index = {}, 0
+        rows = []
+        try:
+            for index, image_url, gen_error in fan_out(current_app._get_current_object(), generate, range(len(prompts)), concurrency):
+                scene = {"scene": index + 1, "success": gen_error is None}
+                if gen_error:
+                    scene["error"] = str(gen_error)
+                else:
+                    scene["image_url"] = image_url
+                    rows.append(dict(
+                        tool_name="story-image",
+                        input_text=f"Story: {story} | Scene {index + 1}: {scene_texts[index]}",
+                        output_text=prompts[index],
+                        output_image=image_url,
+                        user_id=current_user.id
+                    ))
+
+                if order == "completion":
+                    yield scene
+                    continue
+                ready[index] = scene
+                while next_index in ready:
+                    yield ready.pop(next_index)
+                    next_index += 1
+        finally:
+            history_recorder.record_many(rows)
+
+    if stream_format == "json":
+        scenes_out = list(scenes_done())
+        return jsonify({
+            "status": "success",
+            "success": True,
+            "scenes": scenes_out
         })
 
-    return jsonify({
-        "status": "success",
-        "scenes": scenes
-    })
+    def body():
+        for scene in scenes_done():
+            yield encode_story_event("scene", scene, stream_format)
+        yield encode_story_event("done", {"scenes": len(prompts)}, stream_format)
+
+    mimetype = "text/event-stream" if stream_format == "sse" else "application/x-ndjson"
+    response = current_app.response_class(stream_with_context(body()), mimetype=mimetype)
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"     # don't let nginx buffer the stream
+    return response
+
+
+def story_stream_format():
+    accept = request.accept_mimetypes
+    if accept.best == "text/event-stream":
+        return "sse"
+    if accept.best == "application/x-ndjson":
+        return "ndjson"
+    return "json"
 
-@app.route("/generated/<filename>")
-def serve_generated(filename):
-    return send_from_directory(GENERATED_FOLDER, filename)
 
+def encode_story_event(event, data, stream_format):
+    if stream_format == "sse":
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    return json.dumps(dict(data, type=event)) + "\n"
 
 # ---------- SERVE GENERATED IMAGE ----------
-# @app.route("/api/story-image/file/<filename>")
+# @bp.route("/api/story-image/file/<filename>")
 # def serve_story_image(filename):
     # return send_from_directory(GENERATED_DIR, filename)
 
 
 # ========== PROMPT ENHANCER ==========
-@app.route("/api/enhance-prompt", methods=["POST"])
+# Cached on the normalized prompt; the batch endpoint packs cache misses
+# into as few upstream calls as possible (prompt_enhancer.py)
+prompt_enhancer = PromptEnhancer(upstream.client)
+
+
+def enhancer_user():
+    """
+    The enhancer works without logging in; a valid token just means the
+    result is saved to that user's history. Returns (user or None, error).
+    """
+    if request.headers.get("Authorization") is None:
+        return None, None
+    return get_current_user()
+
+
+def record_enhancement(user, simple_prompt, enhanced_prompt):
+    if user is None:
+        return
+    history_recorder.record(
+        tool_name="prompt-enhancer",
+        input_text=simple_prompt,
+        input_image=None,
+        output_text=enhanced_prompt,
+        output_image=None,
+        user_id=user.id
+    )
+
+
+@bp.route("/api/enhance-prompt", methods=["POST"])
 def enhance_prompt():
     """Enhance a simple prompt into a detailed, image-generation-ready prompt"""
+    current_user, error = enhancer_user()
+    if error:
+        return error
+
     try:
-        data = request.json
-        simple_prompt = data.get("prompt", "").strip()
-        
+        data = request.get_json(silent=True) or {}
+        simple_prompt = (data.get("prompt") or "").strip()
+
         if not simple_prompt:
             return jsonify({"success": False, "error": "Prompt cannot be empty"}), 400
-        
-        # Use Gemini to enhance the prompt
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        
-        enhancement_instruction = f"""You are an expert prompt engineer for AI image generation models.
-        
-Take this simple prompt and enhance it into a detailed, vivid, and comprehensive prompt suitable for high-quality image generation.
-
-Add details about:
-- Visual style and aesthetic
-- Lighting and atmosphere
-- Color palette
-- Composition and framing
-- Quality indicators (masterpiece, highly detailed, professional, etc.)
-- Any relevant artistic styles or references
 
-Simple prompt: {simple_prompt}
-
-Respond with ONLY the enhanced prompt, nothing else. Make it detailed but concise (1-2 sentences max)."""
-        
-        response = model.generate_content(enhancement_instruction)
-        enhanced_prompt = response.text.strip()
+        enhanced_prompt, cached = prompt_enhancer.enhance(simple_prompt)
 
         # ✅ SAVE TO HISTORY TABLE
-        history = History(
-            tool_name="prompt-enhancer",
-            input_text=simple_prompt,
-            input_image=None,
-            output_text=enhanced_prompt,
-            output_image=None
-        )
+        record_enhancement(current_user, simple_prompt, enhanced_prompt)
 
-        db.session.add(history)
-        db.session.commit()
-
-        
         return jsonify({
             "success": True,
             "original_prompt": simple_prompt,
-            "enhanced_prompt": enhanced_prompt
+            "enhanced_prompt": enhanced_prompt,
+            "cached": cached
         }), 200
-        
+
+    except PromptRejected as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    except upstream.UpstreamError as e:
+        return jsonify({"success": False, "error": str(e)}), 503 if e.status in (429, 503) else 502
     except Exception as e:
         print(f"[ERROR] enhance_prompt: {str(e)}")
         return jsonify({"success": False, "error": str(e)}), 500
-    
+
+
+@bp.route("/api/enhance-prompt/batch", methods=["POST"])
+def enhance_prompt_batch():
+    """
+    {"prompts": ["a cat", "a dog", ...]} -> one result per prompt, in order.
+    Cache hits cost nothing; misses share a few upstream calls.
+    """
+    current_user, error = enhancer_user()
+    if error:
+        return error
+
+    data = request.get_json(silent=True) or {}
+    prompts = data.get("prompts")
+    if not isinstance(prompts, list) or not prompts:
+        return jsonify({"success": False, "error": "prompts must be a non-empty list"}), 400
+    if len(prompts) > ENHANCE_BATCH_MAX:
+        return jsonify({"success": False, "error": f"Too many prompts (max {ENHANCE_BATCH_MAX})"}), 400
+
+    try:
+        prompts = [p.strip() if isinstance(p, str) else p for p in prompts]
+        enhanced = prompt_enhancer.enhance_many(prompts)
+    except PromptRejected as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    except upstream.UpstreamError as e:
+        return jsonify({"success": False, "error": str(e)}), 503 if e.status in (429, 503) else 502
+
+    results = []
+    for simple_prompt, (enhanced_prompt, cached) in zip(prompts, enhanced):
+        record_enhancement(current_user, simple_prompt, enhanced_prompt)
+        results.append({
+            "original_prompt": simple_prompt,
+            "enhanced_prompt": enhanced_prompt,
+            "cached": cached
+        })
+
+    return jsonify({"success": True, "results": results}), 200
+
 # ========== PROMPT ENHANCER HISTORY ==========
-@app.route("/api/prompt-enhancer/history", methods=["GET"])
+@bp.route("/api/prompt-enhancer/history", methods=["GET"])
 def prompt_enhancer_history():
     history_items = (
         History.query
@@ -861,14 +1529,181 @@ def prompt_enhancer_history():
 
 
 
-# ---------------- RUN ----------------
-print("ROUTES REGISTERED:")
-for rule in app.url_map.iter_rules():
-    print(rule)
+# ---------------- JOB WORKERS ----------------
+JOB_HANDLERS = {
+    "prompt-to-image": run_prompt_to_image,
+    "prompt-to-image/batch": run_prompt_to_image_batch,
+    "image-to-style": run_image_style,
+    "specs-tryon": run_specs_tryon,
+    "haircut-preview": run_haircut_preview,
+    "insta-story": run_insta_story,
+    "social/generate": run_social_post
+}
 
 
-if __name__ == "__main__":
-  
-    app.run(debug=True)
+# ---------------- STORAGE RETENTION ----------------
+# Unreferenced files past a grace period + storage quotas (see storage_gc.py)
+storage_gc = StorageGC(thumbnails=thumbnails, preprocessor=preprocessor)
+
 
+# ---------------- METRICS ----------------
+@bp.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    return metrics.metrics_response()
 
+
+metrics.gauge("imageworks_jobs_pending", "Generation jobs queued or running in this process.", job_queue.pending)
+metrics.gauge("imageworks_admission_in_flight", "Admitted generation requests in progress.", admission.in_flight)
+metrics.gauge("imageworks_history_pending", "History rows waiting to be written.", history_recorder.pending)
+metrics.gauge("imageworks_result_cache_hits", "Result cache hits since start.", lambda: result_cache.hits)
+metrics.gauge("imageworks_result_cache_misses", "Result cache misses since start.", lambda: result_cache.misses)
+
+
+# =============================================================================
+# APP FACTORY
+# =============================================================================
+
+def create_app(config=None):
+    timings = {"imports": IMPORT_SECONDS}
+    started = time.perf_counter()
+
+    # Background workers (hash pool, history flusher, storage sweeper, job
+    # queue) run once per process and only when serving: CLI commands
+    # (migrate, gc, ...) must not start them or take over jobs
+    background = (config or {}).get("BACKGROUND_WORKERS", serving())
+
+    # Fork the password hashing processes before any worker threads exist
+    if background:
+        start_hash_pool()
+    timings["hash pool"] = _lap(started)
+
+    app = Flask(__name__,
+                static_folder=os.path.join(FRONTEND_DIR, 'static'),
+                static_url_path='/static')
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///imageai.db'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_REQUEST_BYTES
+    app.config['AUTO_MIGRATE'] = AUTO_MIGRATE
+    app.config.update(config or {})
+    app.config['BACKGROUND_WORKERS'] = background
+
+    # CORS(app)  # allow frontend JS calls
+    CORS(app, resources={r"/api/*": {"origins": "*"}})
+
+    for folder in (GENERATED_DIR, UPLOAD_FOLDER, OUTPUT_FOLDER, *TOOL_FOLDERS.values()):
+        os.makedirs(folder, exist_ok=True)
+
+    # WAL, busy timeout, pooled connections and one serialized writer (database.py)
+    init_db(app, db)
+    # Per-route latency / status / SQL time, served at /metrics (metrics.py)
+    metrics.init_app(app, db)
+    if app.config['AUTO_MIGRATE']:
+        with app.app_context():
+            db.create_all()
+            run_migrations(db)
+    timings["database"] = _lap(started)
+
+    app.register_blueprint(bp)
+    app.cli.add_command(migrate_command)
+    app.cli.add_command(startup_report_command)
+    app.cli.add_command(gc_command)
+
+    admission.init_app(app)
+    storage_gc.init_app(app, background=background)
+    events.broker.init_app(app, background=background)
+    event_server.init_app(app)
+    if background:
+        # Without it (CLI), the recorder writes rows synchronously
+        history_recorder.init_app(app)
+        try:
+            job_queue.init_app(app, JOB_HANDLERS)
+        except OperationalError as e:
+            log.warning("Could not resume jobs (%s); run `flask --app app migrate`", e.orig)
+    timings["workers"] = _lap(started)
+
+    timings["total"] = IMPORT_SECONDS + _lap(started)
+    app.extensions["startup_timings"] = timings
+    log.info("Startup: %s", ", ".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in timings.items()))
+    return app
+
+
+def _lap(started):
+    return time.perf_counter() - started
+
+
+def serving():
+    """False when the app is being built for a `flask` command other than `flask run`."""
+    ctx = click.get_current_context(silent=True)
+    return ctx is None or ctx.info_name == "run"
+
+
+# ---------------- CLI ----------------
+
+@click.command("migrate")
+@with_appcontext
+def migrate_command():
+    """Create missing tables and apply pending schema migrations."""
+    db.create_all()
+    applied = run_migrations(db)
+    click.echo(f"Database ready ({len(applied)} migration(s) applied)")
+
+
+@click.command("gc")
+@click.option("--dry-run", is_flag=True, help="Report what would be removed without removing it.")
+@with_appcontext
+def gc_command(dry_run):
+    """Run one storage retention pass now (see storage_gc.py)."""
+    summary = storage_gc.run_locked(dry_run=dry_run)
+    if summary is None:
+        click.echo("Another process is sweeping right now")
+        return
+    click.echo(json.dumps(summary, indent=2))
+
+
+@click.command("startup-report")
+@click.option("--top", default=15, help="Number of slowest imports to list.")
+@with_appcontext
+def startup_report_command(top):
+    """Import timings of a cold `import app` plus create_app() phases."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"],
+                            cwd=BACKEND_DIR, capture_output=True, text=True)
+
+    imports = []
+    for line in result.stderr.splitlines():
+        # "import time:       self [us] |  cumulative | imported package"
+        parts = line.split("|")
+        if not line.startswith("import time:") or len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        imports.append((int(parts[1]), parts[2].rstrip()))
+
+    click.echo("Slowest imports (cumulative ms) of a cold `import app`:")
+    for cumulative, name in sorted(imports, reverse=True)[:top]:
+        click.echo(f"  {cumulative / 1000:8.1f}  {name}")
+
+    click.echo("This process:")
+    for name, seconds in current_app.extensions["startup_timings"].items():
+        click.echo(f"  {seconds * 1000:8.1f}  {name}")
+
+
+# ---------------- DEFAULT APP ----------------
+# `app` is built on first access, so "gunicorn app:app" and
+# "flask --app app" keep working while a plain import stays cheap.
+_default_app = None
+_default_app_lock = threading.Lock()
+
+
+def __getattr__(name):
+    global _default_app
+    if name != "app":
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    with _default_app_lock:
+        if _default_app is None:
+            _default_app = create_app()
+    return _default_app
+
+
+# ---------------- RUN ----------------
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    app = create_app({"AUTO_MIGRATE": True})
+    app.run(debug=True)
@@ -0,0 +1,196 @@
+# =============================================================================
+# Asset Index (assets + history_assets)
+# =============================================================================
+# History.input_image holds a JSON object of paths ({"face": ..., "specs": ...}),
+# a single path, a literal like "Text Input" or nothing, depending on the
+# tool, and output_image holds a URL. Finding the rows that use a file meant
+# a full scan plus string parsing. Every file a row points at now also has:
+#
+#   assets          one row per file: path (e.g. "uploads/ab/cd/<digest>.png"),
+#                   digest, size, mime, width, height
+#   history_assets  (history_id, role) -> asset_id, role being the key in
+#                   input_image ("face", "specs", ...), "input" for a plain
+#                   path and "output" for output_image
+#
+# The history recorder links rows in the same transaction that inserts
+# them; migration 2 backfilled the rows that existed before. input_image /
+# output_image are still written, for older clients.
+
+import os
+import json
+import logging
+from urllib.parse import urlparse
+
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from models import History, Asset, HistoryAsset
+from upload_store import UploadStore, MIME_TYPES
+
+try:
+    from PIL import Image
+except ImportError:          # dimensions are left empty without Pillow
+    Image = None
+
+log = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Ref prefix -> folder, for every folder history rows point into
+ASSET_ROOTS = {
+    prefix: os.path.join(BASE_DIR, *prefix.split("/"))
+    for prefix in ("uploads", "generated", "outputs", "static/uploads", "static/outputs",
+                   "generated_story_image", "generated_post")
+}
+# Longest first, so "static/uploads" wins over a shorter prefix
+_PREFIXES = sorted(ASSET_ROOTS, key=len, reverse=True)
+
+INPUT_ROLE = "input"
+OUTPUT_ROLE = "output"
+
+# SQLite's default limit on bound parameters is 999 in older builds
+IN_CHUNK = 500
+
+
+def normalize_ref(ref):
+    """"http://host/generated/x.png" -> "generated/x.png"; None if not under ASSET_ROOTS."""
+    if not ref or not isinstance(ref, str):
+        return None
+    path = (urlparse(ref).path if "://" in ref else ref).lstrip("/")
+    for prefix in _PREFIXES:
+        if path.startswith(prefix + "/") and len(path) > len(prefix) + 1:
+            return path
+    return None
+
+
+def path_of(ref):
+    for prefix in _PREFIXES:
+        if ref.startswith(prefix + "/"):
+            return os.path.join(ASSET_ROOTS[prefix], *ref[len(prefix) + 1:].split("/"))
+    return None
+
+
+def history_asset_refs(input_image, output_image):
+    """[(role, ref)] of the files a History row points at."""
+    pairs = []
+    if input_image:
+        try:
+            parsed = json.loads(input_image)
+        except ValueError:
+            parsed = input_image        # a plain path, or "Text Input"
+        if isinstance(parsed, dict):
+            pairs.extend((str(role), value) for role, value in parsed.items())
+        elif isinstance(parsed, str):
+            pairs.append((INPUT_ROLE, parsed))
+    if output_image:
+        pairs.append((OUTPUT_ROLE, output_image))
+
+    refs = []
+    for role, value in pairs:
+        ref = normalize_ref(value)
+        if ref:
+            refs.append((role[:30], ref))
+    return refs
+
+
+def describe(ref):
+    """Column values of the Asset for ref, read from the file (header only for dimensions)."""
+    values = {
+        "path": ref,
+        "digest": UploadStore.digest_of(ref),
+        "mime": MIME_TYPES.get(UploadStore.extension_for(ref)),
+        "size": None, "width": None, "height": None
+    }
+    path = path_of(ref)
+    try:
+        values["size"] = os.path.getsize(path)
+    except (OSError, TypeError):
+        return values           # gone already; the row still records the reference
+    if Image is not None:
+        try:
+            with Image.open(path) as img:
+                values["width"], values["height"] = img.size
+        except Exception:
+            pass
+    return values
+
+
+def link_history_assets(conn, rows):
+    """
+    Create the assets / history_assets rows for inserted History rows.
+    rows: [(history_id, input_image, output_image)]. conn is a Session or
+    Connection; the caller commits.
+    """
+    links = []
+    for history_id, input_image, output_image in rows:
+        links.extend((history_id, role, ref) for role, ref in history_asset_refs(input_image, output_image))
+    if not links:
+        return 0
+
+    ids = asset_ids(conn, {ref for _, _, ref in links})
+    conn.execute(
+        sqlite_insert(HistoryAsset.__table__).on_conflict_do_nothing(),
+        [{"history_id": history_id, "role": role, "asset_id": ids[ref]} for history_id, role, ref in links]
+    )
+    return len(links)
+
+
+def asset_ids(conn, refs):
+    """{ref: asset id} for refs, creating the missing assets."""
+    table = Asset.__table__
+    ids = _existing_ids(conn, refs)
+
+    missing = [ref for ref in refs if ref not in ids]
+    if missing:
+        conn.execute(sqlite_insert(table).on_conflict_do_nothing(index_elements=["path"]),
+                     [describe(ref) for ref in missing])
+        ids.update(_existing_ids(conn, missing))
+    return ids
+
+
+def _existing_ids(conn, refs):
+    table = Asset.__table__
+    refs = list(refs)
+    ids = {}
+    for i in range(0, len(refs), IN_CHUNK):
+        chunk = refs[i:i + IN_CHUNK]
+        ids.update(conn.execute(select(table.c.path, table.c.id).where(table.c.path.in_(chunk))).all())
+    return ids
+
+
+def asset_view(asset, public_base_url=""):
+    """JSON for one asset in API responses."""
+    served = asset.path.split("/", 1)[0] in ("uploads", "generated")
+    return {
+        "path": asset.path,
+        "url": f"{public_base_url}/{asset.path}" if served else None,
+        "digest": asset.digest,
+        "size": asset.size,
+        "mime": asset.mime,
+        "width": asset.width,
+        "height": asset.height
+    }
+
+
+# =============================================================================
+# BACKFILL (migration 2)
+# =============================================================================
+
+def backfill(conn, batch_size=500):
+    """Link every existing History row to its assets."""
+    Asset.__table__.create(conn, checkfirst=True)
+    HistoryAsset.__table__.create(conn, checkfirst=True)
+
+    table = History.__table__
+    last_id, linked = 0, 0
+    while True:
+        rows = conn.execute(
+            select(table.c.id, table.c.input_image, table.c.output_image)
+            .where(table.c.id > last_id).order_by(table.c.id).limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        linked += link_history_assets(conn, rows)
+        last_id = rows[-1].id
+
+    log.info("Linked %d history assets", linked)
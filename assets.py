@@ -0,0 +1,156 @@
+# =============================================================================
+# Static Asset Serving (generated/, uploads/, thumbnails/)
+# =============================================================================
+# One place that serves the files the app produces, with HTTP caching:
+#
+#   - strong ETags derived from content hashes
+#   - content-addressed files (named by their SHA-256, see upload_store.py /
+#     inline_image.py) are sent with "Cache-Control: public, max-age=1y,
+#     immutable"; everything else with "no-cache", so browsers revalidate
+#     and get a 304
+#   - If-None-Match -> 304 without opening the file
+#   - Range requests (206 / 416) via Werkzeug's make_conditional
+#   - per-file metadata (size, mtime, etag, mimetype) is cached, so a hit on
+#     a content-addressed file doesn't stat the disk at all; other files are
+#     re-checked with one stat at most every MUTABLE_METADATA_TTL seconds,
+#     and only re-hashed when their size or mtime changed
+
+import os
+import time
+import hashlib
+import mimetypes
+
+from flask import request, jsonify
+from werkzeug.security import safe_join
+from werkzeug.wrappers import Response
+from werkzeug.wsgi import wrap_file
+
+from lru import LRUCache
+from upload_store import UploadStore
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+MUTABLE_METADATA_TTL = 5
+METADATA_CACHE_SIZE = int(os.environ.get("ASSET_METADATA_CACHE_SIZE", 20000))
+
+CHUNK_SIZE = 64 * 1024
+
+
+class AssetMeta:
+    __slots__ = ("path", "size", "mtime", "etag", "mimetype", "immutable", "stamp", "checked")
+
+    def __init__(self, path, size, mtime, etag, mimetype, immutable, stamp=None):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.etag = etag
+        self.mimetype = mimetype
+        self.immutable = immutable
+        self.stamp = stamp                  # (st_size, st_mtime_ns) the etag was computed for
+        self.checked = time.monotonic()
+
+
+class AssetServer:
+    def __init__(self, roots, cors=False):
+        """roots maps a name ("generated", "uploads", ...) to its folder."""
+        self.roots = roots
+        self.cors = cors
+        self._meta = LRUCache(maxsize=METADATA_CACHE_SIZE)
+
+    # ---------------- METADATA ----------------
+
+    def metadata(self, root, filename):
+        """AssetMeta for roots[root]/filename, or None if it doesn't exist."""
+        path = safe_join(self.roots[root], filename)
+        if path is None:
+            return None
+
+        meta = self._meta.get(path)
+        if meta is not None and (meta.immutable or time.monotonic() - meta.checked < MUTABLE_METADATA_TTL):
+            return meta
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            self._meta.pop(path)
+            return None
+        if not os.path.isfile(path):
+            return None
+
+        stamp = (st.st_size, st.st_mtime_ns)
+        if meta is not None and meta.stamp == stamp:
+            # Unchanged since it was hashed: one stat, no read
+            meta.checked = time.monotonic()
+            return meta
+
+        digest = UploadStore.digest_of(path)
+        immutable = digest is not None
+        if immutable:
+            # "<digest>.png" -> digest; derivatives ("<digest>.png.webp" in a
+            # size folder) get a suffix so each representation has its own tag
+            basename = os.path.basename(path)
+            etag = digest if basename.count(".") <= 1 else \
+                f"{digest}-{hashlib.sha1(filename.encode()).hexdigest()[:12]}"
+        else:
+            etag = self._hash_file(path)
+
+        meta = AssetMeta(
+            path=path,
+            size=st.st_size,
+            mtime=int(st.st_mtime),
+            etag=etag,
+            mimetype=mimetypes.guess_type(path)[0] or "application/octet-stream",
+            immutable=immutable,
+            stamp=stamp
+        )
+        self._meta.set(path, meta)
+        return meta
+
+    def forget(self, path):
+        """Drop cached metadata, e.g. after deleting or rewriting a file."""
+        self._meta.pop(path)
+
+    @staticmethod
+    def _hash_file(path):
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                h.update(chunk)
+        return h.hexdigest()[:32]
+
+    # ---------------- RESPONSES ----------------
+
+    def serve(self, root, filename):
+        meta = self.metadata(root, filename)
+        if meta is None:
+            return jsonify({"success": False, "error": "Not found"}), 404
+
+        if request.if_none_match.contains(meta.etag):
+            response = Response(status=304)
+            self._cache_headers(response, meta)
+            return response
+
+        try:
+            f = open(meta.path, "rb")
+        except FileNotFoundError:
+            self.forget(meta.path)
+            return jsonify({"success": False, "error": "Not found"}), 404
+
+        response = Response(wrap_file(request.environ, f, CHUNK_SIZE),
+                            mimetype=meta.mimetype, direct_passthrough=True)
+        response.content_length = meta.size
+        self._cache_headers(response, meta)
+        # Handles If-Modified-Since and Range (206 / 416)
+        response.make_conditional(request, accept_ranges=True, complete_length=meta.size)
+        return response
+
+    def _cache_headers(self, response, meta):
+        response.set_etag(meta.etag)
+        response.last_modified = meta.mtime
+        if meta.immutable:
+            response.cache_control.public = True
+            response.cache_control.max_age = IMMUTABLE_MAX_AGE
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.no_cache = True
+        if self.cors:
+            response.headers["Access-Control-Allow-Origin"] = "*"
@@ -2,26 +2,133 @@
 # Part 6: Authentication Helpers (with @token_required decorator)
 # =============================================================================
 
+import os
+import time
+import logging
+import threading
+import multiprocessing
 import jwt
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timedelta
 # Note: We don't need 'wraps' anymore since we're not using decorators
 from flask import request, jsonify
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import event
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+
+from lru import LRUCache
+from models import db, User
+
+log = logging.getLogger(__name__)
 
 SECRET_KEY = "your-secret-key-change-in-production"
 TOKEN_EXPIRATION_HOURS = 24
 
+# Verified tokens are cached until their own "exp" (capped), users for a
+# short TTL and dropped as soon as the User row changes in this process.
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", 10000))
+TOKEN_CACHE_MAX_TTL = int(os.environ.get("TOKEN_CACHE_MAX_TTL", 3600))
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 5000))
+USER_CACHE_TTL = int(os.environ.get("USER_CACHE_TTL", 300))
+
+# Werkzeug method string, e.g. "scrypt:32768:8:1" or "pbkdf2:sha256:1000000".
+# Stored hashes made with anything else are upgraded on the next good login.
+PASSWORD_HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+PASSWORD_HASH_TIMEOUT = int(os.environ.get("PASSWORD_HASH_TIMEOUT", 30))
+PASSWORD_HASH_RETRY_AFTER = 5
+
 
 # =============================================================================
 # PASSWORD FUNCTIONS
 # =============================================================================
 
+# Hashing is deliberately slow and CPU-bound. It runs in a small process
+# pool so a burst of logins can't hold request threads (and the GIL) hostage.
+# With no pool (PASSWORD_HASH_WORKERS=0, or start_hash_pool() not called)
+# it simply runs inline. When the pool can't answer within
+# PASSWORD_HASH_TIMEOUT, or dies, the call raises HashingUnavailable and
+# the endpoint answers 503 + Retry-After; a dead pool is dropped, so later
+# calls hash inline.
+
+_hash_pool = None
+_hash_pool_lock = threading.Lock()
+
+
+class HashingUnavailable(Exception):
+    """The hashing pool is saturated or died; the client should retry shortly."""
+
+    retry_after = PASSWORD_HASH_RETRY_AFTER
+
+
+def start_hash_pool():
+    """
+    Start the hashing processes. Call early during startup: the pool uses
+    fork, which should happen before the app starts its own threads.
+    """
+    global _hash_pool
+    with _hash_pool_lock:
+        if _hash_pool is None and PASSWORD_HASH_WORKERS > 0 \
+                and "fork" in multiprocessing.get_all_start_methods():
+            _hash_pool = ProcessPoolExecutor(max_workers=PASSWORD_HASH_WORKERS,
+                                             mp_context=multiprocessing.get_context("fork"))
+            # With fork, the first submit launches every worker right away
+            _hash_pool.submit(int).result()
+    return _hash_pool
+
+
+def _run_hashing(fn, *args):
+    global _hash_pool
+    pool = _hash_pool
+    if pool is None:
+        return fn(*args)
+    future = None
+    try:
+        future = pool.submit(fn, *args)
+        return future.result(timeout=PASSWORD_HASH_TIMEOUT)
+    except FutureTimeout:
+        future.cancel()         # still queued: don't spend a worker on it
+        log.warning("Password hashing took over %ss, pool saturated", PASSWORD_HASH_TIMEOUT)
+        raise HashingUnavailable()
+    except BrokenProcessPool:
+        log.error("Password hashing pool died, hashing inline from now on")
+        with _hash_pool_lock:
+            if _hash_pool is pool:
+                _hash_pool = None
+        raise HashingUnavailable()
+
+
 def hash_password(password):
-    return generate_password_hash(password)
+    return _run_hashing(generate_password_hash, password, PASSWORD_HASH_METHOD)
 
 
 def verify_password(password_hash, password):
-    return check_password_hash(password_hash, password)
+    return _run_hashing(check_password_hash, password_hash, password)
+
+
+def full_hash_method(method):
+    """
+    The method string Werkzeug stores for method, with its defaults filled
+    in ("scrypt" -> "scrypt:32768:8:1"), worked out without hashing anything.
+    """
+    name, *args = method.split(":")
+    if name == "scrypt":
+        n, r, p = args if args else (2 ** 15, 8, 1)
+        return f"scrypt:{int(n)}:{int(r)}:{int(p)}"
+    if name == "pbkdf2":
+        hash_name = args[0] if args else "sha256"
+        iterations = args[1] if len(args) > 1 else DEFAULT_PBKDF2_ITERATIONS
+        return f"pbkdf2:{hash_name}:{int(iterations)}"
+    raise ValueError(f"Unsupported PASSWORD_HASH_METHOD {method!r}")
+
+
+_method_prefix = full_hash_method(PASSWORD_HASH_METHOD)
+
+
+def password_needs_rehash(password_hash):
+    """True if password_hash wasn't made with the configured method/cost."""
+    return password_hash.split("$", 1)[0] != _method_prefix
 
 
 # =============================================================================
@@ -44,6 +151,58 @@ def decode_token(token):
         return None
 
 
+# =============================================================================
+# AUTH CACHES
+# =============================================================================
+
+token_cache = LRUCache(maxsize=TOKEN_CACHE_SIZE)     # token -> decoded payload
+user_cache = LRUCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)   # user id -> CachedUser
+
+# What endpoints get as current_user: a plain snapshot, safe to share
+# between requests and threads (unlike a session-bound User instance)
+CachedUser = namedtuple("CachedUser", "id username email is_admin")
+
+
+def verify_token(token):
+    """decode_token() with a cache: repeat calls skip the signature check."""
+    data = token_cache.get(token)
+    if data is not None:
+        return data
+
+    data = decode_token(token)
+    if data:
+        ttl = min(data.get('exp', 0) - time.time(), TOKEN_CACHE_MAX_TTL)
+        if ttl > 0:
+            token_cache.set(token, data, ttl=ttl)
+    return data
+
+
+def load_user(user_id):
+    """CachedUser for user_id (cached), or None if the user doesn't exist."""
+    cached = user_cache.get(user_id)
+    if cached is not None:
+        return cached
+
+    user = db.session.get(User, user_id)
+    if not user:
+        return None
+
+    cached = CachedUser(user.id, user.username, user.email, bool(user.is_admin))
+    user_cache.set(user_id, cached)
+    return cached
+
+
+def invalidate_user(user_id):
+    """Call after bulk updates that bypass the ORM (query.update / raw SQL)."""
+    user_cache.pop(user_id)
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _drop_cached_user(mapper, connection, target):
+    invalidate_user(target.id)
+
+
 # =============================================================================
 # GET CURRENT USER (Helper Function)
 # =============================================================================
@@ -54,48 +213,44 @@ def decode_token(token):
 #   - (user, None) if token is valid
 #   - (None, error_response) if token is invalid
 
-def get_current_user():
+def get_current_user(allow_query_token=False):
     """
     Validates JWT token and returns current user.
 
     How it works:
     1. Checks for Authorization header
     2. Extracts and validates the JWT token
-    3. Fetches user from database
+    3. Fetches user (a CachedUser snapshot) from cache or database
     4. Returns (user, None) or (None, error_response)
     """
-    from models import User
 
     # Step 1: Check if Authorization header exists
-    if 'Authorization' not in request.headers:
+    auth_header = request.headers.get('Authorization')
+    if auth_header is None and allow_query_token and request.args.get('token'):
+        # For clients that can't set headers (EventSource)
+        auth_header = f"Bearer {request.args['token']}"
+    if auth_header is None:
         return None, (jsonify({'error': 'Token is missing'}), 401)
-    print("========================================")
-    print("Authorization header found.")
-    print(request.headers)
-    print(request.headers['Authorization'])
-    print("\n\n")
+
     # Step 2: Extract token from "Bearer <token>"
- 
-    auth_header = request.headers['Authorization']
     if not auth_header.startswith('Bearer '):
         return None, (jsonify({'error': 'Invalid token format'}), 401)
 
-    print("Split with (' ')")
-    print(auth_header.split(' '))
-    print("\n\n")
     token = auth_header.split(' ')[1]
 
-    # Step 3: Decode and validate token
-    data = decode_token(token)
-    print("Decoded token data:")
-    print(data)
+    # Step 3: Decode and validate token (cached until it expires)
+    data = verify_token(token)
     if not data:
+        log.debug("Rejected token on %s", request.path)
         return None, (jsonify({'error': 'Token is invalid or expired'}), 401)
 
-    # Step 4: Get user from database
-    current_user = User.query.get(data['user_id'])
+    # Step 4: Get user (cached snapshot, DB only on a miss)
+    current_user = load_user(data['user_id'])
     if not current_user:
         return None, (jsonify({'error': 'User not found'}), 401)
 
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Authenticated user %s on %s", current_user.id, request.path)
+
     # Success! Return user
     return current_user, None
@@ -0,0 +1,146 @@
+# =============================================================================
+# Fake Gemini generateContent server (for benchmarks)
+# =============================================================================
+# A local stand-in for
+#   POST https://generativelanguage.googleapis.com/v1beta/models/<model>:generateContent
+# that answers with one inline PNG, so the app can be load-tested without
+# spending API quota. Point the app at it with
+#   GEMINI_BASE_URL=http://127.0.0.1:<port>/v1beta
+#
+# Knobs: latency (+ random jitter), error rate (answered with 503 or 429,
+# like the real thing when overloaded) and the size of the returned image.
+# Each prompt gets a different image, so the app's content-addressed files
+# don't collapse into one.
+#
+#   python bench/fake_gemini.py --port 8765 --latency 0.8 --error-rate 0.02 --image-kb 900
+
+import sys
+import json
+import zlib
+import time
+import base64
+import random
+import struct
+import hashlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# 1x1 PNG; bigger images get a private ancillary chunk of padding, which
+# decoders (Pillow included) skip
+BASE_PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+)
+IEND = BASE_PNG[-12:]
+
+
+def padded_png(size, seed=b""):
+    """A valid PNG of about `size` bytes; different seeds give different files."""
+    pad = max(0, size - len(BASE_PNG) - 12)
+    block = hashlib.sha256(seed).digest()
+    data = (block * (pad // len(block) + 1))[:pad]
+    chunk_type = b"pdGn"
+    chunk = struct.pack(">I", len(data)) + chunk_type + data + \
+        struct.pack(">I", zlib.crc32(chunk_type + data) & 0xFFFFFFFF)
+    return BASE_PNG[:-12] + chunk + IEND
+
+
+class FakeGemini:
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, image_bytes=64 * 1024):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.image_bytes = image_bytes
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    def respond(self, body):
+        """(status, headers, payload bytes) for one generateContent call."""
+        with self._lock:
+            self.requests += 1
+
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+
+        if self.error_rate and random.random() < self.error_rate:
+            with self._lock:
+                self.errors += 1
+            status = random.choice((429, 503))
+            return status, {"Retry-After": "0"}, json.dumps({"error": {"code": status}}).encode()
+
+        image = base64.b64encode(padded_png(self.image_bytes, seed=body)).decode("ascii")
+        payload = json.dumps({
+            "candidates": [{"content": {"parts": [
+                {"inlineData": {"mimeType": "image/png", "data": image}}
+            ]}}]
+        }).encode()
+        return 200, {"Content-Type": "application/json"}, payload
+
+    # ---------------- SERVER ----------------
+
+    def start(self, host="127.0.0.1", port=0):
+        """Serve in a background thread. Returns the base URL (".../v1beta")."""
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"       # keep-alive, like the real endpoint
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                if not self.path.endswith(":generateContent"):
+                    status, headers, payload = 404, {}, b"{}"
+                else:
+                    status, headers, payload = fake.respond(body)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+
+            def handle_error(self, request, client_address):
+                # The app hanging up mid-response (e.g. stopped at the end of a run)
+                if not isinstance(sys.exc_info()[1], ConnectionError):
+                    super().handle_error(request, client_address)
+
+        self._server = Server((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, name="fake-gemini", daemon=True).start()
+        return f"http://{host}:{self._server.server_address[1]}/v1beta"
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds per call")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random seconds per call")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction answered with 429/503")
+    parser.add_argument("--image-kb", type=int, default=64, help="size of the returned PNG")
+    args = parser.parse_args()
+
+    fake = FakeGemini(args.latency, args.jitter, args.error_rate, args.image_kb * 1024)
+    url = fake.start(args.host, args.port)
+    print(f"Fake Gemini listening, set GEMINI_BASE_URL={url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
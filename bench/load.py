@@ -0,0 +1,456 @@
+# =============================================================================
+# Offline Load Test
+# =============================================================================
+# Drives the /api/* routes at fixed concurrency levels against a local fake
+# Gemini (bench/fake_gemini.py), so throughput can be measured without API
+# quota. Prints one JSON document: requests/sec, latency percentiles, status
+# codes and server RSS per (route, concurrency).
+#
+#   python bench/load.py                                   # everything, defaults
+#   python bench/load.py --routes login,prompt-to-image --concurrency 1,16,64 --duration 20
+#   python bench/load.py --latency 1.5 --error-rate 0.05 --image-kb 1500 --wait-jobs
+#   python bench/load.py --out run.json --baseline previous.json   # exit 1 on regression
+#
+# By default the app is started as a subprocess from a scratch copy of this
+# directory (fresh SQLite database, generated/ and uploads/ in a temp dir),
+# so RSS is the server's own and the working tree stays clean. --url targets
+# an already running server instead; pass its --pid to get RSS, and point
+# that server's GEMINI_BASE_URL at a fake started with fake_gemini.py.
+#
+# Generation endpoints answer 202 once the job is queued; that is what the
+# latency figures measure. --wait-jobs also polls every job to completion
+# and reports queue-to-done time under "jobs". Admission control is off in
+# the spawned server (it would turn most of the load into 429s); --admission
+# keeps it on.
+
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from fake_gemini import FakeGemini, padded_png  # noqa: E402
+
+BENCH_PASSWORD = "bench-password-1"
+# get-history goes last, so the generation routes have filled the history first
+ROUTE_NAMES = ("login", "prompt-to-image", "specs-tryon", "haircut-preview",
+               "insta-story", "social/generate", "get-history")
+JOB_STATES_DONE = ("done", "failed")
+
+
+# =============================================================================
+# ROUTES
+# =============================================================================
+# Each route is (method, path, build) where build(ctx, n) returns the
+# keyword arguments for requests.Session.request. Prompts and uploads differ
+# per request so the result cache and upload dedup don't turn the run into
+# a cache benchmark.
+
+def _unique(n):
+    return f"{n}-{uuid.uuid4().hex[:8]}"
+
+
+def _auth(ctx):
+    return {"Authorization": f"Bearer {ctx['token']}"}
+
+
+def _upload(ctx, n, name):
+    return (f"{name}.png", padded_png(ctx["upload_bytes"], seed=f"{name}-{_unique(n)}".encode()), "image/png")
+
+
+ROUTES = {
+    "login": ("POST", "/api/login", lambda ctx, n: {
+        "json": {"email": ctx["email"], "password": BENCH_PASSWORD}
+    }),
+    "get-history": ("GET", "/api/get-history", lambda ctx, n: {
+        "headers": _auth(ctx), "params": {"tool": "prompt-to-image", "limit": 20}
+    }),
+    "prompt-to-image": ("POST", "/api/prompt-to-image", lambda ctx, n: {
+        "headers": _auth(ctx), "json": {"prompt": f"a lighthouse at dusk {_unique(n)}", "imgstyle": "clean"}
+    }),
+    "specs-tryon": ("POST", "/api/specs-tryon", lambda ctx, n: {
+        "headers": _auth(ctx),
+        "files": {"face": _upload(ctx, n, "face"), "specs": _upload(ctx, n, "specs")},
+        "data": {"prompt": f"round frames {_unique(n)}"}
+    }),
+    "haircut-preview": ("POST", "/api/haircut-preview", lambda ctx, n: {
+        "headers": _auth(ctx),
+        "files": {"you": _upload(ctx, n, "you"), "sample": _upload(ctx, n, "sample")},
+        "data": {"prompt": f"short bob {_unique(n)}"}
+    }),
+    "insta-story": ("POST", "/api/insta-story", lambda ctx, n: {
+        "headers": _auth(ctx), "json": {"overlay_text": f"New drop {_unique(n)}"}
+    }),
+    "social/generate": ("POST", "/api/social/generate", lambda ctx, n: {
+        "headers": _auth(ctx), "json": {"prompt": f"coffee flat lay {_unique(n)}", "platform": "Instagram"}
+    }),
+}
+
+
+# =============================================================================
+# SERVER UNDER TEST
+# =============================================================================
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class LocalServer:
+    """The app from a scratch copy of BACKEND_DIR, in its own process."""
+
+    SERVE = ("import sys, app; "
+             "app.create_app({'AUTO_MIGRATE': True}).run("
+             "host='127.0.0.1', port=int(sys.argv[1]), threaded=True, use_reloader=False)")
+
+    def __init__(self, gemini_url, admission=False, env=None):
+        self.workdir = tempfile.mkdtemp(prefix="imageworks-bench-")
+        for name in os.listdir(BACKEND_DIR):
+            if name.endswith(".py"):
+                shutil.copy2(os.path.join(BACKEND_DIR, name), self.workdir)
+
+        self.port = _free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.env = dict(os.environ,
+                        GEMINI_BASE_URL=gemini_url,
+                        NANOBANANA_KEY="bench",
+                        UPSTREAM_STUB="0",
+                        PUBLIC_BASE_URL=self.url,
+                        ADMISSION_ENABLED="1" if admission else "0",
+                        PYTHONUNBUFFERED="1",
+                        **(env or {}))
+        self.process = None
+
+    def start(self, timeout=60):
+        self.log = open(os.path.join(self.workdir, "server.log"), "wb")
+        self.process = subprocess.Popen([sys.executable, "-c", self.SERVE, str(self.port)],
+                                        cwd=self.workdir, env=self.env,
+                                        stdout=self.log, stderr=subprocess.STDOUT)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Server exited during startup, see {self.log.name}")
+            try:
+                requests.get(f"{self.url}/api/cache/stats", timeout=1)
+                return self
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        raise RuntimeError(f"Server did not come up within {timeout}s, see {self.log.name}")
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def stop(self, keep=False):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.log.close()
+        if not keep:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+def read_rss(pid):
+    """{"rss_kb", "peak_kb"} of pid from /proc, or None where that isn't available."""
+    if not pid:
+        return None
+    values = {}
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                key, _, value = line.partition(":")
+                if key in ("VmRSS", "VmHWM"):
+                    values["rss_kb" if key == "VmRSS" else "peak_kb"] = int(value.split()[0])
+    except OSError:
+        return None
+    return values
+
+
+# =============================================================================
+# LOAD GENERATION
+# =============================================================================
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    if not latencies:
+        return {}
+    ms = lambda seconds: round(seconds * 1000, 2)   # noqa: E731
+    return {
+        "p50": ms(percentile(latencies, 50)),
+        "p95": ms(percentile(latencies, 95)),
+        "p99": ms(percentile(latencies, 99)),
+        "max": ms(latencies[-1]),
+        "mean": ms(sum(latencies) / len(latencies))
+    }
+
+
+def wait_for_jobs(base_url, ctx, accepted, timeout):
+    """Poll each (status_url, accepted_at) until done; returns completion stats."""
+    session = requests.Session()
+    pending = list(accepted)
+    durations, states = [], {}
+    deadline = time.monotonic() + timeout
+
+    while pending and time.monotonic() < deadline:
+        still_pending = []
+        for status_url, accepted_at in pending:
+            try:
+                job = session.get(base_url + status_url, headers=_auth(ctx), timeout=10).json()
+            except (requests.RequestException, ValueError):
+                still_pending.append((status_url, accepted_at))
+                continue
+            status = job.get("status")
+            if status in JOB_STATES_DONE:
+                durations.append(time.monotonic() - accepted_at)
+                states[status] = states.get(status, 0) + 1
+            else:
+                still_pending.append((status_url, accepted_at))
+        pending = still_pending
+        if pending:
+            time.sleep(0.05)
+
+    if pending:
+        states["timed_out"] = len(pending)
+    return {"states": states, "latency_ms": summarize(durations)}
+
+
+def run_level(base_url, route, concurrency, ctx, total_requests=None, duration=None,
+              wait_jobs=False, job_timeout=300, pid=None):
+    method, path, build = ROUTES[route]
+    counter = iter(range(10 ** 12))
+    lock = threading.Lock()
+    latencies, statuses, accepted = [], {}, []
+    errors = 0
+    deadline = time.monotonic() + duration if duration else None
+
+    def next_request():
+        with lock:
+            n = next(counter)
+        if total_requests is not None and n >= total_requests:
+            return None
+        if deadline is not None and time.monotonic() >= deadline:
+            return None
+        return n
+
+    def worker():
+        nonlocal errors
+        session = requests.Session()
+        while True:
+            n = next_request()
+            if n is None:
+                return
+            kwargs = build(ctx, n)
+            started = time.perf_counter()
+            try:
+                response = session.request(method, base_url + path, timeout=120, **kwargs)
+                status = response.status_code
+                body = response.content
+            except requests.RequestException:
+                status, body = "error", b""
+            elapsed = time.perf_counter() - started
+
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+                if status == "error" or status >= 400:
+                    errors += 1
+                elif status == 202 and wait_jobs:
+                    accepted.append((json.loads(body)["status_url"], time.monotonic()))
+
+    rss_before = read_rss(pid)
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+    rss_after = read_rss(pid)
+
+    result = {
+        "route": route,
+        "method": method,
+        "path": path,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "status": {str(k): v for k, v in sorted(statuses.items(), key=lambda item: str(item[0]))},
+        "seconds": round(wall, 3),
+        "rps": round(len(latencies) / wall, 2) if wall else None,
+        "latency_ms": summarize(latencies),
+        "rss_kb": {"before": rss_before, "after": rss_after}
+    }
+    if wait_jobs and accepted:
+        result["jobs"] = wait_for_jobs(base_url, ctx, accepted, job_timeout)
+    return result
+
+
+def sign_in(base_url):
+    """Register a fresh bench user; returns the route context (token, email, ...)."""
+    email = f"bench-{uuid.uuid4().hex[:12]}@example.com"
+    response = requests.post(f"{base_url}/api/register", timeout=30, json={
+        "username": email.split("@")[0], "email": email, "password": BENCH_PASSWORD
+    })
+    response.raise_for_status()
+    response = requests.post(f"{base_url}/api/login", timeout=30,
+                             json={"email": email, "password": BENCH_PASSWORD})
+    response.raise_for_status()
+    return {"email": email, "token": response.json()["token"]}
+
+
+# =============================================================================
+# REGRESSION CHECK
+# =============================================================================
+
+def compare(results, baseline, tolerance):
+    """Regressions of results against a previous run: rps down or p95 up by more than tolerance."""
+    previous = {(r["route"], r["concurrency"]): r for r in baseline.get("results", [])}
+    regressions = []
+    for result in results:
+        before = previous.get((result["route"], result["concurrency"]))
+        if not before:
+            continue
+        if before.get("rps") and result["rps"] is not None and result["rps"] < before["rps"] * (1 - tolerance):
+            regressions.append({"route": result["route"], "concurrency": result["concurrency"],
+                                "metric": "rps", "baseline": before["rps"], "current": result["rps"]})
+        old_p95 = before.get("latency_ms", {}).get("p95")
+        new_p95 = result.get("latency_ms", {}).get("p95")
+        if old_p95 and new_p95 is not None and new_p95 > old_p95 * (1 + tolerance):
+            regressions.append({"route": result["route"], "concurrency": result["concurrency"],
+                                "metric": "p95_ms", "baseline": old_p95, "current": new_p95})
+    return regressions
+
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR,
+                              capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+# =============================================================================
+# MAIN
+# =============================================================================
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test for the /api routes.")
+    parser.add_argument("--routes", default=",".join(ROUTE_NAMES),
+                        help=f"comma-separated, from: {', '.join(ROUTE_NAMES)}")
+    parser.add_argument("--concurrency", default="1,8,32", help="comma-separated levels")
+    parser.add_argument("--requests", type=int, default=200, help="requests per route and level")
+    parser.add_argument("--duration", type=float, help="seconds per route and level (instead of --requests)")
+    parser.add_argument("--wait-jobs", action="store_true", help="also time queued jobs to completion")
+    parser.add_argument("--job-timeout", type=float, default=300)
+    parser.add_argument("--upload-kb", type=int, default=256, help="size of each uploaded image")
+    parser.add_argument("--admission", action="store_true", help="keep admission control enabled")
+    # fake Gemini
+    parser.add_argument("--latency", type=float, default=0.5, help="fake Gemini seconds per call")
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--image-kb", type=int, default=512, help="size of the fake Gemini image")
+    # external server
+    parser.add_argument("--url", help="benchmark this running server instead of spawning one")
+    parser.add_argument("--pid", type=int, help="pid of the --url server, for RSS")
+    parser.add_argument("--keep-workdir", action="store_true", help="don't delete the scratch copy")
+    # output
+    parser.add_argument("--out", help="write the JSON here instead of stdout")
+    parser.add_argument("--baseline", help="previous JSON output to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression (fraction)")
+    args = parser.parse_args()
+
+    routes = [name.strip() for name in args.routes.split(",") if name.strip()]
+    unknown = [name for name in routes if name not in ROUTES]
+    if unknown:
+        parser.error(f"unknown route(s): {', '.join(unknown)}")
+    levels = [int(level) for level in args.concurrency.split(",")]
+
+    fake = FakeGemini(args.latency, args.jitter, args.error_rate, args.image_kb * 1024)
+    server = None
+    try:
+        if args.url:
+            base_url, pid = args.url.rstrip("/"), args.pid
+        else:
+            gemini_url = fake.start()
+            server = LocalServer(gemini_url, admission=args.admission).start()
+            base_url, pid = server.url, server.pid
+
+        ctx = dict(sign_in(base_url), upload_bytes=args.upload_kb * 1024)
+        rss_start = read_rss(pid)
+
+        results = []
+        for route in routes:
+            for level in levels:
+                result = run_level(base_url, route, level, ctx,
+                                   total_requests=None if args.duration else args.requests,
+                                   duration=args.duration, wait_jobs=args.wait_jobs,
+                                   job_timeout=args.job_timeout, pid=pid)
+                results.append(result)
+                print(f"{route:>16} c={level:<4} {result['rps'] or 0:>9.1f} req/s  "
+                      f"p95 {result['latency_ms'].get('p95')} ms  errors {result['errors']}",
+                      file=sys.stderr)
+
+        report = {
+            "meta": {
+                "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "revision": _git_revision(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "server": "external" if args.url else "spawned",
+                "fake_gemini": {"latency": args.latency, "jitter": args.jitter,
+                                "error_rate": args.error_rate, "image_kb": args.image_kb,
+                                "calls": fake.requests, "errors_injected": fake.errors},
+                "upload_kb": args.upload_kb,
+                "admission": args.admission,
+                "rss_kb": {"start": rss_start, "end": read_rss(pid)}
+            },
+            "results": results
+        }
+    finally:
+        if server is not None:
+            server.stop(keep=args.keep_workdir)
+        fake.stop()
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        report["regressions"] = regressions
+        exit_code = 1 if regressions else 0
+
+    output = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,184 @@
+# =============================================================================
+# Microbenchmarks of Hot-Path Internals
+# =============================================================================
+# Per-operation cost of the pieces every request goes through, without a
+# server: inline image decoding, the LRU cache, metric recording, admission
+# buckets and prompt normalization. Prints JSON with ops/sec and us/op.
+#
+#   python bench/micro.py
+#   python bench/micro.py --only lru,admission --seconds 2
+#   python bench/micro.py --out micro.json --baseline previous.json   # exit 1 on regression
+
+import os
+import sys
+import json
+import time
+import base64
+import argparse
+import platform
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, BACKEND_DIR)
+
+import metrics  # noqa: E402
+import inline_image  # noqa: E402
+from lru import LRUCache  # noqa: E402
+from admission import MemoryBuckets, SQLiteBuckets  # noqa: E402
+from prompt_enhancer import normalize_prompt  # noqa: E402
+from fake_gemini import padded_png  # noqa: E402
+
+
+def measure(fn, seconds):
+    """Run fn() repeatedly for about `seconds`; returns (calls, elapsed)."""
+    fn()    # warm up
+    calls, started = 0, time.perf_counter()
+    batch = 1
+    while True:
+        for _ in range(batch):
+            fn()
+        calls += batch
+        elapsed = time.perf_counter() - started
+        if elapsed >= seconds:
+            return calls, elapsed
+        batch = min(batch * 2, 10000)
+
+
+# =============================================================================
+# BENCHMARKS
+# =============================================================================
+# name -> setup(workdir) returning (fn, bytes handled per call or None)
+
+def bench_inline_image(workdir, image_kb=1024):
+    image = base64.b64encode(padded_png(image_kb * 1024, seed=b"micro")).decode("ascii")
+    body = json.dumps({"candidates": [{"content": {"parts": [
+        {"inlineData": {"mimeType": "image/png", "data": image}}
+    ]}}]}).encode()
+    chunks = [body[i:i + inline_image.CHUNK_SIZE] for i in range(0, len(body), inline_image.CHUNK_SIZE)]
+    return (lambda: inline_image.save_inline_image(chunks, workdir)), len(body)
+
+
+def bench_lru_hit(workdir):
+    cache = LRUCache(maxsize=10000, ttl=3600)
+    for i in range(10000):
+        cache.set(i, i)
+    keys = iter(range(10 ** 12))
+    return (lambda: cache.get(next(keys) % 10000)), None
+
+
+def bench_lru_set(workdir):
+    cache = LRUCache(maxsize=10000, ttl=3600)
+    keys = iter(range(10 ** 12))
+    return (lambda: cache.set(next(keys), 1)), None
+
+
+def bench_metrics_counter(workdir):
+    counter = metrics.Counter("bench_total", "bench", ["route", "status"])
+    return (lambda: counter.inc("/api/prompt-to-image", 202)), None
+
+
+def bench_metrics_histogram(workdir):
+    histogram = metrics.Histogram("bench_seconds", "bench", ["route"])
+    return (lambda: histogram.observe(0.042, "/api/prompt-to-image")), None
+
+
+def bench_admission_memory(workdir):
+    buckets = MemoryBuckets()
+    keys = iter(range(10 ** 12))
+    return (lambda: buckets.take(f"{next(keys) % 1000}:prompt-to-image", 1000.0, 1000)), None
+
+
+def bench_admission_sqlite(workdir):
+    buckets = SQLiteBuckets(os.path.join(workdir, "admission.db"))
+    keys = iter(range(10 ** 12))
+    return (lambda: buckets.take(f"{next(keys) % 1000}:prompt-to-image", 1000.0, 1000)), None
+
+
+def bench_normalize_prompt(workdir):
+    prompt = "  A   Lighthouse at DUSK,\n  dramatic clouds,   golden hour  "
+    return (lambda: normalize_prompt(prompt)), None
+
+
+BENCHMARKS = {
+    "inline_image": bench_inline_image,
+    "lru_hit": bench_lru_hit,
+    "lru_set": bench_lru_set,
+    "metrics_counter": bench_metrics_counter,
+    "metrics_histogram": bench_metrics_histogram,
+    "admission_memory": bench_admission_memory,
+    "admission_sqlite": bench_admission_sqlite,
+    "normalize_prompt": bench_normalize_prompt,
+}
+
+
+def compare(results, baseline, tolerance):
+    previous = {r["name"]: r for r in baseline.get("results", [])}
+    regressions = []
+    for result in results:
+        before = previous.get(result["name"])
+        if before and result["ops_per_sec"] < before["ops_per_sec"] * (1 - tolerance):
+            regressions.append({"name": result["name"], "metric": "ops_per_sec",
+                                "baseline": before["ops_per_sec"], "current": result["ops_per_sec"]})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks of hot-path internals.")
+    parser.add_argument("--only", help=f"comma-separated, from: {', '.join(BENCHMARKS)}")
+    parser.add_argument("--seconds", type=float, default=1.0, help="time per benchmark")
+    parser.add_argument("--out", help="write the JSON here instead of stdout")
+    parser.add_argument("--baseline", help="previous JSON output to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression (fraction)")
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.only.split(",")] if args.only else list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(unknown)}")
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="imageworks-micro-") as workdir:
+        for name in names:
+            fn, nbytes = BENCHMARKS[name](workdir)
+            calls, elapsed = measure(fn, args.seconds)
+            result = {
+                "name": name,
+                "ops": calls,
+                "seconds": round(elapsed, 3),
+                "ops_per_sec": round(calls / elapsed, 1),
+                "us_per_op": round(elapsed / calls * 1e6, 3)
+            }
+            if nbytes:
+                result["mb_per_sec"] = round(nbytes * calls / elapsed / 1024 ** 2, 1)
+            results.append(result)
+            print(f"{name:>18} {result['us_per_op']:>12.3f} us/op", file=sys.stderr)
+
+    report = {
+        "meta": {
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "seconds_per_benchmark": args.seconds
+        },
+        "results": results
+    }
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["regressions"] = compare(results, json.load(f), args.tolerance)
+        exit_code = 1 if report["regressions"] else 0
+
+    output = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,108 @@
+# =============================================================================
+# SQLite Setup for Multi-Threaded Serving
+# =============================================================================
+# With default settings, readers of /api/get-history block behind history
+# inserts and busy threads hit "database is locked". init_db() sets up:
+#
+#   - WAL journaling: readers never wait for the writer
+#   - synchronous=NORMAL (safe with WAL, one fsync per checkpoint, not per commit)
+#   - busy_timeout, so a writer in another process is waited for, not an error
+#   - larger page cache and mmap for reads
+#   - a real connection pool shared across threads
+#   - one serialized writer per process: the first write of a session
+#     transaction takes write_lock, the end of the transaction releases it.
+#     Threads queue on a Python lock instead of spinning on SQLITE_BUSY.
+
+import os
+import logging
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+log = logging.getLogger(__name__)
+
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", 5000))
+SQLITE_CACHE_SIZE_KB = int(os.environ.get("SQLITE_CACHE_SIZE_KB", 20000))
+SQLITE_MMAP_SIZE_MB = int(os.environ.get("SQLITE_MMAP_SIZE_MB", 256))
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 10))
+DB_POOL_OVERFLOW = int(os.environ.get("DB_POOL_OVERFLOW", 10))
+
+write_lock = threading.RLock()
+
+_WRITE_LOCK_KEY = "holds_write_lock"
+
+
+class WriteLockTimeout(Exception):
+    pass
+
+
+def engine_options():
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_POOL_OVERFLOW,
+        "pool_timeout": 30,
+        "connect_args": {
+            # Connections are pooled across threads (never used by two at once)
+            "check_same_thread": False,
+            "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000
+        }
+    }
+
+
+def init_db(app, db):
+    """Use instead of db.init_app(app)."""
+    options = app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", {})
+    for key, value in engine_options().items():
+        options.setdefault(key, value)
+
+    db.init_app(app)
+
+    with app.app_context():
+        if db.engine.dialect.name == "sqlite":
+            event.listen(db.engine, "connect", _set_sqlite_pragmas)
+            db.engine.dispose()     # drop any connection made before the listener
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE_MB * 1024 * 1024}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+# =============================================================================
+# SERIALIZED WRITER
+# =============================================================================
+
+def _acquire_write_lock(session):
+    if session.info.get(_WRITE_LOCK_KEY):
+        return
+    if not write_lock.acquire(timeout=SQLITE_BUSY_TIMEOUT_MS / 1000):
+        raise WriteLockTimeout("Timed out waiting for the database writer")
+    session.info[_WRITE_LOCK_KEY] = True
+
+
+@event.listens_for(Session, "before_flush")
+def _lock_before_flush(session, flush_context, instances):
+    if session.new or session.dirty or session.deleted:
+        _acquire_write_lock(session)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _lock_bulk_writes(orm_execute_state):
+    # Query.update() / delete() and insert() statements skip the flush
+    if orm_execute_state.is_update or orm_execute_state.is_delete or orm_execute_state.is_insert:
+        _acquire_write_lock(orm_execute_state.session)
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _unlock_after_transaction(session, transaction):
+    # Fires for commit, rollback and close; only the outermost transaction counts
+    if transaction.parent is None and session.info.pop(_WRITE_LOCK_KEY, False):
+        write_lock.release()
@@ -0,0 +1,367 @@
+# =============================================================================
+# Generation Progress Events (Server-Sent Events)
+# =============================================================================
+# /api/events streams lifecycle events for the signed-in user's generations,
+# so the frontend doesn't have to poll /api/jobs/<id>:
+#
+#   queued -> running -> upstream-started -> decoding -> done | failed,
+#   plus thumbnail-ready once the output's thumbnails exist
+#
+# Each user has a channel holding the last EVENTS_BACKLOG events with
+# increasing ids. A client that reconnects with Last-Event-ID gets what it
+# missed. If its id has already dropped out of the backlog, it gets a
+# "reset" event and should re-read its jobs.
+#
+# Where events are kept is EVENTS_BACKEND:
+#
+#   memory   the default: one process. Events published by another worker
+#            (a job it ran) never reach streams served by this one.
+#   sqlite   events are appended to a small SQLite file (EVENTS_DB) shared
+#            by the workers on a host. One thread per process tails it every
+#            EVENTS_POLL_INTERVAL seconds and fans new events out to the
+#            local streams, so a stream sees every worker's jobs, and ids are
+#            global: Last-Event-ID resumes on whichever worker the reconnect
+#            lands on. Rows older than EVENTS_RETENTION seconds are trimmed.
+#
+# Open streams are served by events_server.py: one asyncio thread per
+# process holds every idle connection, so a subscriber costs a socket and a
+# few KB, not a request thread. /api/events authenticates and redirects
+# there. Without it (EVENTS_SERVER_ENABLED=0, or its port can't be bound)
+# stream() is served from the request thread instead, which then stays
+# busy for as long as the stream is open. Either way, streams are closed
+# after EVENTS_MAX_STREAM seconds; EventSource reconnects and resumes from
+# Last-Event-ID.
+#
+# Code running a job publishes without passing ids around: jobs.py opens a
+# job_scope(), and emit("decoding") anywhere below it reaches that job's
+# user.
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+EVENTS_BACKEND = os.environ.get("EVENTS_BACKEND", "memory")     # memory | sqlite
+EVENTS_DB = os.environ.get("EVENTS_DB", "")                     # default: instance/events.db
+EVENTS_BACKLOG = int(os.environ.get("EVENTS_BACKLOG", 100))
+EVENTS_HEARTBEAT = float(os.environ.get("EVENTS_HEARTBEAT", 15))
+EVENTS_MAX_STREAM = float(os.environ.get("EVENTS_MAX_STREAM", 300))
+EVENTS_IDLE_CHANNEL_TTL = float(os.environ.get("EVENTS_IDLE_CHANNEL_TTL", 600))
+EVENTS_POLL_INTERVAL = float(os.environ.get("EVENTS_POLL_INTERVAL", 0.25))
+EVENTS_RETENTION = float(os.environ.get("EVENTS_RETENTION", 3600))
+EVENTS_RETRY_MS = 3000
+
+POLL_BATCH = 1000
+
+# (user_id, job_id, tool_name) of the job the current code runs for
+_scope = contextvars.ContextVar("event_scope", default=None)
+
+
+class _Channel:
+    def __init__(self, events=(), floor=0):
+        self.events = deque(events, maxlen=EVENTS_BACKLOG)     # (id, event, data)
+        self.floor = floor      # the user's events up to this id aren't in the backlog
+        self.cond = threading.Condition()
+        self.subscribers = 0
+        self.touched = time.monotonic()
+
+    def append(self, event_id, event, data):
+        with self.cond:
+            if len(self.events) == self.events.maxlen:
+                self.floor = self.events[0][0]
+            self.events.append((event_id, event, data))
+            self.touched = time.monotonic()
+            self.cond.notify_all()
+
+    def since(self, seen):
+        """Backlog events newer than seen."""
+        with self.cond:
+            return [e for e in self.events if e[0] > seen]
+
+
+# =============================================================================
+# SHARED LOG
+# =============================================================================
+
+class SQLiteLog:
+    """Events shared by every process using the same file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._connect()
+        # AUTOINCREMENT: ids are never reused after a trim, so an old
+        # Last-Event-ID can't point into someone else's events
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS events ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL,"
+            " event TEXT NOT NULL, data TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_events_user ON events (user_id, id)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def append(self, user_id, event, data):
+        cursor = self._connect().execute(
+            "INSERT INTO events (user_id, event, data, created) VALUES (?, ?, ?, ?)",
+            (user_id, event, json.dumps(data), time.time())
+        )
+        return cursor.lastrowid
+
+    def since(self, after_id, limit=POLL_BATCH):
+        rows = self._connect().execute(
+            "SELECT id, user_id, event, data FROM events WHERE id > ? ORDER BY id LIMIT ?", (after_id, limit)
+        )
+        return [(event_id, user_id, event, json.loads(data)) for event_id, user_id, event, data in rows]
+
+    def recent(self, user_id, up_to, limit):
+        """The user's last limit events with ids up to up_to, oldest first."""
+        rows = self._connect().execute(
+            "SELECT id, event, data FROM events WHERE user_id = ? AND id <= ? ORDER BY id DESC LIMIT ?",
+            (user_id, up_to, limit)
+        ).fetchall()
+        return [(event_id, event, json.loads(data)) for event_id, event, data in reversed(rows)]
+
+    def last_id(self):
+        return self._connect().execute("SELECT coalesce(max(id), 0) FROM events").fetchone()[0]
+
+    def trim(self, retention):
+        self._connect().execute("DELETE FROM events WHERE created < ?", (time.time() - retention,))
+
+
+# =============================================================================
+# BROKER
+# =============================================================================
+
+class EventBroker:
+    def __init__(self, backend=EVENTS_BACKEND, poll_interval=EVENTS_POLL_INTERVAL):
+        self.backend = backend
+        self.poll_interval = poll_interval
+        self.log = None             # SQLiteLog once init_app has run with the sqlite backend
+        self._channels = {}
+        self._lock = threading.Lock()
+        self._last_id = 0           # memory: last id handed out; sqlite: last id read from the log
+        self._poll_lock = threading.Lock()
+        self._thread = None
+        self._listeners = []        # fn(user_id), called after each event reaches a channel
+
+    def init_app(self, app, background=True):
+        if self.backend == "sqlite" and self.log is None:
+            path = EVENTS_DB or os.path.join(app.instance_path, "events.db")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.log = SQLiteLog(path)
+            self._last_id = self.log.last_id()
+        if self.log is not None and background and self._thread is None:
+            self._thread = threading.Thread(target=self._poll_loop, name="events-poll", daemon=True)
+            self._thread.start()
+
+    def _channel(self, user_id):
+        with self._lock:
+            channel = self._channels.get(user_id)
+        if channel is not None:
+            return channel
+        if self.log is None:
+            with self._lock:
+                return self._new_channel(user_id, (), self._last_id)
+
+        # Backlog from the log, up to where the poller will carry on from
+        with self._poll_lock:
+            with self._lock:
+                channel = self._channels.get(user_id)
+            if channel is not None:
+                return channel
+            backlog = self.log.recent(user_id, self._last_id, EVENTS_BACKLOG)
+            floor = backlog[0][0] - 1 if backlog else self._last_id
+            with self._lock:
+                return self._new_channel(user_id, backlog, floor)
+
+    def _new_channel(self, user_id, backlog, floor):
+        """Called with _lock held."""
+        channel = self._channels.get(user_id)
+        if channel is None:
+            channel = self._channels[user_id] = _Channel(backlog, floor)
+            self._prune()
+        return channel
+
+    def _prune(self):
+        """Drop channels nobody listens to and nothing was published on for a while."""
+        cutoff = time.monotonic() - EVENTS_IDLE_CHANNEL_TTL
+        for user_id, channel in list(self._channels.items()):
+            if channel.subscribers == 0 and channel.touched < cutoff:
+                del self._channels[user_id]
+
+    # ---------------- PUBLISH ----------------
+
+    def publish(self, user_id, event, data):
+        """The event's id, or None if the shared log couldn't take it."""
+        if self.log is not None:
+            try:
+                event_id = self.log.append(user_id, event, data)
+                self._poll()        # local streams needn't wait for the poller
+            except sqlite3.Error:
+                log.warning("Could not publish %s event for user %s", event, user_id, exc_info=True)
+                return None
+            return event_id
+
+        with self._lock:
+            self._last_id += 1
+            event_id = self._last_id
+            channel = self._new_channel(user_id, (), event_id - 1)
+            channel.append(event_id, event, data)
+        self._notify(user_id)
+        return event_id
+
+    def _poll(self):
+        """Hand the log's new events to the channels of this process."""
+        with self._poll_lock:
+            while True:
+                rows = self.log.since(self._last_id)
+                for event_id, user_id, event, data in rows:
+                    self._last_id = event_id
+                    with self._lock:
+                        channel = self._channels.get(user_id)
+                    if channel is not None:
+                        channel.append(event_id, event, data)
+                        self._notify(user_id)
+                if len(rows) < POLL_BATCH:
+                    return
+
+    def _poll_loop(self):
+        trimmed = 0
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self._poll()
+                if time.monotonic() - trimmed > 60:
+                    self.log.trim(EVENTS_RETENTION)
+                    trimmed = time.monotonic()
+            except sqlite3.Error:
+                log.warning("Event log poll failed", exc_info=True)
+
+    def add_listener(self, listener):
+        """listener(user_id) is called, from the publishing thread, after each event for user_id."""
+        self._listeners.append(listener)
+
+    def _notify(self, user_id):
+        for listener in self._listeners:
+            listener(user_id)
+
+    # ---------------- SUBSCRIBE ----------------
+
+    def subscribe(self, user_id, last_event_id=None):
+        """
+        (channel, seen, missed) for a new subscriber; unsubscribe(channel)
+        when it's gone. Events after seen are owed to it; missed means its
+        last_event_id was older than the backlog and it should get a reset.
+        """
+        if self.log is not None:
+            try:
+                self._poll()        # an id from another worker may be ahead of the poller
+            except sqlite3.Error:
+                log.warning("Event log poll failed", exc_info=True)
+        channel = self._channel(user_id)
+
+        missed = False
+        with channel.cond:
+            channel.subscribers += 1
+            latest = self._last_id
+            seen = latest if last_event_id is None else last_event_id
+            if not channel.floor <= seen <= latest:
+                # Older than the backlog, or from before a restart
+                seen, missed = latest, True
+        return channel, seen, missed
+
+    @staticmethod
+    def unsubscribe(channel):
+        with channel.cond:
+            channel.subscribers -= 1
+            channel.touched = time.monotonic()
+
+    def stream(self, user_id, last_event_id=None, heartbeat=EVENTS_HEARTBEAT, max_duration=EVENTS_MAX_STREAM):
+        """
+        Generator of SSE-formatted strings for user_id: missed events after
+        last_event_id, then new ones as they come, with comment heartbeats.
+        Used from a request thread when events_server.py isn't running.
+        """
+        channel, seen, missed = self.subscribe(user_id, last_event_id)
+        deadline = time.monotonic() + max_duration
+
+        try:
+            yield f"retry: {EVENTS_RETRY_MS}\n\n"
+            if missed:
+                yield format_event(seen, "reset", {"reason": "backlog"})
+
+            while True:
+                with channel.cond:
+                    pending = [e for e in channel.events if e[0] > seen]
+                    if not pending:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            return
+                        channel.cond.wait(min(heartbeat, remaining))
+                        pending = [e for e in channel.events if e[0] > seen]
+
+                if not pending:
+                    yield ": keep-alive\n\n"
+                    continue
+
+                for event_id, event, data in pending:
+                    seen = event_id
+                    yield format_event(event_id, event, data)
+        finally:
+            self.unsubscribe(channel)
+
+
+def format_event(event_id, event, data):
+    return f"id: {event_id}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+# Shared instance used by the app
+broker = EventBroker()
+
+
+# =============================================================================
+# JOB SCOPE
+# =============================================================================
+
+@contextmanager
+def job_scope(user_id, job_id, tool_name):
+    """Events emitted inside the block are published for this job."""
+    token = _scope.set((user_id, job_id, tool_name))
+    try:
+        yield
+    finally:
+        _scope.reset(token)
+
+
+def publish_job(user_id, job_id, tool_name, event, **data):
+    return broker.publish(user_id, event, dict(data, job_id=job_id, tool=tool_name))
+
+
+def emit(event, **data):
+    """Publish event for the job in scope; a no-op outside of a job."""
+    scope = _scope.get()
+    if scope is not None:
+        publish_job(*scope, event, **data)
+
+
+def bind(event):
+    """Callback that emits event (with the callback's kwargs) for the job in scope now."""
+    scope = _scope.get()
+    if scope is None:
+        return None
+    return lambda **data: publish_job(*scope, event, **data)
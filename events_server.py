@@ -0,0 +1,272 @@
+# =============================================================================
+# Event Stream Server (asyncio)
+# =============================================================================
+# A WSGI request thread can't let go of a connection it's streaming, so
+# serving /api/events from Flask costs a thread per open browser tab. This
+# serves the same SSE streams from one asyncio thread per process instead:
+# an idle subscriber is a socket, a coroutine waiting for it to close and
+# a few KB of state, so a worker can hold thousands.
+#
+#   GET /api/events on the app     authenticates and answers 307 to
+#                                  EVENTS_PUBLIC_URL/api/events?token=...
+#   GET /api/events on this port   the stream itself (same token, same
+#                                  Last-Event-ID semantics, CORS open)
+#
+# Delivery is push, not polling: the broker calls back after every event
+# (events.EventBroker.add_listener), and the loop writes the user's new
+# events to each of their connections. A client whose socket buffer backs
+# up past EVENTS_MAX_BUFFER is dropped; EventSource reconnects and resumes.
+#
+# The server starts on the first /api/events request, so CLI commands and
+# the reloader's parent process never bind the port. Every worker binds
+# the same port (SO_REUSEPORT); with several workers use
+# EVENTS_BACKEND=sqlite so each one sees every job's events.
+
+import os
+import json
+import socket
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+
+from events import EVENTS_HEARTBEAT, EVENTS_MAX_STREAM, EVENTS_RETRY_MS, format_event
+
+log = logging.getLogger(__name__)
+
+EVENTS_SERVER_ENABLED = os.environ.get("EVENTS_SERVER_ENABLED", "1") == "1"
+EVENTS_SERVER_HOST = os.environ.get("EVENTS_SERVER_HOST", "0.0.0.0")
+EVENTS_SERVER_PORT = int(os.environ.get("EVENTS_SERVER_PORT", 5001))
+EVENTS_PUBLIC_URL = os.environ.get("EVENTS_PUBLIC_URL", "")      # default: the app's host on EVENTS_SERVER_PORT
+EVENTS_MAX_BUFFER = int(os.environ.get("EVENTS_MAX_BUFFER", 256 * 1024))
+
+MAX_REQUEST_HEAD = 16 * 1024
+REQUEST_TIMEOUT = 10
+AUTH_WORKERS = 4         # token checks and subscribe() run here, off the loop
+
+CORS_HEADERS = (
+    "Access-Control-Allow-Origin: *\r\n"
+    "Access-Control-Allow-Headers: Authorization, Last-Event-ID, Cache-Control\r\n"
+    "Access-Control-Allow-Methods: GET, OPTIONS\r\n"
+)
+
+
+class _Subscriber:
+    def __init__(self, writer, channel, seen):
+        self.writer = writer
+        self.channel = channel
+        self.seen = seen
+
+
+class EventServer:
+    def __init__(self, broker, authenticate, host=EVENTS_SERVER_HOST, port=EVENTS_SERVER_PORT,
+                 heartbeat=EVENTS_HEARTBEAT, max_duration=EVENTS_MAX_STREAM):
+        """authenticate(token) -> user id or None; it runs on a worker thread in an app context."""
+        self.app = None
+        self.broker = broker
+        self.authenticate = authenticate
+        self.host = host
+        self.port = port
+        self.heartbeat = heartbeat
+        self.max_duration = max_duration
+        self.loop = None
+        self.running = False
+        self._subscribers = {}          # user_id -> set of _Subscriber, only touched on the loop
+        self._lock = threading.Lock()
+        self._started = False
+
+    # ---------------- LIFECYCLE ----------------
+
+    def init_app(self, app):
+        if self.app is None:
+            self.app = app
+
+    def ensure_started(self):
+        """Start the server thread once; True if it's listening."""
+        with self._lock:
+            if not self._started:
+                self._started = True
+                ready = threading.Event()
+                threading.Thread(target=self._run, args=(ready,), name="events-server", daemon=True).start()
+                ready.wait(5)
+        return self.running
+
+    def _run(self, ready):
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(ThreadPoolExecutor(max_workers=AUTH_WORKERS, thread_name_prefix="events-auth"))
+        try:
+            server = self.loop.run_until_complete(asyncio.start_server(
+                self._handle, self.host, self.port, limit=MAX_REQUEST_HEAD,
+                reuse_port=hasattr(socket, "SO_REUSEPORT")
+            ))
+        except OSError as e:
+            log.warning("Event stream server not started on %s:%s (%s); streaming from request threads",
+                        self.host, self.port, e)
+            ready.set()
+            return
+
+        self.port = server.sockets[0].getsockname()[1]
+        self.broker.add_listener(self._wake)
+        self.running = True
+        ready.set()
+        log.info("Event stream server listening on %s:%s", self.host, self.port)
+        self.loop.create_task(self._heartbeat_loop())
+        self.loop.run_forever()
+
+    def _authenticate(self, token):
+        with self.app.app_context():
+            return self.authenticate(token)
+
+    def subscriber_count(self):
+        return sum(len(subscribers) for subscribers in list(self._subscribers.values()))
+
+    # ---------------- FAN-OUT ----------------
+
+    def _wake(self, user_id):
+        # Called on the publishing thread
+        if user_id in self._subscribers:
+            self.loop.call_soon_threadsafe(self._deliver, user_id)
+
+    def _deliver(self, user_id):
+        for subscriber in list(self._subscribers.get(user_id, ())):
+            self._send_pending(subscriber)
+
+    def _send_pending(self, subscriber):
+        for event_id, event, data in subscriber.channel.since(subscriber.seen):
+            subscriber.seen = event_id
+            self._write(subscriber, format_event(event_id, event, data))
+
+    def _write(self, subscriber, text):
+        transport = subscriber.writer.transport
+        if transport.is_closing():
+            return
+        if transport.get_write_buffer_size() > EVENTS_MAX_BUFFER:
+            log.info("Dropping event stream that stopped reading")
+            transport.abort()
+            return
+        subscriber.writer.write(text.encode())
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            for subscribers in list(self._subscribers.values()):
+                for subscriber in list(subscribers):
+                    self._write(subscriber, ": keep-alive\n\n")
+
+    # ---------------- CONNECTIONS ----------------
+
+    async def _handle(self, reader, writer):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), REQUEST_TIMEOUT)
+            method, url, headers = _parse_head(head)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            writer.close()
+            return
+
+        try:
+            if method == "OPTIONS":
+                await _respond(writer, "204 No Content", "")
+                return
+            if method != "GET" or url.path != "/api/events":
+                await _respond(writer, "404 Not Found", {"success": False, "error": "Not found"})
+                return
+
+            query = parse_qs(url.query)
+            token = _bearer(headers.get("authorization")) or query.get("token", [None])[0]
+            last_event_id = headers.get("last-event-id") or query.get("last_event_id", [None])[0]
+            try:
+                last_event_id = int(last_event_id) if last_event_id else None
+            except ValueError:
+                last_event_id = None
+
+            user_id = await self.loop.run_in_executor(None, self._authenticate, token) if token else None
+            if user_id is None:
+                await _respond(writer, "401 Unauthorized", {"error": "Token is invalid or expired"})
+                return
+
+            # subscribe() may read the shared log, so keep it off the loop
+            channel, seen, missed = await self.loop.run_in_executor(
+                None, self.broker.subscribe, user_id, last_event_id)
+            try:
+                await self._stream(reader, writer, user_id, channel, seen, missed)
+            finally:
+                self.broker.unsubscribe(channel)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            writer.close()
+
+    async def _stream(self, reader, writer, user_id, channel, seen, missed):
+        writer.write((
+            "HTTP/1.1 200 OK\r\n"
+            "Content-Type: text/event-stream\r\n"
+            "Cache-Control: no-cache\r\n"
+            "X-Accel-Buffering: no\r\n"
+            "Connection: close\r\n"
+            f"{CORS_HEADERS}\r\n"
+            f"retry: {EVENTS_RETRY_MS}\n\n"
+        ).encode())
+        if missed:
+            writer.write(format_event(seen, "reset", {"reason": "backlog"}).encode())
+
+        subscriber = _Subscriber(writer, channel, seen)
+        self._subscribers.setdefault(user_id, set()).add(subscriber)
+        try:
+            self._send_pending(subscriber)      # what arrived while subscribing
+            # Nothing more comes from the client; wait for it to go away
+            await asyncio.wait_for(_until_closed(reader), self.max_duration)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            subscribers = self._subscribers.get(user_id)
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self._subscribers[user_id]
+
+    # ---------------- REDIRECT ----------------
+
+    def public_url(self, request):
+        """Where /api/events on the app sends clients."""
+        if EVENTS_PUBLIC_URL:
+            return EVENTS_PUBLIC_URL.rstrip("/")
+        host = urlsplit(f"//{request.host}").hostname
+        if ":" in host:
+            host = f"[{host}]"
+        return f"{request.scheme}://{host}:{self.port}"
+
+
+async def _until_closed(reader):
+    while await reader.read(1024):
+        pass
+
+
+async def _respond(writer, status, body):
+    body = body if isinstance(body, str) else json.dumps(body)
+    writer.write((
+        f"HTTP/1.1 {status}\r\n"
+        "Content-Type: application/json\r\n"
+        f"Content-Length: {len(body.encode())}\r\n"
+        "Connection: close\r\n"
+        "Access-Control-Max-Age: 86400\r\n"
+        f"{CORS_HEADERS}\r\n"
+        f"{body}"
+    ).encode())
+    await writer.drain()
+
+
+def _parse_head(head):
+    lines = head.decode("latin-1").split("\r\n")
+    method, target, _ = lines[0].split(" ", 2)
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+    return method, urlsplit(target), headers
+
+
+def _bearer(header):
+    if header and header.startswith("Bearer "):
+        return header.split(" ", 1)[1]
+    return None
@@ -0,0 +1,46 @@
+# =============================================================================
+# Bounded Concurrent Fan-Out
+# =============================================================================
+# Runs one function over many items on a small thread pool, each call inside
+# its own app context (so it can use db.session), and hands results back as
+# they finish. Used by the batch / storyboard endpoints, where wall-clock
+# time should follow the slowest item rather than the sum of all of them.
+# The global upstream in-flight cap (upstream.py) still applies on top.
+
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+def fan_out(app, fn, items, concurrency):
+    """
+    Call fn(item) for every item, at most `concurrency` at a time.
+    Yields (index, result, error) in completion order; error is the
+    exception raised by fn, or None. Closing the generator early cancels
+    the items that haven't started yet.
+    """
+    items = list(items)
+    if not items:
+        return
+
+    # Each item runs in a copy of the caller's context, so contextvars such
+    # as the progress event scope (events.py) carry over to the workers.
+    # The app context is pushed inside that copy: Flask keeps it in a
+    # contextvar too, and each worker needs its own (and its own db.session).
+    context = contextvars.copy_context()
+
+    def run(item):
+        with app.app_context():
+            return fn(item)
+
+    def call(item):
+        return context.copy().run(run, item)
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(items))),
+                                  thread_name_prefix="fan-out")
+    try:
+        futures = {executor.submit(call, item): index for index, item in enumerate(items)}
+        for future in as_completed(futures):
+            error = future.exception()
+            yield futures[future], (None if error else future.result()), error
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,283 @@
+# =============================================================================
+# Write-Behind History Recorder
+# =============================================================================
+# Every tool used to add a History row and commit it on its own, which is
+# one fsync-bound transaction per generation. Now tools hand their rows to
+# history_recorder.record(...) and return straight away. A background thread writes
+# the buffered rows in one multi-row INSERT per batch:
+#
+#   - when HISTORY_BATCH_SIZE rows are waiting, or
+#   - every HISTORY_FLUSH_INTERVAL seconds, whichever comes first
+#
+# Crash safety: each record is also appended to a spool file
+# (instance/history-spool/history-<pid>-<seq>.jsonl) before record()
+# returns. A segment is deleted once its batch is committed; segments left
+# by a process that died are inserted on the next start. A crash between the
+# commit and the delete can replay that batch once (at-least-once).
+#
+# HISTORY_SYNC=1 (or HistoryRecorder(sync=True)) inserts + commits inside
+# record() instead, for tests and scripts that read history right after.
+
+import os
+import re
+import json
+import atexit
+import logging
+import threading
+from datetime import datetime
+
+from sqlalchemy.exc import IntegrityError
+
+from models import db, History
+from asset_index import link_history_assets
+
+log = logging.getLogger(__name__)
+
+HISTORY_BATCH_SIZE = int(os.environ.get("HISTORY_BATCH_SIZE", 200))
+HISTORY_FLUSH_INTERVAL = float(os.environ.get("HISTORY_FLUSH_INTERVAL", 0.5))
+HISTORY_SYNC = os.environ.get("HISTORY_SYNC", "0") == "1"
+HISTORY_SPOOL_FSYNC = os.environ.get("HISTORY_SPOOL_FSYNC", "0") == "1"
+HISTORY_SPOOL_DIR = os.environ.get("HISTORY_SPOOL_DIR")
+
+COLUMNS = ("tool_name", "input_text", "input_image", "output_text", "output_image", "created_at", "user_id")
+REQUIRED = ("tool_name", "user_id")
+
+SEGMENT_NAME = re.compile(r"^history-(\d+)-(\d+)\.jsonl$")
+
+
+class HistoryRecorder:
+    def __init__(self, batch_size=HISTORY_BATCH_SIZE, flush_interval=HISTORY_FLUSH_INTERVAL,
+                 sync=HISTORY_SYNC, spool_dir=HISTORY_SPOOL_DIR):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.sync = sync
+        self.spool_dir = spool_dir
+        self.app = None
+
+        self._lock = threading.Lock()         # buffer + active segment
+        self._flush_lock = threading.Lock()   # one flush at a time
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        self._rows = []
+        self._segment = None                  # open file of the active segment
+        self._segment_path = None
+        self._seq = 0
+        self._failed = []                     # [(segment_path, rows)] waiting for a retry
+
+    def init_app(self, app):
+        if self.app is not None:
+            return          # one flusher + spool replay per process, bound to the first app
+        self.app = app
+        if self.spool_dir is None:
+            self.spool_dir = os.path.join(app.instance_path, "history-spool")
+        os.makedirs(self.spool_dir, exist_ok=True)
+
+        with app.app_context():
+            self._replay()
+
+        if not self.sync:
+            self._thread = threading.Thread(target=self._flusher, name="history-writer", daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    # ---------------- PUBLIC API ----------------
+
+    def record(self, **fields):
+        """
+        Queue one History row. Takes History column names; created_at
+        defaults to now, so rows keep the time of the request, not of the flush.
+        """
+        self.record_many([fields])
+
+    def record_many(self, records):
+        """
+        Queue several History rows (dicts of column values) together. They
+        are buffered as a unit, so they are written in the same transaction.
+        """
+        rows = [self._row(fields) for fields in records]
+        if not rows:
+            return
+
+        if self.sync or self.app is None:
+            self._write(rows)
+            db.session.commit()
+            return
+
+        with self._lock:
+            for row in rows:
+                self._spool(row)
+            self._rows.extend(rows)
+            full = len(self._rows) >= self.batch_size
+
+        if full:
+            self._wakeup.set()
+
+    def flush(self):
+        """Write everything buffered so far. Returns the number of rows inserted."""
+        with self._flush_lock:
+            with self._lock:
+                if self._rows:
+                    self._failed.append((self._segment_path, self._rows))
+                    self._rows = []
+                    self._close_segment()
+                batches, self._failed = self._failed, []
+
+            inserted = 0
+            for i, (path, rows) in enumerate(batches):
+                try:
+                    inserted += self._insert(rows)
+                except Exception:
+                    db.session.rollback()
+                    log.exception("History flush failed, %d rows kept for retry", len(rows))
+                    with self._lock:
+                        self._failed = batches[i:] + self._failed
+                    break
+                self._remove_segment(path)
+            return inserted
+
+    def pending(self):
+        with self._lock:
+            return len(self._rows) + sum(len(rows) for _, rows in self._failed)
+
+    def close(self):
+        """Stop the writer thread and flush what is left."""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=10)
+        if self.app is not None:
+            with self.app.app_context():
+                self.flush()
+                db.session.remove()
+
+    @staticmethod
+    def _row(fields):
+        unknown = set(fields) - set(COLUMNS)
+        if unknown:
+            raise TypeError(f"Unknown History fields: {', '.join(sorted(unknown))}")
+        missing = [name for name in REQUIRED if fields.get(name) is None]
+        if missing:
+            raise ValueError(f"History record needs {', '.join(missing)}")
+
+        row = {column: fields.get(column) for column in COLUMNS}
+        if row["created_at"] is None:
+            row["created_at"] = datetime.utcnow()
+        return row
+
+    # ---------------- WRITER SIDE ----------------
+
+    def _flusher(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            if self._stopped.is_set():
+                break
+            try:
+                with self.app.app_context():
+                    self.flush()
+                    db.session.remove()
+            except Exception:
+                log.exception("History writer error")
+
+    def _insert(self, rows):
+        """One transaction, one executemany. Rows the database rejects are dropped."""
+        try:
+            self._write(rows)
+            db.session.commit()
+            return len(rows)
+        except IntegrityError:
+            db.session.rollback()
+
+        # A row references a deleted user (or similar): keep the good ones
+        inserted = 0
+        for row in rows:
+            try:
+                self._write([row])
+                db.session.commit()
+                inserted += 1
+            except IntegrityError as e:
+                db.session.rollback()
+                log.error("Dropping history row for %s (user %s): %s",
+                          row["tool_name"], row["user_id"], e.orig)
+        return inserted
+
+    @staticmethod
+    def _write(rows):
+        """INSERT rows plus their asset links (asset_index.py), without committing."""
+        table = History.__table__
+        ids = db.session.execute(
+            table.insert().returning(table.c.id, sort_by_parameter_order=True), rows
+        ).scalars().all()
+        link_history_assets(db.session, [
+            (history_id, row["input_image"], row["output_image"]) for history_id, row in zip(ids, rows)
+        ])
+
+    # ---------------- SPOOL ----------------
+
+    def _spool(self, row):
+        if self._segment is None:
+            self._seq += 1
+            self._segment_path = os.path.join(self.spool_dir, f"history-{os.getpid()}-{self._seq}.jsonl")
+            self._segment = open(self._segment_path, "a", encoding="utf-8")
+
+        data = dict(row, created_at=row["created_at"].isoformat())
+        self._segment.write(json.dumps(data) + "\n")
+        self._segment.flush()
+        if HISTORY_SPOOL_FSYNC:
+            os.fsync(self._segment.fileno())
+
+    def _close_segment(self):
+        if self._segment is not None:
+            self._segment.close()
+        self._segment = self._segment_path = None
+
+    @staticmethod
+    def _remove_segment(path):
+        if path is None:
+            return
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _replay(self):
+        """Insert rows from segments left behind by processes that are gone."""
+        replayed = 0
+        for name in sorted(os.listdir(self.spool_dir)):
+            match = SEGMENT_NAME.match(name)
+            if not match:
+                continue
+            pid = int(match.group(1))
+            if pid != os.getpid() and _process_alive(pid):
+                continue    # another worker's live segment
+
+            path = os.path.join(self.spool_dir, name)
+            rows = []
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        data = json.loads(line)
+                    except ValueError:
+                        continue    # torn last line from the crash
+                    data["created_at"] = datetime.fromisoformat(data["created_at"])
+                    rows.append({column: data.get(column) for column in COLUMNS})
+
+            if rows:
+                replayed += self._insert(rows)
+            self._remove_segment(path)
+
+        db.session.remove()
+        if replayed:
+            log.info("Recovered %d history rows from the spool", replayed)
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
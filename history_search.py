@@ -0,0 +1,239 @@
+# =============================================================================
+# History Search (SQLite FTS5)
+# =============================================================================
+# history_fts is an external-content FTS5 index over History: it stores only
+# the inverted index and reads the text back from the history table (for
+# highlight/snippet), so the prompts aren't stored twice. Triggers keep it in
+# step with every INSERT / UPDATE / DELETE on history, whatever writes them
+# (recorder, delete_history, the storage GC). Migration 3 creates it and
+# indexes the rows that existed before.
+#
+#   input_text, output_text   what users search; ranked by bm25, the user's
+#                             own prompt weighted above the expanded one
+#   user_id, tool_name        indexed too, so a search is the intersection
+#                             of the user's posting list with the terms',
+#                             not a scan of every user's matches
+#
+# User input never reaches MATCH as syntax: it's split into words, each one
+# quoted, the last one a prefix query (search-as-you-type).
+#
+# Matching is a posting-list intersection and takes well under a millisecond
+# at millions of rows. bm25, though, counts the rows containing each phrase
+# of the query over the whole table, and output_text is mostly the tool's
+# prompt template, so words like "image" or "style" are in nearly every row:
+# ranking on them alone costs ~30 ms per million rows, for an IDF of ~0. So
+# rows must match every word, but only the words found in fewer than
+# SEARCH_COMMON_TERM_ROWS rows go into the ranking query. If every word is
+# that common, results come newest first.
+#
+# The last word is judged by its longest indexed prefix, which is in at
+# least as many rows as the word expands to. Past PREFIX_LENGTHS a prefix
+# query merges the posting lists of every word it expands to, so a long last
+# word whose prefix is common and which is a common word itself is matched
+# as a whole word (porter stemming already covers its plural and verb forms).
+# One-letter words are always matched whole.
+
+import os
+import re
+import html
+import base64
+
+from sqlalchemy import text, bindparam
+from sqlalchemy.orm import joinedload
+
+from models import db, History, HistoryAsset
+
+FTS_TABLE = "history_fts"
+
+# Prefix lengths FTS5 keeps an index for; a longer prefix query merges the
+# posting lists of every word it expands to
+PREFIX_LENGTHS = (2, 3, 4)
+
+# bm25 weights in column order: input_text, output_text, user_id, tool_name
+RANK = "bm25(4.0, 1.0, 0.0, 0.0)"
+
+SCHEMA = [
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+    " input_text, output_text, user_id, tool_name,"
+    " content='history', content_rowid='id',"
+    " tokenize='porter unicode61 remove_diacritics 2',"
+    f" prefix='{' '.join(str(n) for n in PREFIX_LENGTHS)}')",
+
+    f"CREATE TRIGGER IF NOT EXISTS history_fts_insert AFTER INSERT ON history BEGIN"
+    f" INSERT INTO {FTS_TABLE} (rowid, input_text, output_text, user_id, tool_name)"
+    f" VALUES (new.id, new.input_text, new.output_text, new.user_id, new.tool_name); END",
+
+    f"CREATE TRIGGER IF NOT EXISTS history_fts_delete AFTER DELETE ON history BEGIN"
+    f" INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, input_text, output_text, user_id, tool_name)"
+    f" VALUES ('delete', old.id, old.input_text, old.output_text, old.user_id, old.tool_name); END",
+
+    f"CREATE TRIGGER IF NOT EXISTS history_fts_update"
+    f" AFTER UPDATE OF input_text, output_text, user_id, tool_name ON history BEGIN"
+    f" INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, input_text, output_text, user_id, tool_name)"
+    f" VALUES ('delete', old.id, old.input_text, old.output_text, old.user_id, old.tool_name);"
+    f" INSERT INTO {FTS_TABLE} (rowid, input_text, output_text, user_id, tool_name)"
+    f" VALUES (new.id, new.input_text, new.output_text, new.user_id, new.tool_name); END",
+
+    # Index the existing rows, and make ORDER BY rank use the weights above
+    f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('rebuild')",
+    f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rank) VALUES ('rank', '{RANK}')",
+]
+
+SEARCH_COMMON_TERM_ROWS = int(os.environ.get("SEARCH_COMMON_TERM_ROWS", 20000))
+
+MAX_TERMS = 16
+SNIPPET_TOKENS = 24
+
+# Highlight markers: control characters that can't occur in the escaped text
+_OPEN, _CLOSE = "\x02", "\x03"
+
+_COUNT_SQL = text(f"SELECT count(*) FROM (SELECT 1 FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :match LIMIT :cap)")
+
+# "+" keeps SQLite from handing the IN list to FTS5 as rowid=? lookups,
+# which would rerun the ranked query (bm25 counts included) once per row
+_RANKED_SQL = f"""
+    SELECT f.rowid AS id, f.rank AS rank
+    FROM {FTS_TABLE} AS f JOIN history AS h ON h.id = f.rowid
+    WHERE f.{FTS_TABLE} MATCH :rank_match
+      AND +f.rowid IN (SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :match)
+      {{tool}} {{after}}
+    ORDER BY f.rank, f.rowid
+    LIMIT :limit
+"""
+_RANKED_AFTER = "AND (f.rank > :after_rank OR (f.rank = :after_rank AND f.rowid > :after_id))"
+
+# Rows come out of FTS5 in rowid order with no sort step, so the highlights
+# are only made for the page (in ranked order every match is sorted first)
+_RECENT_SQL = f"""
+    SELECT f.rowid AS id, NULL AS rank,
+           highlight(f.{FTS_TABLE}, 0, :open, :close) AS input_hl,
+           snippet(f.{FTS_TABLE}, 1, :open, :close, '…', :tokens) AS output_hl
+    FROM {FTS_TABLE} AS f JOIN history AS h ON h.id = f.rowid
+    WHERE f.{FTS_TABLE} MATCH :match {{tool}} {{after}}
+    ORDER BY f.rowid DESC
+    LIMIT :limit
+"""
+_RECENT_AFTER = "AND f.rowid < :after_id"
+
+_HIGHLIGHT_SQL = text(f"""
+    SELECT rowid, highlight({FTS_TABLE}, 0, :open, :close), snippet({FTS_TABLE}, 1, :open, :close, '…', :tokens)
+    FROM {FTS_TABLE}
+    WHERE {FTS_TABLE} MATCH :match AND +rowid IN :ids
+""").bindparams(bindparam("ids", expanding=True))
+
+
+def query_terms(query):
+    """FTS5 phrases for free text: every word quoted, the last one a prefix."""
+    words = re.findall(r"\w+", query or "")[:MAX_TERMS]
+    terms = [f'"{word}"' for word in words]
+    if terms and not query[-1:].isspace() and len(words[-1]) >= min(PREFIX_LENGTHS):
+        terms[-1] += "*"        # still typing the last word
+    return terms
+
+
+def search(user_id, query, tool=None, limit=5, cursor=None):
+    """
+    One page of the user's History rows matching every word of query, best
+    first: ([(History, rank or None, input highlight, output snippet)], next
+    cursor), or None if query has no searchable words.
+    cursor: from a previous page; it also pins the ordering the first page used.
+    """
+    terms = query_terms(query)
+    if not terms:
+        return None
+
+    owner = f'user_id : "{int(user_id)}"'
+    scope = [owner]
+    if tool:
+        tool_words = re.findall(r"\w+", tool)
+        if tool_words:
+            scope.append(f'tool_name : "{" ".join(tool_words)}"')   # narrows; h.tool_name is exact
+
+    common = [_is_common(term) for term in terms[:-1]]
+    last = terms[-1]
+    if last.endswith("*"):
+        word = last[1:-2]
+        # Its indexed prefix is in at least as many rows as everything it expands to
+        common.append(_is_common(f'"{word[:max(PREFIX_LENGTHS)]}"*'))
+        if common[-1] and len(word) > max(PREFIX_LENGTHS) and _is_common(last[:-1]):
+            terms[-1] = last[:-1]
+    else:
+        common.append(_is_common(last))
+    match = " AND ".join(scope + [" ".join(terms)])
+
+    if cursor is not None and cursor[0] is None:
+        ranking = []
+    else:
+        ranking = [term for term, is_common in zip(terms, common) if not is_common] or (terms if cursor else [])
+
+    params = {"match": match, "limit": limit + 1, "open": _OPEN, "close": _CLOSE, "tokens": SNIPPET_TOKENS}
+    tool_sql = ""
+    if tool:
+        tool_sql = "AND h.tool_name = :tool"
+        params["tool"] = tool
+    if ranking:
+        params["rank_match"] = f"{owner} AND {' '.join(ranking)}"
+        sql, after_sql = _RANKED_SQL, _RANKED_AFTER
+    else:
+        sql, after_sql = _RECENT_SQL, _RECENT_AFTER
+    if cursor:
+        params["after_rank"], params["after_id"] = cursor
+    sql = text(sql.format(tool=tool_sql, after=after_sql if cursor else ""))
+
+    page = db.session.execute(sql, params).all()
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        next_cursor = encode_cursor(page[-1].rank, page[-1].id)
+    if not page:
+        return [], None
+
+    ids = [row.id for row in page]
+    if ranking:
+        highlights = {row[0]: (row[1], row[2]) for row in db.session.execute(_HIGHLIGHT_SQL, {**params, "ids": ids})}
+    else:
+        highlights = {row.id: (row.input_hl, row.output_hl) for row in page}
+    records = {r.id: r for r in (
+        History.query
+        .options(joinedload(History.assets).joinedload(HistoryAsset.asset))
+        .filter(History.id.in_(ids))
+    )}
+
+    results = [
+        (records[row.id], row.rank, *highlights.get(row.id, (None, None)))
+        for row in page if row.id in records
+    ]
+    return results, next_cursor
+
+
+def _is_common(term):
+    """Whether the phrase is in at least SEARCH_COMMON_TERM_ROWS rows (reads at most that many)."""
+    count = db.session.execute(_COUNT_SQL, {"match": term, "cap": SEARCH_COMMON_TERM_ROWS}).scalar()
+    return count >= SEARCH_COMMON_TERM_ROWS
+
+
+def marked(fragment):
+    """Highlighted fragment as HTML: text escaped, matches in <mark>."""
+    if fragment is None:
+        return None
+    return html.escape(fragment).replace(_OPEN, "<mark>").replace(_CLOSE, "</mark>")
+
+
+# The rank of a row moves a little as the index grows, so a page boundary
+# may repeat or skip a row when rows are added between requests; the cursor
+# never fails, though.
+def encode_cursor(rank, record_id):
+    return base64.urlsafe_b64encode(f"{'' if rank is None else repr(rank)}|{record_id}".encode()) \
+        .decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """(rank or None for newest-first pages, id) or None if cursor is missing/invalid."""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        rank, record_id = raw.rsplit("|", 1)
+        return (float(rank) if rank else None), int(record_id)
+    except (ValueError, UnicodeDecodeError):
+        return None
@@ -0,0 +1,240 @@
+# =============================================================================
+# Background Generation Jobs
+# =============================================================================
+# The /api image tools used to do all of their work inside the Flask request,
+# holding a WSGI worker for the whole upstream call. Now the request only
+# validates input and saves uploads, then hands a job to this queue and
+# returns 202 with the job id. A bounded pool of worker threads runs the
+# tool's handler (upstream call + History row) and stores the result.
+#
+# Jobs live in the "jobs" table, so anything still queued or running when
+# the process stops is picked up again by another one. Each process holds a
+# lease on the jobs it queued or claimed: worker_id plus a heartbeat_at it
+# refreshes every JOB_HEARTBEAT_SECONDS. Only jobs whose lease is older
+# than JOB_LEASE_SECONDS (their process died) are taken over, so with
+# several workers an in-flight job is never run twice. CLI commands don't
+# start the queue at all (app.py). Status changes are also published to the
+# owner's /api/events stream (events.py).
+
+import os
+import json
+import time
+import uuid
+import socket
+import logging
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import or_
+
+import events
+import metrics
+from models import db, Job
+
+log = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 4))
+JOB_QUEUE_LIMIT = int(os.environ.get("JOB_QUEUE_LIMIT", 200))
+JOB_HEARTBEAT_SECONDS = float(os.environ.get("JOB_HEARTBEAT_SECONDS", 15))
+JOB_LEASE_SECONDS = float(os.environ.get("JOB_LEASE_SECONDS", 60))     # several missed heartbeats
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+JOB_SECONDS = metrics.histogram("imageworks_job_duration_seconds",
+                                "Time a worker spends on a job, per tool.", ["tool", "status"])
+
+
+class QueueFull(Exception):
+    """Raised by submit() when JOB_QUEUE_LIMIT jobs are already waiting."""
+
+
+class QueueUnavailable(Exception):
+    """Raised by submit() in a process that runs no job workers (init_app not called)."""
+
+
+class JobQueue:
+    def __init__(self, workers=JOB_WORKERS, max_pending=JOB_QUEUE_LIMIT,
+                 heartbeat=JOB_HEARTBEAT_SECONDS, lease=JOB_LEASE_SECONDS):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.heartbeat = heartbeat
+        self.lease = timedelta(seconds=lease)
+        self.worker_id = f"{socket.gethostname()[:40]}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.app = None
+        self.handlers = {}
+        self._executor = None
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def init_app(self, app, handlers):
+        """
+        handlers maps tool_name -> fn(payload, user_id) returning a
+        JSON-serialisable result dict. Raising marks the job as failed.
+        Takes over jobs whose lease has expired, then keeps this process's
+        leases alive (and takes over more) in a background thread.
+        Only the first call per process does anything.
+        """
+        if self._executor is not None:
+            return
+        self.app = app
+        self.handlers = handlers
+        self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                            thread_name_prefix="job-worker")
+        with app.app_context():
+            self._reclaim()
+        self._thread = threading.Thread(target=self._heartbeat_loop, name="job-heartbeat", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    # ---------------- PUBLIC API ----------------
+
+    def submit(self, tool_name, user_id, payload):
+        """Store a new job and queue it. Returns the Job row."""
+        if self._executor is None:
+            # e.g. an app built with BACKGROUND_WORKERS off: nobody would run it
+            raise QueueUnavailable()
+        if tool_name not in self.handlers:
+            raise KeyError(f"No job handler for {tool_name}")
+
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise QueueFull()
+            self._pending += 1
+
+        try:
+            job = Job(
+                id=uuid.uuid4().hex,
+                tool_name=tool_name,
+                status=QUEUED,
+                payload=json.dumps(payload),
+                user_id=user_id,
+                worker_id=self.worker_id,
+                heartbeat_at=datetime.utcnow()
+            )
+            db.session.add(job)
+            db.session.commit()
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+            raise
+
+        events.publish_job(user_id, job.id, tool_name, QUEUED)
+        self._executor.submit(self._run, job.id)
+        return job
+
+    def pending(self):
+        """Jobs queued or running in this process."""
+        return self._pending
+
+    def get(self, job_id, user_id):
+        """Return the job if it belongs to user_id, else None."""
+        job = db.session.get(Job, job_id)
+        if job is None or job.user_id != user_id:
+            return None
+        return job
+
+    @staticmethod
+    def to_dict(job):
+        return {
+            "job_id": job.id,
+            "tool": job.tool_name,
+            "status": job.status,
+            "result": json.loads(job.result) if job.result else None,
+            "error": job.error,
+            "created_at": job.created_at.strftime("%Y-%m-%d %H:%M:%S") if job.created_at else None
+        }
+
+    # ---------------- WORKER SIDE ----------------
+
+    def _run(self, job_id):
+        try:
+            with self.app.app_context():
+                self._execute(job_id)
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def _execute(self, job_id):
+        # Claim the job atomically, and only while this process still holds
+        # its lease: if another one took it over, that one runs it
+        claimed = (
+            Job.query
+            .filter(Job.id == job_id, Job.status == QUEUED, Job.worker_id == self.worker_id)
+            .update({Job.status: RUNNING, Job.heartbeat_at: datetime.utcnow()}, synchronize_session=False)
+        )
+        db.session.commit()
+        if not claimed:
+            return
+
+        job = db.session.get(Job, job_id)
+        user_id, tool_name = job.user_id, job.tool_name
+        started = time.perf_counter()
+        try:
+            with events.job_scope(user_id, job_id, tool_name):
+                events.emit(RUNNING)
+                result = self.handlers[tool_name](json.loads(job.payload or "{}"), user_id)
+            job.status = DONE
+            job.result = json.dumps(result)
+            job.error = None
+            db.session.commit()
+            JOB_SECONDS.observe(time.perf_counter() - started, tool_name, DONE)
+            events.publish_job(user_id, job_id, tool_name, DONE, result=result)
+        except Exception as e:
+            log.exception("Job %s (%s) failed", job_id, tool_name)
+            db.session.rollback()
+            job = db.session.get(Job, job_id)
+            job.status = FAILED
+            job.error = str(e)
+            db.session.commit()
+            JOB_SECONDS.observe(time.perf_counter() - started, tool_name, FAILED)
+            events.publish_job(user_id, job_id, tool_name, FAILED, error=str(e))
+        finally:
+            db.session.remove()
+
+    # ---------------- LEASES ----------------
+
+    def _heartbeat_loop(self):
+        while not self._stopped.wait(self.heartbeat):
+            try:
+                with self.app.app_context():
+                    self._renew()
+                    self._reclaim()
+            except Exception:
+                log.exception("Job lease heartbeat failed")
+
+    def _renew(self):
+        """Refresh the lease on every job this process has queued or is running."""
+        (Job.query
+         .filter(Job.worker_id == self.worker_id, Job.status.in_([QUEUED, RUNNING]))
+         .update({Job.heartbeat_at: datetime.utcnow()}, synchronize_session=False))
+        db.session.commit()
+
+    def _reclaim(self):
+        """Take over queued/running jobs whose lease expired (their process is gone)."""
+        expired = or_(Job.heartbeat_at.is_(None), Job.heartbeat_at < datetime.utcnow() - self.lease)
+        candidates = [job_id for job_id, in
+                      db.session.query(Job.id).filter(Job.status.in_([QUEUED, RUNNING]), expired)]
+
+        taken = []
+        for job_id in candidates:
+            # Conditional on the lease still being expired, so two processes
+            # reclaiming at once can't both get it
+            if (Job.query
+                    .filter(Job.id == job_id, Job.status.in_([QUEUED, RUNNING]), expired)
+                    .update({Job.status: QUEUED, Job.worker_id: self.worker_id,
+                             Job.heartbeat_at: datetime.utcnow()}, synchronize_session=False)):
+                taken.append(job_id)
+            db.session.commit()
+
+        for job_id in taken:
+            with self._lock:
+                self._pending += 1
+            self._executor.submit(self._run, job_id)
+
+        if taken:
+            log.info("Took over %d unfinished jobs with expired leases", len(taken))
@@ -0,0 +1,289 @@
+# =============================================================================
+# Metrics (Prometheus text format at /metrics)
+# =============================================================================
+# Counters and histograms for request latency / status codes, SQL queries,
+# upstream Gemini calls and uploads. Other modules declare their metrics at
+# import time:
+#
+#     UPLOAD_BYTES = metrics.counter("imageworks_upload_bytes_total", "...", ["endpoint"])
+#     UPLOAD_BYTES.inc(endpoint, amount=n)
+#
+# Recording takes no lock: every thread writes to its own shard (a plain
+# dict reached through threading.local) and /metrics adds the shards up.
+# Shards of threads that have exited are folded into a base total at
+# collection time, so short-lived fan-out threads don't pile up.
+#
+# init_app() hooks Flask (per-route latency + status, per-request SQL
+# count/time) and SQLAlchemy (query latency). Set METRICS_TOKEN to require
+# "Authorization: Bearer <token>" on /metrics.
+
+import os
+import time
+import bisect
+import threading
+import contextvars
+
+from flask import g, request, Response
+from sqlalchemy import event
+
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") == "1"
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (1024, 16 * 1024, 64 * 1024, 256 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2, 64 * 1024 ** 2)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+# [queries, seconds] of SQL run by the current request
+_request_db = contextvars.ContextVar("request_db", default=None)
+
+
+# =============================================================================
+# METRIC TYPES
+# =============================================================================
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards = []               # [(thread, values)]
+        self._base = {}                 # totals folded in from exited threads
+        self._lock = threading.Lock()   # shard list / folding only, never on record
+
+    def _values(self):
+        values = getattr(self._local, "values", None)
+        if values is None:
+            values = self._local.values = {}
+            with self._lock:
+                self._shards.append((threading.current_thread(), values))
+        return values
+
+    def _collect(self):
+        """Merged {labelvalues: value} over all threads."""
+        with self._lock:
+            alive = []
+            for thread, values in self._shards:
+                if thread.is_alive():
+                    alive.append((thread, values))
+                else:
+                    self._merge(self._base, values)
+            self._shards = alive
+
+            total = {}
+            self._merge(total, self._base)
+            for _, values in alive:
+                self._merge(total, dict(values))
+        return total
+
+    def _labels(self, labelvalues, extra=()):
+        pairs = list(zip(self.labelnames, labelvalues)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for labelvalues, value in sorted(self._collect().items()):
+            lines.extend(self._render_value(labelvalues, value))
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labelvalues, amount=1):
+        values = self._values()
+        values[labelvalues] = values.get(labelvalues, 0) + amount
+
+    @staticmethod
+    def _merge(into, values):
+        for key, value in values.items():
+            into[key] = into.get(key, 0) + value
+
+    def _render_value(self, labelvalues, value):
+        return [f"{self.name}{self._labels(labelvalues)} {_number(value)}"]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labelvalues):
+        values = self._values()
+        entry = values.get(labelvalues)
+        if entry is None:
+            # per-bucket (non-cumulative) counts incl. +Inf, then sum
+            entry = values[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0]
+        entry[bisect.bisect_left(self.buckets, value)] += 1
+        entry[-1] += value
+
+    @staticmethod
+    def _merge(into, values):
+        for key, entry in values.items():
+            entry = list(entry)
+            target = into.get(key)
+            if target is None:
+                into[key] = entry
+            else:
+                into[key] = [a + b for a, b in zip(target, entry)]
+
+    def _render_value(self, labelvalues, entry):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), entry[:-1]):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else _number(bound)
+            lines.append(f"{self.name}_bucket{self._labels(labelvalues, [('le', le)])} {cumulative}")
+        lines.append(f"{self.name}_sum{self._labels(labelvalues)} {_number(entry[-1])}")
+        lines.append(f"{self.name}_count{self._labels(labelvalues)} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """Value read from a callback at scrape time (queue depth, in-flight, ...)."""
+    kind = "gauge"
+
+    def __init__(self, name, help_text, fn):
+        self.name = name
+        self.help = help_text
+        self.fn = fn
+
+    def render(self):
+        try:
+            value = self.fn()
+        except Exception:
+            return []
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {_number(value)}"]
+
+
+def _register(metric):
+    with _registry_lock:
+        _registry.append(metric)
+    return metric
+
+
+def counter(name, help_text, labelnames=()):
+    return _register(Counter(name, help_text, labelnames))
+
+
+def histogram(name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+    return _register(Histogram(name, help_text, labelnames, buckets))
+
+
+def gauge(name, help_text, fn):
+    return _register(Gauge(name, help_text, fn))
+
+
+def render():
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# =============================================================================
+# HTTP + SQL INSTRUMENTATION
+# =============================================================================
+
+REQUEST_SECONDS = histogram("imageworks_http_request_duration_seconds",
+                            "Time to produce a response, per route.", ["route", "method"])
+REQUESTS = counter("imageworks_http_requests_total",
+                   "Responses per route and status code.", ["route", "method", "status"])
+REQUEST_DB_QUERIES = histogram("imageworks_http_request_db_queries",
+                               "SQL statements run per request.", ["route"], COUNT_BUCKETS)
+REQUEST_DB_SECONDS = histogram("imageworks_http_request_db_seconds",
+                               "Time spent in SQL per request.", ["route"], DB_BUCKETS)
+DB_QUERY_SECONDS = histogram("imageworks_db_query_duration_seconds",
+                             "SQL statement latency, by request route or 'background'.", ["source"], DB_BUCKETS)
+
+
+def current_route():
+    """Route template of the current request ("unmatched" for 404s), or None outside one."""
+    try:
+        rule = request.url_rule
+    except RuntimeError:
+        return None
+    return rule.rule if rule is not None else "unmatched"
+
+
+def init_app(app, db):
+    if not METRICS_ENABLED:
+        return
+
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+
+    with app.app_context():
+        engine = db.engine
+    if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def metrics_response():
+    """Body for the /metrics route."""
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return Response("Unauthorized\n", status=401, mimetype="text/plain")
+    return Response(render(), mimetype="text/plain; version=0.0.4")
+
+
+def _start_request():
+    g.metrics_started = time.perf_counter()
+    g.metrics_db_token = _request_db.set([0, 0.0])
+
+
+def _finish_request(response):
+    started = g.pop("metrics_started", None)
+    if started is None:
+        return response
+
+    route = current_route()
+    method = request.method
+    REQUEST_SECONDS.observe(time.perf_counter() - started, route, method)
+    REQUESTS.inc(route, method, response.status_code)
+
+    stats = _request_db.get()
+    if stats is not None:
+        REQUEST_DB_QUERIES.observe(stats[0], route)
+        REQUEST_DB_SECONDS.observe(stats[1], route)
+    token = g.pop("metrics_db_token", None)
+    if token is not None:
+        _request_db.reset(token)
+    return response
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("metrics_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get("metrics_started")
+    if not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+
+    stats = _request_db.get()
+    if stats is not None:
+        stats[0] += 1
+        stats[1] += elapsed
+    DB_QUERY_SECONDS.observe(elapsed, current_route() or "background")
@@ -0,0 +1,75 @@
+# =============================================================================
+# Schema Migrations
+# =============================================================================
+# db.create_all() only creates missing tables; it never touches tables that
+# already exist. Changes to existing tables (indexes, new columns, ...) go
+# here as numbered steps. Each step is applied once and recorded in the
+# schema_migrations table.
+#
+# A step is a list of SQL statements or a callable taking the connection.
+# Keep statements idempotent (IF NOT EXISTS) so a fresh database created by
+# create_all() can run them too.
+
+import logging
+
+from sqlalchemy import text
+
+from asset_index import backfill as backfill_assets
+import history_search
+
+log = logging.getLogger(__name__)
+
+
+def add_job_lease(conn):
+    # SQLite has no ADD COLUMN IF NOT EXISTS, and create_all() already made them on a fresh database
+    columns = {row[1] for row in conn.execute(text("PRAGMA table_info(jobs)"))}
+    if "worker_id" not in columns:
+        conn.execute(text("ALTER TABLE jobs ADD COLUMN worker_id VARCHAR(64)"))
+    if "heartbeat_at" not in columns:
+        conn.execute(text("ALTER TABLE jobs ADD COLUMN heartbeat_at DATETIME"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_jobs_status_heartbeat ON jobs (status, heartbeat_at)"))
+
+
+MIGRATIONS = [
+    (1, "history: composite index for per-user, per-tool history listing", [
+        "CREATE INDEX IF NOT EXISTS ix_history_user_tool_created "
+        "ON history (user_id, tool_name, created_at DESC, id)"
+    ]),
+    (2, "assets + history_assets: normalized file references, backfilled from history", backfill_assets),
+    (3, "history_fts: FTS5 index over history prompts, kept in sync by triggers", history_search.SCHEMA),
+    (4, "jobs: worker_id + heartbeat_at lease columns", add_job_lease),
+]
+
+
+def run_migrations(db):
+    """Apply pending migrations. Returns the list of versions applied."""
+    applied = []
+
+    with db.engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            " version INTEGER PRIMARY KEY,"
+            " description TEXT,"
+            " applied_at DATETIME DEFAULT CURRENT_TIMESTAMP)"
+        ))
+        done = {row[0] for row in conn.execute(text("SELECT version FROM schema_migrations"))}
+
+    for version, description, step in MIGRATIONS:
+        if version in done:
+            continue
+
+        with db.engine.begin() as conn:
+            if callable(step):
+                step(conn)
+            else:
+                for statement in step:
+                    conn.execute(text(statement))
+            conn.execute(
+                text("INSERT INTO schema_migrations (version, description) VALUES (:v, :d)"),
+                {"v": version, "d": description}
+            )
+
+        log.info("Applied migration %d: %s", version, description)
+        applied.append(version)
+
+    return applied
@@ -17,6 +17,17 @@ class History(db.Model):
     created_at = db.Column(db.DateTime, server_default=func.now())
     user_id = db.Column(db.Integer , db.ForeignKey('users.id'), nullable=False)
 
+    # Serves /api/get-history: filter on user + tool, newest first, keyset on (created_at, id).
+    # Existing databases get it from migrations.py.
+    __table_args__ = (
+        db.Index("ix_history_user_tool_created", user_id, tool_name, created_at.desc(), id),
+    )
+
+    # Files the row points at (input_image / output_image), see asset_index.py.
+    # The database deletes the links with the row (foreign_keys=ON).
+    assets = db.relationship("HistoryAsset", back_populates="history", lazy="select",
+                             cascade="all, delete-orphan", passive_deletes=True)
+
     def __repr__(self):
         return f"<History {self.tool_name} #{self.id}>"
     
@@ -38,3 +49,73 @@ class User(db.Model):
     def __repr__(self):
         return f"<USer {self.username}>"
 
+
+class Job(db.Model):
+    __tablename__ = "jobs"
+
+    id = db.Column(db.String(32), primary_key=True)           # uuid4 hex
+    tool_name = db.Column(db.String(100), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default="queued")  # queued / running / done / failed
+    payload = db.Column(db.Text)                               # JSON handed to the worker
+    result = db.Column(db.Text)                                # JSON returned by the worker
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, server_default=func.now())
+    updated_at = db.Column(db.DateTime, server_default=func.now(), onupdate=func.now())
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    # Lease: the process that queued/claimed the job and when it last said it's alive (jobs.py).
+    # Existing databases get these from migrations.py.
+    worker_id = db.Column(db.String(64))
+    heartbeat_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index("ix_jobs_status_heartbeat", status, heartbeat_at),
+    )
+
+    def __repr__(self):
+        return f"<Job {self.tool_name} {self.id} {self.status}>"
+
+
+
+class CachedResult(db.Model):
+    __tablename__ = "result_cache"
+
+    key = db.Column(db.String(64), primary_key=True)          # sha256 of tool + prompt + options + input digests
+    tool_name = db.Column(db.String(100), nullable=False)
+    filename = db.Column(db.String(300), nullable=False)      # file inside generated/
+    size = db.Column(db.Integer, nullable=False, default=0)
+    hits = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, server_default=func.now(), index=True)
+    last_used_at = db.Column(db.DateTime, server_default=func.now(), index=True)
+
+    def __repr__(self):
+        return f"<CachedResult {self.tool_name} {self.key[:12]}>"
+
+
+class Asset(db.Model):
+    __tablename__ = "assets"
+
+    id = db.Column(db.Integer, primary_key=True)
+    path = db.Column(db.String(300), unique=True, nullable=False)   # "uploads/ab/cd/<digest>.png", "generated/<file>"
+    digest = db.Column(db.String(64), index=True)                    # sha256, None for legacy (not content-addressed) files
+    size = db.Column(db.Integer)
+    mime = db.Column(db.String(50))
+    width = db.Column(db.Integer)
+    height = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, server_default=func.now())
+
+    def __repr__(self):
+        return f"<Asset {self.path}>"
+
+
+class HistoryAsset(db.Model):
+    __tablename__ = "history_assets"
+
+    history_id = db.Column(db.Integer, db.ForeignKey("history.id", ondelete="CASCADE"), primary_key=True)
+    role = db.Column(db.String(30), primary_key=True)                # "face", "specs", "image", "output", ...
+    asset_id = db.Column(db.Integer, db.ForeignKey("assets.id"), nullable=False, index=True)
+
+    history = db.relationship("History", back_populates="assets")
+    asset = db.relationship("Asset", lazy="joined", innerjoin=True)
+
+    def __repr__(self):
+        return f"<HistoryAsset #{self.history_id} {self.role}>"
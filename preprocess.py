@@ -0,0 +1,212 @@
+# =============================================================================
+# Input Image Preprocessing
+# =============================================================================
+# specs-tryon, haircut-preview and image-style send the user's photos to
+# Gemini as inline base64. A 12 MP phone photo is several MB of base64 and
+# dominates upload time and upstream latency, while the model works at a
+# far lower resolution anyway. Each upload is therefore prepared once:
+#
+#   decode (JPEGs at a reduced DCT scale when that's enough) -> EXIF
+#   orientation -> downscale to PREPROCESS_MAX_EDGE -> re-encode as
+#   PREPROCESS_FORMAT at PREPROCESS_QUALITY
+#
+# Prepared bytes are cached by upload digest: in memory for the jobs that
+# follow shortly after the upload (receive_uploads() schedules the work in
+# the background, so it's usually done before the job starts), and on disk
+# in prepared/ab/<digest>-<variant> across restarts. The variant encodes
+# every setting, output format included (e.g. "1536q85.webp"), so changing
+# any of them never serves stale files. A kept original is stored under the
+# same name, and its type is read back from its magic bytes.
+#
+# An upload that is already small, upright and no bigger than its re-encode
+# is sent as is. Without Pillow (or for files it can't decode) the original
+# bytes are sent.
+
+import io
+import os
+import logging
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from lru import LRUCache
+from upload_store import MIME_TYPES
+from upload_stream import sniff_image_type
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:          # preprocessing is optional; originals are sent instead
+    Image = ImageOps = None
+
+log = logging.getLogger(__name__)
+
+PREPROCESS_MAX_EDGE = int(os.environ.get("PREPROCESS_MAX_EDGE", 1536))
+PREPROCESS_FORMAT = os.environ.get("PREPROCESS_FORMAT", "webp").lower()     # webp | jpeg
+PREPROCESS_QUALITY = int(os.environ.get("PREPROCESS_QUALITY", 85))
+PREPROCESS_CACHE_SIZE = int(os.environ.get("PREPROCESS_CACHE_SIZE", 128))    # prepared images in memory
+PREPROCESS_WORKERS = int(os.environ.get("PREPROCESS_WORKERS", 2))
+
+EXTENSIONS = {"webp": "webp", "jpeg": "jpg"}
+EXIF_ORIENTATION = 0x0112
+
+PREPROCESS_BYTES = metrics.counter("imageworks_preprocess_bytes_total",
+                                   "Input image bytes before (source) and after (prepared) preprocessing.",
+                                   ["stage"])
+PREPROCESS_LOOKUPS = metrics.counter("imageworks_preprocess_lookups_total",
+                                     "Prepared image lookups by where they were answered from.", ["result"])
+
+# data: bytes to send upstream, mime: their type
+PreparedImage = namedtuple("PreparedImage", "data mime")
+
+
+class ImagePreprocessor:
+    def __init__(self, cache_dir, max_edge=PREPROCESS_MAX_EDGE, fmt=PREPROCESS_FORMAT,
+                 quality=PREPROCESS_QUALITY, cache_size=PREPROCESS_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_edge = max_edge
+        self.format = fmt if fmt in EXTENSIONS else "webp"
+        self.quality = quality
+        self.ext = EXTENSIONS[self.format]
+        self.variant = f"{max_edge}q{quality}.{self.ext}"
+        self.cache = LRUCache(maxsize=cache_size)
+        self._executor = ThreadPoolExecutor(max_workers=PREPROCESS_WORKERS, thread_name_prefix="preprocess")
+        self._lock = threading.Lock()
+        self._building = {}                  # digest -> Lock held while it's being prepared
+
+    @property
+    def enabled(self):
+        return Image is not None
+
+    # ---------------- PUBLIC API ----------------
+
+    def prepare(self, digest, source_path):
+        """PreparedImage for the upload with this digest stored at source_path."""
+        prepared = self.cache.get(digest)
+        if prepared is not None:
+            PREPROCESS_LOOKUPS.inc("memory")
+            return prepared
+
+        with self._digest_lock(digest):
+            prepared = self.cache.get(digest)
+            if prepared is not None:
+                PREPROCESS_LOOKUPS.inc("memory")
+                return prepared
+
+            prepared = self._read_cached(digest)
+            if prepared is not None:
+                PREPROCESS_LOOKUPS.inc("disk")
+            else:
+                PREPROCESS_LOOKUPS.inc("miss")
+                prepared = self._prepare(digest, source_path)
+
+            self.cache.set(digest, prepared)
+            return prepared
+
+    def schedule(self, uploads):
+        """Prepare StoredUploads in the background, ahead of the job that will send them."""
+        for stored in uploads:
+            self._executor.submit(self._prepare_quietly, stored.digest, stored.abs_path)
+
+    def cached_path(self, digest):
+        return os.path.join(self.cache_dir, digest[:2], f"{digest}-{self.variant}")
+
+    # ---------------- INTERNALS ----------------
+
+    def _digest_lock(self, digest):
+        # Only one thread decodes a given upload; the rest wait for its result
+        with self._lock:
+            lock = self._building.get(digest)
+            if lock is None:
+                lock = self._building[digest] = _RefLock(self._building, digest, self._lock)
+            lock.refs += 1
+            return lock
+
+    def _prepare_quietly(self, digest, source_path):
+        try:
+            self.prepare(digest, source_path)
+        except Exception:
+            log.exception("Preprocessing failed for %s", digest)
+
+    def _read_cached(self, digest):
+        try:
+            with open(self.cached_path(digest), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        # Usually self.ext, unless the original was kept (see _encode)
+        ext = sniff_image_type(data[:16])
+        return PreparedImage(data, MIME_TYPES[ext]) if ext in MIME_TYPES else None
+
+    def _prepare(self, digest, source_path):
+        with open(source_path, "rb") as f:
+            source = f.read()
+        PREPROCESS_BYTES.inc("source", amount=len(source))
+        source_ext = sniff_image_type(source[:16])
+
+        data, ext = source, source_ext
+        if self.enabled:
+            try:
+                data, ext = self._encode(source, source_ext)
+            except Exception as e:      # Pillow can't read it; the model may still manage
+                log.warning("Sending %s unprocessed: %s", digest, e)
+
+        PREPROCESS_BYTES.inc("prepared", amount=len(data))
+        prepared = PreparedImage(data, MIME_TYPES.get(ext, "application/octet-stream"))
+        if ext in MIME_TYPES:
+            self._write_cached(self.cached_path(digest), data)
+        return prepared
+
+    def _encode(self, source, source_ext):
+        """(bytes, ext) to send for the source image bytes."""
+        with Image.open(io.BytesIO(source)) as img:
+            if img.format == "JPEG":
+                # Let libjpeg decode at 1/2, 1/4 or 1/8 scale when that still covers max_edge
+                img.draft("RGB", (self.max_edge, self.max_edge))
+            upright = img.getexif().get(EXIF_ORIENTATION, 1) == 1
+            small = max(img.size) <= self.max_edge
+
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((self.max_edge, self.max_edge), Image.LANCZOS)
+            if self.ext == "jpg" and img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            elif img.mode not in ("RGB", "RGBA", "L"):
+                img = img.convert("RGBA")
+
+            out = io.BytesIO()
+            img.save(out, format=self.format.upper(), quality=self.quality)
+            data = out.getvalue()
+
+        if upright and small and len(source) <= len(data):
+            return source, source_ext
+        return data, self.ext
+
+    @staticmethod
+    def _write_cached(path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+
+class _RefLock:
+    """Per-digest lock that removes itself from the table once nobody holds it."""
+
+    def __init__(self, table, key, table_lock):
+        self.table = table
+        self.key = key
+        self.table_lock = table_lock
+        self.lock = threading.Lock()
+        self.refs = 0
+
+    def __enter__(self):
+        self.lock.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.lock.release()
+        with self.table_lock:
+            self.refs -= 1
+            if self.refs == 0:
+                self.table.pop(self.key, None)
@@ -0,0 +1,160 @@
+# =============================================================================
+# Prompt Enhancer (cached, batched)
+# =============================================================================
+# /api/enhance-prompt turns a short prompt into a detailed image prompt with
+# the Gemini text model. Users re-enhance the same short prompts constantly,
+# so results are cached on the normalized prompt (LRU + TTL).
+#
+# enhance_many() serves the batch endpoint. Cache hits are answered
+# directly. The remaining distinct prompts are packed ENHANCE_PACK_SIZE at a
+# time into one upstream call that returns a JSON array. If a pack's
+# answer can't be parsed (or has the wrong length), its prompts fall back
+# to one call each. Results always come back in input order.
+
+import os
+import re
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from lru import LRUCache
+
+log = logging.getLogger(__name__)
+
+ENHANCE_CACHE_SIZE = int(os.environ.get("ENHANCE_CACHE_SIZE", 5000))
+ENHANCE_CACHE_TTL = int(os.environ.get("ENHANCE_CACHE_TTL", 24 * 3600))
+ENHANCE_PACK_SIZE = int(os.environ.get("ENHANCE_PACK_SIZE", 10))
+ENHANCE_BATCH_MAX = int(os.environ.get("ENHANCE_BATCH_MAX", 50))
+ENHANCE_MAX_PROMPT_CHARS = int(os.environ.get("ENHANCE_MAX_PROMPT_CHARS", 2000))
+ENHANCE_PARALLEL_CALLS = int(os.environ.get("ENHANCE_PARALLEL_CALLS", 4))
+
+ENHANCEMENT_INSTRUCTION = """You are an expert prompt engineer for AI image generation models.
+
+Take this simple prompt and enhance it into a detailed, vivid, and comprehensive prompt suitable for high-quality image generation.
+
+Add details about:
+- Visual style and aesthetic
+- Lighting and atmosphere
+- Color palette
+- Composition and framing
+- Quality indicators (masterpiece, highly detailed, professional, etc.)
+- Any relevant artistic styles or references
+
+Simple prompt: {prompt}
+
+Respond with ONLY the enhanced prompt, nothing else. Make it detailed but concise (1-2 sentences max)."""
+
+BATCH_INSTRUCTION = """You are an expert prompt engineer for AI image generation models.
+
+Enhance each of the simple prompts below into a detailed, vivid, and comprehensive prompt suitable for high-quality image generation.
+
+For each one, add details about visual style and aesthetic, lighting and atmosphere, color palette, composition and framing, quality indicators and any relevant artistic styles or references. Make each enhanced prompt detailed but concise (1-2 sentences max).
+
+Respond with ONLY a JSON array of strings: one enhanced prompt per input, in the same order, nothing else.
+
+Prompts:
+{prompts}"""
+
+_WHITESPACE = re.compile(r"\s+")
+_CODE_FENCE = re.compile(r"^```(?:json)?\s*|\s*```$")
+
+
+class PromptRejected(Exception):
+    pass
+
+
+def normalize_prompt(prompt):
+    """Cache key form of a prompt: trimmed, single-spaced, case-folded."""
+    return _WHITESPACE.sub(" ", prompt).strip().casefold()
+
+
+class PromptEnhancer:
+    def __init__(self, client, cache_size=ENHANCE_CACHE_SIZE, cache_ttl=ENHANCE_CACHE_TTL,
+                 pack_size=ENHANCE_PACK_SIZE):
+        """client is an upstream.GeminiClient (anything with generate_text)."""
+        self.client = client
+        self.pack_size = pack_size
+        self.cache = LRUCache(maxsize=cache_size, ttl=cache_ttl)
+        self._executor = ThreadPoolExecutor(max_workers=ENHANCE_PARALLEL_CALLS,
+                                            thread_name_prefix="enhancer")
+
+    # ---------------- PUBLIC API ----------------
+
+    def enhance(self, prompt):
+        """Returns (enhanced_prompt, cached)."""
+        key = self._key(prompt)
+        enhanced = self.cache.get(key)
+        if enhanced is not None:
+            return enhanced, True
+
+        enhanced = self._enhance_one(prompt)
+        self.cache.set(key, enhanced)
+        return enhanced, False
+
+    def enhance_many(self, prompts):
+        """
+        Returns [(enhanced_prompt, cached)] in the order of prompts. Raises
+        PromptRejected for an empty or oversized prompt before any upstream call.
+        """
+        keys = [self._key(prompt) for prompt in prompts]
+
+        results = {}
+        misses = {}         # key -> first prompt with that key
+        for key, prompt in zip(keys, prompts):
+            if key in results or key in misses:
+                continue
+            enhanced = self.cache.get(key)
+            if enhanced is not None:
+                results[key] = (enhanced, True)
+            else:
+                misses[key] = prompt
+
+        miss_keys = list(misses)
+        packs = [miss_keys[i:i + self.pack_size] for i in range(0, len(miss_keys), self.pack_size)]
+        futures = [self._executor.submit(self._enhance_pack, [misses[key] for key in pack]) for pack in packs]
+
+        for pack, future in zip(packs, futures):
+            for key, enhanced in zip(pack, future.result()):
+                self.cache.set(key, enhanced)
+                results[key] = (enhanced, False)
+
+        return [results[key] for key in keys]
+
+    # ---------------- UPSTREAM ----------------
+
+    @staticmethod
+    def _key(prompt):
+        if not isinstance(prompt, str) or not prompt.strip():
+            raise PromptRejected("Prompt cannot be empty")
+        if len(prompt) > ENHANCE_MAX_PROMPT_CHARS:
+            raise PromptRejected(f"Prompt too long (max {ENHANCE_MAX_PROMPT_CHARS} characters)")
+        return normalize_prompt(prompt)
+
+    def _enhance_one(self, prompt):
+        return self.client.generate_text(ENHANCEMENT_INSTRUCTION.format(prompt=prompt.strip()))
+
+    def _enhance_pack(self, prompts):
+        if len(prompts) == 1:
+            return [self._enhance_one(prompts[0])]
+
+        answer = self.client.generate_text(
+            BATCH_INSTRUCTION.format(prompts=json.dumps([p.strip() for p in prompts], ensure_ascii=False))
+        )
+        enhanced = self._parse_pack(answer, len(prompts))
+        if enhanced is None:
+            log.warning("Unusable batch enhancement answer for %d prompts, enhancing one by one", len(prompts))
+            return [self._enhance_one(prompt) for prompt in prompts]
+        return enhanced
+
+    @staticmethod
+    def _parse_pack(answer, expected):
+        """The JSON array of strings in answer, or None if it isn't one of the right length."""
+        try:
+            items = json.loads(_CODE_FENCE.sub("", answer.strip()))
+        except ValueError:
+            return None
+        if not isinstance(items, list) or len(items) != expected:
+            return None
+        if not all(isinstance(item, str) and item.strip() for item in items):
+            return None
+        return [item.strip() for item in items]
@@ -0,0 +1,221 @@
+# =============================================================================
+# Generation Result Cache
+# =============================================================================
+# Users resubmit the same prompt/style or the same face+specs pair a lot.
+# Every generation is keyed on:
+#   tool name + fully formatted SYSTEM_PROMPTS text + aspect + style
+#   + SHA-256 of each input image
+# and the output file in generated/ is reused for the same key instead of
+# calling Gemini again.
+#
+#   - in-memory LRU in front (no DB hit for hot keys)
+#   - "result_cache" table as the durable index
+#   - eviction by age (RESULT_CACHE_MAX_AGE_DAYS) and total size
+#     (RESULT_CACHE_MAX_MB), least recently used first; it drops index rows,
+#     the files go with the storage sweeper once no history row uses them
+#   - hit / miss counters (stats())
+
+import os
+import shutil
+import hashlib
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from lru import LRUCache
+from models import db, CachedResult
+
+log = logging.getLogger(__name__)
+
+RESULT_CACHE_MEMORY_ENTRIES = int(os.environ.get("RESULT_CACHE_MEMORY_ENTRIES", 1024))
+RESULT_CACHE_MAX_MB = int(os.environ.get("RESULT_CACHE_MAX_MB", 2048))
+RESULT_CACHE_MAX_AGE_DAYS = int(os.environ.get("RESULT_CACHE_MAX_AGE_DAYS", 30))
+RESULT_CACHE_EVICT_EVERY = int(os.environ.get("RESULT_CACHE_EVICT_EVERY", 50))   # puts between eviction passes
+
+# A memory hit only writes last_used_at back to the DB this often
+TOUCH_INTERVAL = timedelta(minutes=5)
+
+CHUNK_SIZE = 64 * 1024
+
+
+def file_digest(path):
+    """SHA-256 hex digest of a file, read in chunks."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ResultCache:
+    def __init__(self, directory,
+                 memory_entries=RESULT_CACHE_MEMORY_ENTRIES,
+                 max_bytes=RESULT_CACHE_MAX_MB * 1024 * 1024,
+                 max_age=timedelta(days=RESULT_CACHE_MAX_AGE_DAYS)):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._memory = LRUCache(maxsize=memory_entries)    # key -> (filename, last_synced)
+        self._lock = threading.Lock()
+        self._puts = 0
+        self.hits = 0
+        self.misses = 0
+
+    # ---------------- KEYS ----------------
+
+    @staticmethod
+    def make_key(tool_name, final_prompt, aspect=None, style=None, input_digests=()):
+        h = hashlib.sha256()
+        for part in (tool_name, final_prompt, aspect or "", style or "", *input_digests):
+            h.update(part.encode("utf-8"))
+            h.update(b"\0")
+        return h.hexdigest()
+
+    # ---------------- LOOKUP ----------------
+
+    def get(self, key):
+        """Return the cached output filename (inside directory) or None."""
+        now = datetime.utcnow()
+
+        cached = self._memory.get(key)
+        if cached:
+            filename, last_synced = cached
+            if os.path.exists(os.path.join(self.directory, filename)):
+                if now - last_synced > TOUCH_INTERVAL:
+                    self._touch(key, now)
+                    self._memory.set(key, (filename, now))
+                self._count(hit=True)
+                return filename
+            self._memory.pop(key)
+
+        entry = db.session.get(CachedResult, key)
+        if entry and entry.created_at and now - entry.created_at > self.max_age:
+            entry = None
+        if entry and not os.path.exists(os.path.join(self.directory, entry.filename)):
+            db.session.delete(entry)
+            db.session.commit()
+            entry = None
+
+        if not entry:
+            self._count(hit=False)
+            return None
+
+        entry.hits += 1
+        entry.last_used_at = now
+        db.session.commit()
+
+        self._memory.set(key, (entry.filename, now))
+        self._count(hit=True)
+        return entry.filename
+
+    def put(self, key, tool_name, output_path):
+        """
+        Record output_path as the result for key and return its filename.
+        Files are stored under their own SHA-256 so identical outputs share
+        one file and a later generation can't overwrite a cached one.
+        """
+        digest = file_digest(output_path)
+        ext = os.path.splitext(output_path)[1] or ".png"
+        filename = f"{digest}{ext}"
+        target = os.path.join(self.directory, filename)
+
+        if os.path.abspath(output_path) != os.path.abspath(target) and not os.path.exists(target):
+            tmp = f"{target}.{threading.get_ident()}.tmp"
+            shutil.copyfile(output_path, tmp)
+            os.replace(tmp, target)
+        else:
+            # May have been an orphan until now: restart the storage sweeper's grace period
+            os.utime(target)
+
+        for attempt in range(2):
+            entry = db.session.get(CachedResult, key) or CachedResult(key=key, hits=0)
+            entry.tool_name = tool_name
+            entry.filename = filename
+            entry.size = os.path.getsize(target)
+            entry.created_at = entry.last_used_at = datetime.utcnow()
+            db.session.add(entry)
+            try:
+                db.session.commit()
+                break
+            except IntegrityError:
+                # Another worker stored the same key first (e.g. duplicate
+                # items in a batch); update its row instead
+                db.session.rollback()
+                if attempt:
+                    raise
+
+        self._memory.set(key, (filename, entry.last_used_at))
+
+        with self._lock:
+            self._puts += 1
+            run_eviction = self._puts % RESULT_CACHE_EVICT_EVERY == 0
+        if run_eviction:
+            self.evict()
+
+        return filename
+
+    # ---------------- EVICTION ----------------
+
+    def evict(self):
+        """Drop entries older than max_age, then LRU entries until under max_bytes."""
+        expired = CachedResult.query.filter(
+            CachedResult.created_at < datetime.utcnow() - self.max_age
+        ).all()
+        removed = self._remove(expired)
+
+        total = db.session.query(func.coalesce(func.sum(CachedResult.size), 0)).scalar()
+        if total > self.max_bytes:
+            victims = []
+            for entry in CachedResult.query.order_by(CachedResult.last_used_at.asc()).yield_per(200):
+                if total <= self.max_bytes:
+                    break
+                victims.append(entry)
+                total -= entry.size
+            removed += self._remove(victims)
+
+        if removed:
+            log.info("Result cache evicted %d entries", removed)
+        return removed
+
+    def _remove(self, entries):
+        # Only the index rows go. History rows may still show the file, so
+        # deleting files is left to the storage sweeper (storage_gc.py),
+        # which removes them once nothing references them.
+        if not entries:
+            return 0
+
+        for entry in entries:
+            self._memory.pop(entry.key)
+            db.session.delete(entry)
+        db.session.commit()
+        return len(entries)
+
+    # ---------------- STATS ----------------
+
+    def _touch(self, key, now):
+        CachedResult.query.filter_by(key=key).update(
+            {CachedResult.last_used_at: now, CachedResult.hits: CachedResult.hits + 1},
+            synchronize_session=False
+        )
+        db.session.commit()
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+            "memory_entries": len(self._memory),
+            "disk_entries": CachedResult.query.count(),
+            "disk_bytes": db.session.query(func.coalesce(func.sum(CachedResult.size), 0)).scalar()
+        }
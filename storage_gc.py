@@ -0,0 +1,482 @@
+# =============================================================================
+# Storage Retention / Orphan Sweeper
+# =============================================================================
+# Deleting a history row only ever removed the row, and the legacy folders
+# (outputs/, static/uploads, static/outputs) aren't referenced by anything,
+# so disk use only grew. A background pass every GC_INTERVAL seconds:
+#
+#   1. collects the files still referenced: assets linked to a history row
+#      (asset_index.py), plus result_cache
+#   2. walks the managed folders and removes files nothing references once
+#      they are older than GC_GRACE_HOURS (uploads waiting for their job and
+#      rows still in the history write-behind buffer are younger than that)
+#   3. enforces the storage quotas, if set: a user over GC_USER_QUOTA_MB
+#      loses their oldest history rows until back under it, and once the
+#      files history rows use pass GC_TOTAL_QUOTA_MB the oldest rows of
+#      everyone go (together with the result cache entries of their
+#      outputs). Files left unreferenced are removed right away. Outputs
+#      only the result cache holds are bounded by RESULT_CACHE_MAX_MB
+#      instead. Eviction stops early once a batch of rows frees nothing.
+#   4. drops thumbnails / prepared inputs whose source file is gone
+#
+# Everything runs in batches of GC_BATCH_SIZE rows or files, with a
+# GC_BATCH_PAUSE sleep in between and one short transaction per batch, so
+# a pass never holds the database write lock or a core for long. Only one
+# process per instance folder sweeps at a time (a lock file).
+#
+# Content-addressed files are shared, so a new upload or result can point
+# at a file that was an orphan a moment ago. UploadStore / ResultCache
+# refresh the file's mtime when that happens, which restarts its grace.
+#
+#   flask --app app gc --dry-run      # report what a pass would remove
+
+import os
+import time
+import logging
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, exists, distinct, type_coerce, String
+
+import metrics
+from models import db, History, Asset, HistoryAsset, CachedResult
+from asset_index import ASSET_ROOTS, normalize_ref
+from upload_store import UploadStore
+from thumbnails import SIZE_CLASSES
+
+try:
+    import fcntl
+except ImportError:          # no lock file on Windows; run one process there
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+GC_ENABLED = os.environ.get("GC_ENABLED", "1") == "1"
+GC_INTERVAL = float(os.environ.get("GC_INTERVAL", 3600))
+GC_START_DELAY = float(os.environ.get("GC_START_DELAY", 300))
+GC_GRACE_HOURS = float(os.environ.get("GC_GRACE_HOURS", 24))
+GC_BATCH_SIZE = int(os.environ.get("GC_BATCH_SIZE", 500))
+GC_BATCH_PAUSE = float(os.environ.get("GC_BATCH_PAUSE", 0.05))
+GC_USER_QUOTA_MB = float(os.environ.get("GC_USER_QUOTA_MB", 0))       # 0 = no quota
+GC_TOTAL_QUOTA_MB = float(os.environ.get("GC_TOTAL_QUOTA_MB", 0))     # 0 = no quota
+
+GC_REMOVED_FILES = metrics.counter("imageworks_gc_removed_files_total",
+                                   "Files removed by the storage sweeper.", ["reason"])
+GC_REMOVED_BYTES = metrics.counter("imageworks_gc_removed_bytes_total",
+                                   "Bytes removed by the storage sweeper.", ["reason"])
+GC_EVICTED_ROWS = metrics.counter("imageworks_gc_evicted_history_total",
+                                  "History rows removed to enforce a storage quota.", ["quota"])
+
+INCOMING_PREFIX = ".incoming-"      # UploadStore temp files
+
+
+class StorageGC:
+    def __init__(self, cache_root="generated", thumbnails=None, preprocessor=None,
+                 grace=timedelta(hours=GC_GRACE_HOURS), batch_size=GC_BATCH_SIZE,
+                 batch_pause=GC_BATCH_PAUSE, user_quota_mb=GC_USER_QUOTA_MB,
+                 total_quota_mb=GC_TOTAL_QUOTA_MB, interval=GC_INTERVAL, enabled=GC_ENABLED):
+        """
+        Sweeps the folders in asset_index.ASSET_ROOTS. result_cache filenames
+        live under cache_root. thumbnails / preprocessor are the services
+        whose derived files follow their sources.
+        """
+        self.roots = ASSET_ROOTS
+        self.cache_root = cache_root
+        self.thumbnails = thumbnails
+        self.preprocessor = preprocessor
+        self.grace = grace
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.user_quota = int(user_quota_mb * 1024 * 1024)
+        self.total_quota = int(total_quota_mb * 1024 * 1024)
+        self.interval = interval
+        self.enabled = enabled
+        self.app = None
+        self.last_run = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def init_app(self, app, background=True):
+        """Bind to the first app; start the sweeper thread once per process when background."""
+        if self.app is None:
+            self.app = app
+        if background and self._thread is None and self.enabled and self.interval > 0:
+            self._thread = threading.Thread(target=self._loop, name="storage-gc", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def stats(self):
+        return {"enabled": self.enabled, "last_run": self.last_run}
+
+    # ---------------- PASS ----------------
+
+    def run(self, dry_run=False):
+        """One full pass (needs an app context). Returns a summary dict."""
+        started = time.perf_counter()
+        summary = {"dry_run": dry_run, "orphans": 0, "orphan_bytes": 0, "quota_files": 0,
+                   "quota_bytes": 0, "evicted_rows": 0, "derived": 0}
+
+        linked, cached = self._referenced()
+        files = self._collect_files()
+        summary["files"] = len(files)
+        summary["bytes"] = sum(size for _, size, _ in files.values())
+
+        # 2. Orphans past the grace period
+        cutoff = time.time() - self.grace.total_seconds()
+        for batch in _batches([ref for ref in files if ref not in linked and ref not in cached], self.batch_size):
+            removed = []
+            for ref in batch:
+                path, size, mtime = files[ref]
+                if mtime < cutoff and _mtime(path) < cutoff:     # re-checked: it may just have been reused
+                    self._remove(ref, path, size, "orphan", dry_run)
+                    removed.append(ref)
+                    del files[ref]
+                    summary["orphans"] += 1
+                    summary["orphan_bytes"] += size
+            self._forget_assets(removed, dry_run)
+            self._pause()
+
+        # 3. Quotas
+        links = {}      # asset_id -> history rows still linking it, shared by the evictions below
+        if self.user_quota:
+            for user_id, usage in self._users_over_quota():
+                self._evict(summary, files, cached, links, dry_run,
+                            user_id=user_id, excess=usage - self.user_quota)
+        if self.total_quota:
+            # Only files history rows use can be freed by evicting rows
+            total = sum(size for ref, (_, size, _) in files.items() if ref in linked)
+            if total > self.total_quota:
+                self._evict(summary, files, cached, links, dry_run, excess=total - self.total_quota)
+        self._prune_assets(files, dry_run)
+
+        # 4. Derived files of sources that are gone
+        summary["derived"] += self._sweep_derived(files, cutoff, dry_run)
+
+        summary["seconds"] = round(time.perf_counter() - started, 3)
+        summary["finished_at"] = datetime.utcnow().isoformat(timespec="seconds")
+        if not dry_run:
+            self.last_run = summary
+        return summary
+
+    def _referenced(self):
+        """(refs of assets linked to a history row, refs held by the result cache)"""
+        linked_refs, cached = set(), set()
+
+        linked = exists().where(HistoryAsset.asset_id == Asset.id)
+        last_id = 0
+        while True:
+            rows = (db.session.query(Asset.id, Asset.path).filter(Asset.id > last_id, linked)
+                    .order_by(Asset.id).limit(self.batch_size).all())
+            if not rows:
+                break
+            linked_refs.update(row.path for row in rows)
+            last_id = rows[-1].id
+            db.session.rollback()       # end the read transaction between batches
+            self._pause()
+
+        last_key = ""
+        while True:
+            rows = (db.session.query(CachedResult.key, CachedResult.filename)
+                    .filter(CachedResult.key > last_key).order_by(CachedResult.key)
+                    .limit(self.batch_size).all())
+            if not rows:
+                break
+            cached.update(f"{self.cache_root}/{row.filename}" for row in rows)
+            last_key = rows[-1].key
+            db.session.rollback()
+            self._pause()
+
+        return linked_refs, cached
+
+    def _collect_files(self):
+        """ref -> (path, size, mtime) for every file in the managed folders."""
+        files = {}
+        seen = 0
+        for prefix, root in self.roots.items():
+            for dirpath, dirnames, filenames in os.walk(root):
+                # A managed folder nested in another one (static/uploads in static) is walked on its own
+                dirnames[:] = [d for d in dirnames
+                               if os.path.join(dirpath, d) not in self.roots.values() and not d.startswith(".")]
+                for name in filenames:
+                    if name.startswith(".") and not name.startswith(INCOMING_PREFIX):
+                        continue            # .gitkeep and friends
+                    path = os.path.join(dirpath, name)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    rel = os.path.relpath(path, root).replace(os.sep, "/")
+                    files[f"{prefix}/{rel}"] = (path, st.st_size, st.st_mtime)
+                    seen += 1
+                    if seen % self.batch_size == 0:
+                        self._pause()
+        return files
+
+    # ---------------- QUOTAS ----------------
+
+    def _users_over_quota(self):
+        """[(user_id, bytes)] of users whose rows point at more than user_quota bytes."""
+        per_user = (db.session.query(History.user_id, HistoryAsset.asset_id)
+                    .join(HistoryAsset, HistoryAsset.history_id == History.id)
+                    .distinct().subquery())
+        usage = func.coalesce(func.sum(Asset.size), 0)
+        rows = (db.session.query(per_user.c.user_id, usage)
+                .join(Asset, Asset.id == per_user.c.asset_id)
+                .group_by(per_user.c.user_id)
+                .having(usage > self.user_quota).all())
+        db.session.rollback()
+        return [(row[0], row[1]) for row in rows]
+
+    def _evict(self, summary, files, cached, links, dry_run, excess, user_id=None):
+        """Delete the oldest history rows (of user_id, or of everyone) until excess bytes are freed."""
+        quota = "user" if user_id is not None else "total"
+        freed = 0
+        last = None          # (created_at, id) keyset
+        # created_at is compared as stored text, as in get_history (rows hold
+        # both "YYYY-MM-DD HH:MM:SS" and "... .ffffff" timestamps)
+        created_raw = func.coalesce(type_coerce(History.created_at, String), "")
+        user_links = {}      # asset_id -> rows of user_id linking it, counted down as rows go
+
+        while freed < excess:
+            query = db.session.query(History.id, created_raw.label("created"))
+            if user_id is not None:
+                query = query.filter(History.user_id == user_id)
+            if last is not None:
+                query = query.filter((created_raw > last[0]) | ((created_raw == last[0]) & (History.id > last[1])))
+            rows = query.order_by(created_raw, History.id).limit(self.batch_size).all()
+            if not rows:
+                break
+            last = (rows[-1].created, rows[-1].id)
+
+            assets = self._row_assets([row.id for row in rows])
+            seen = {asset_id for row_assets in assets.values() for asset_id, _, _ in row_assets}
+            links.update(self._link_counts(seen - set(links)))
+            if user_id is not None:
+                user_links.update(self._link_counts(seen - set(user_links), user_id))
+
+            freed_before = freed
+            evicted, unlinked, counted = [], [], []
+            for row in rows:
+                if freed >= excess:
+                    break
+                evicted.append(row.id)
+                for asset_id, ref, size in assets.get(row.id, ()):
+                    counted.append(asset_id)
+                    links[asset_id] -= 1
+                    if user_id is not None:
+                        user_links[asset_id] -= 1
+                        if user_links[asset_id] == 0:
+                            freed += size or 0
+                    if links[asset_id] == 0:
+                        unlinked.append((asset_id, ref))
+
+            dropped_cache, removed = [], []
+            for asset_id, ref in unlinked:
+                if ref in cached:
+                    if user_id is not None:
+                        continue        # the result cache holds it; other users can still be served it
+                    dropped_cache.append(ref.split("/", 1)[1])
+                    cached.discard(ref)
+                removed.append(ref)
+                if ref in files:
+                    path, size, _ = files.pop(ref)
+                    self._remove(ref, path, size, "quota", dry_run)
+                    summary["quota_files"] += 1
+                    summary["quota_bytes"] += size
+                    if user_id is None:
+                        freed += size
+
+            if not removed and freed == freed_before:
+                # Their files are shared with rows that stay (or held by the
+                # cache); evicting older and older rows wouldn't help either.
+                # The rows stay, so do their links.
+                for asset_id in counted:
+                    links[asset_id] += 1
+                    if user_id is not None:
+                        user_links[asset_id] += 1
+                db.session.rollback()
+                break
+            summary["evicted_rows"] += len(evicted)
+            if not dry_run and evicted:
+                # history_assets rows go with them (ON DELETE CASCADE)
+                db.session.query(History).filter(History.id.in_(evicted)).delete(synchronize_session=False)
+                if dropped_cache:
+                    db.session.query(CachedResult).filter(CachedResult.filename.in_(dropped_cache)) \
+                        .delete(synchronize_session=False)
+                db.session.commit()
+                GC_EVICTED_ROWS.inc(quota, amount=len(evicted))
+            else:
+                db.session.rollback()
+            self._forget_assets(removed, dry_run)
+            self._pause()
+
+        if summary["evicted_rows"]:
+            log.info("Storage quota (%s%s): evicted history rows, freed %d bytes",
+                     quota, f" {user_id}" if user_id is not None else "", freed)
+
+    def _row_assets(self, history_ids):
+        """{history_id: [(asset_id, path, size)]} (an index lookup per row)."""
+        assets = defaultdict(list)
+        rows = (db.session.query(HistoryAsset.history_id, Asset.id, Asset.path, Asset.size)
+                .join(Asset, Asset.id == HistoryAsset.asset_id)
+                .filter(HistoryAsset.history_id.in_(history_ids)).all())
+        for history_id, asset_id, path, size in rows:
+            if all(asset_id != seen for seen, _, _ in assets[history_id]):    # same file in two roles
+                assets[history_id].append((asset_id, path, size))
+        return assets
+
+    def _link_counts(self, asset_ids, user_id=None):
+        """{asset_id: number of history rows (of user_id) linking it}."""
+        if not asset_ids:
+            return {}
+        query = (db.session.query(HistoryAsset.asset_id, func.count(distinct(HistoryAsset.history_id)))
+                 .filter(HistoryAsset.asset_id.in_(asset_ids)))
+        if user_id is not None:
+            query = query.join(History, History.id == HistoryAsset.history_id).filter(History.user_id == user_id)
+        counts = dict(query.group_by(HistoryAsset.asset_id).all())
+        return {asset_id: counts.get(asset_id, 0) for asset_id in asset_ids}
+
+    def _prune_assets(self, files, dry_run):
+        """Drop asset rows nothing links whose file is gone (e.g. evicted from the result cache)."""
+        unlinked = ~exists().where(HistoryAsset.asset_id == Asset.id)
+        last_id = 0
+        while True:
+            rows = (db.session.query(Asset.id, Asset.path).filter(Asset.id > last_id, unlinked)
+                    .order_by(Asset.id).limit(self.batch_size).all())
+            if not rows:
+                break
+            last_id = rows[-1].id
+            self._forget_assets([row.path for row in rows if row.path not in files], dry_run)
+            db.session.rollback()
+            self._pause()
+
+    def _forget_assets(self, refs, dry_run):
+        """Drop the asset rows of removed files that no history row links any more."""
+        if dry_run or not refs:
+            return
+        unlinked = ~exists().where(HistoryAsset.asset_id == Asset.id)
+        db.session.query(Asset).filter(Asset.path.in_(refs), unlinked).delete(synchronize_session=False)
+        db.session.commit()
+
+    # ---------------- REMOVAL ----------------
+
+    def _remove(self, ref, path, size, reason, dry_run):
+        if dry_run:
+            return
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        GC_REMOVED_FILES.inc(reason)
+        GC_REMOVED_BYTES.inc(reason, amount=size)
+        self._remove_derived(ref)
+
+    def _remove_derived(self, ref):
+        if self.thumbnails is not None and self.thumbnails.normalize_ref(ref):
+            for size in SIZE_CLASSES:
+                _unlink(self.thumbnails.thumb_path(ref, size))
+        if self.preprocessor is not None and ref.startswith("uploads/"):
+            digest = UploadStore.digest_of(ref)
+            if digest:
+                for name in _listdir(os.path.join(self.preprocessor.cache_dir, digest[:2])):
+                    if name.startswith(f"{digest}-"):
+                        _unlink(os.path.join(self.preprocessor.cache_dir, digest[:2], name))
+
+    def _sweep_derived(self, files, cutoff, dry_run):
+        """Thumbnails / prepared inputs left behind by sources removed some other way."""
+        removed = 0
+
+        if self.thumbnails is not None:
+            for size in SIZE_CLASSES:
+                base = os.path.join(self.thumbnails.out_dir, size)
+                for path, mtime in _walk_files(base):
+                    # thumbnails/<size>/<ref>.<fmt>
+                    ref = os.path.splitext(os.path.relpath(path, base).replace(os.sep, "/"))[0]
+                    if ref not in files and mtime < cutoff and normalize_ref(ref):
+                        removed += 1
+                        if not dry_run:
+                            _unlink(path)
+
+        if self.preprocessor is not None:
+            digests = {UploadStore.digest_of(ref) for ref in files if ref.startswith("uploads/")}
+            for path, mtime in _walk_files(self.preprocessor.cache_dir):
+                digest = os.path.basename(path).split("-", 1)[0]
+                if digest not in digests and mtime < cutoff:
+                    removed += 1
+                    if not dry_run:
+                        _unlink(path)
+
+        return removed
+
+    # ---------------- BACKGROUND ----------------
+
+    def _loop(self):
+        if self._stopped.wait(GC_START_DELAY):
+            return
+        while not self._stopped.is_set():
+            try:
+                self.run_locked()
+            except Exception:
+                log.exception("Storage sweep failed")
+            self._stopped.wait(self.interval)
+
+    def run_locked(self, dry_run=False):
+        """run() unless another process sharing the instance folder is sweeping; then None."""
+        os.makedirs(self.app.instance_path, exist_ok=True)
+        with open(os.path.join(self.app.instance_path, "storage-gc.lock"), "w") as lock:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return None
+            with self.app.app_context():
+                try:
+                    summary = self.run(dry_run=dry_run)
+                finally:
+                    db.session.remove()
+        if summary["orphans"] or summary["quota_files"] or summary["evicted_rows"]:
+            log.info("Storage sweep: %s", summary)
+        return summary
+
+    def _pause(self):
+        if self.batch_pause:
+            time.sleep(self.batch_pause)
+
+
+def _batches(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except FileNotFoundError:
+        return float("inf")
+
+
+def _listdir(path):
+    try:
+        return os.listdir(path)
+    except FileNotFoundError:
+        return []
+
+
+def _walk_files(root):
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            try:
+                yield path, os.path.getmtime(path)
+            except FileNotFoundError:
+                continue
+
+
+def _unlink(path):
+    try:
+        os.remove(path)
+    except (FileNotFoundError, TypeError):
+        pass
@@ -0,0 +1,47 @@
+import os
+
+import pytest
+
+import assets
+from assets import AssetServer
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.setattr(assets, "MUTABLE_METADATA_TTL", 0)
+    (tmp_path / "legacy.png").write_bytes(b"first version")
+    server = AssetServer({"generated": str(tmp_path)})
+    server.hashed = []
+    hash_file = server._hash_file
+
+    def counting_hash(path):
+        server.hashed.append(path)
+        return hash_file(path)
+
+    server._hash_file = counting_hash
+    return server
+
+
+def test_unchanged_file_is_not_rehashed(server):
+    first = server.metadata("generated", "legacy.png")
+    again = server.metadata("generated", "legacy.png")
+    assert again.etag == first.etag
+    assert len(server.hashed) == 1
+
+
+def test_changed_file_is_rehashed(server, tmp_path):
+    first = server.metadata("generated", "legacy.png")
+    path = tmp_path / "legacy.png"
+    path.write_bytes(b"second version, longer")
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1))
+
+    changed = server.metadata("generated", "legacy.png")
+    assert changed.etag != first.etag
+    assert changed.size == len(b"second version, longer")
+    assert len(server.hashed) == 2
+
+
+def test_deleted_file_is_forgotten(server, tmp_path):
+    server.metadata("generated", "legacy.png")
+    os.remove(tmp_path / "legacy.png")
+    assert server.metadata("generated", "legacy.png") is None
@@ -0,0 +1,106 @@
+import socket
+import threading
+import time
+
+import pytest
+from flask import Flask
+
+from events import EventBroker
+from events_server import EventServer, AUTH_WORKERS
+
+TOKENS = {"alice-token": 1, "bob-token": 2}
+
+
+@pytest.fixture
+def broker():
+    return EventBroker(backend="memory")
+
+
+@pytest.fixture
+def server(broker):
+    server = EventServer(broker, TOKENS.get, host="127.0.0.1", port=0, heartbeat=0.2, max_duration=30)
+    server.init_app(Flask(__name__))
+    assert server.ensure_started()
+    return server
+
+
+def connect(server, token, last_event_id=None):
+    sock = socket.create_connection(("127.0.0.1", server.port), timeout=5)
+    extra = f"Last-Event-ID: {last_event_id}\r\n" if last_event_id is not None else ""
+    sock.sendall(f"GET /api/events?token={token} HTTP/1.1\r\nHost: test\r\n{extra}\r\n".encode())
+    return sock
+
+
+def read_until(sock, marker):
+    data = b""
+    while marker.encode() not in data:
+        chunk = sock.recv(65536)
+        assert chunk, data
+        data += chunk
+    return data.decode()
+
+
+def wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def event_names(text):
+    return [line.split(": ", 1)[1] for line in text.split("\n") if line.startswith("event: ")]
+
+
+def test_idle_subscribers_share_one_thread(server, broker):
+    threads = threading.active_count()
+    socks = [connect(server, "alice-token") for _ in range(200)]
+    wait_for(lambda: server.subscriber_count() == 200)
+    assert threading.active_count() <= threads + AUTH_WORKERS
+
+    broker.publish(1, "done", {"job_id": "j1"})
+    for sock in socks:
+        assert event_names(read_until(sock, "event: done")) == ["done"]
+        sock.close()
+    wait_for(lambda: server.subscriber_count() == 0)
+
+
+def test_events_go_to_their_user_only(server, broker):
+    alice, bob = connect(server, "alice-token"), connect(server, "bob-token")
+    wait_for(lambda: server.subscriber_count() == 2)
+
+    broker.publish(2, "queued", {"job_id": "b"})
+    broker.publish(1, "queued", {"job_id": "a"})
+    broker.publish(1, "done", {"job_id": "a"})
+
+    assert event_names(read_until(alice, "event: done")) == ["queued", "done"]
+    text = read_until(bob, "event: queued")
+    assert '"job_id": "b"' in text and '"job_id": "a"' not in text
+
+
+def test_resume_from_last_event_id(server, broker):
+    first = broker.publish(1, "queued", {})
+    broker.publish(1, "running", {})
+    broker.publish(1, "done", {})
+
+    text = read_until(connect(server, "alice-token", first), "event: done")
+    assert event_names(text) == ["running", "done"]
+
+    text = read_until(connect(server, "alice-token", 10 ** 6), "event: reset")
+    assert event_names(text) == ["reset"]
+
+
+def test_heartbeat(server):
+    sock = connect(server, "alice-token")
+    assert "text/event-stream" in read_until(sock, ": keep-alive")
+
+
+def test_bad_token(server):
+    sock = connect(server, "nope")
+    assert read_until(sock, "\r\n").startswith("HTTP/1.1 401")
+
+
+def test_cors_preflight(server):
+    sock = socket.create_connection(("127.0.0.1", server.port), timeout=5)
+    sock.sendall(b"OPTIONS /api/events HTTP/1.1\r\nHost: test\r\n\r\n")
+    text = read_until(sock, "\r\n\r\n")
+    assert text.startswith("HTTP/1.1 204") and "Last-Event-ID" in text
@@ -0,0 +1,117 @@
+import os
+import base64
+import hashlib
+
+import pytest
+
+from inline_image import save_inline_image, InlineImageError
+
+# 0xff / 0xfb bytes make plenty of "/" and "+" in the base64
+IMAGE = b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 20 + b"\xff\xfb\xff" * 300
+
+
+def response_body(data=IMAGE, mime="image/png", escape_slashes=False, key="inlineData", mime_key="mimeType"):
+    encoded = base64.b64encode(data).decode()
+    if escape_slashes:
+        encoded = encoded.replace("/", "\\/")
+        mime = mime.replace("/", "\\/")
+    return (
+        '{"candidates": [{"content": {"parts": [{"text": "Here you go"}, '
+        f'{{"{key}": {{"{mime_key}": "{mime}", "data": "{encoded}"}}}}]}}}}], '
+        '"usageMetadata": {"totalTokenCount": 1290}}'
+    ).encode()
+
+
+def chunked(body, size):
+    return [body[i:i + size] for i in range(0, len(body), size)]
+
+
+def stray_files(directory):
+    return [name for name in os.listdir(directory) if name.startswith(".decoding-")]
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+# Odd sizes put the marker, the closing quote and every offset of a base64
+# quartet (and of a "\/" escape) across chunk edges
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 7, 13, 64, 65536])
+@pytest.mark.parametrize("escape_slashes", [False, True])
+def test_decodes_across_chunk_edges(tmp_path, chunk_size, escape_slashes):
+    body = response_body(escape_slashes=escape_slashes)
+
+    path, mime = save_inline_image(chunked(body, chunk_size), str(tmp_path))
+
+    assert mime == "image/png"
+    assert read(path) == IMAGE
+    assert os.path.basename(path) == f"{hashlib.sha256(IMAGE).hexdigest()}.png"
+    assert not stray_files(tmp_path)
+
+
+@pytest.mark.parametrize("size", range(1, 9))
+def test_every_padding_length(tmp_path, size):
+    data = b"\xff" * size
+    path, _ = save_inline_image(chunked(response_body(data), 3), str(tmp_path))
+    assert read(path) == data
+
+
+def test_escaped_mime_type_and_snake_case_keys(tmp_path):
+    body = response_body(mime="image/jpeg", escape_slashes=True, key="inline_data", mime_key="mime_type")
+    path, mime = save_inline_image(chunked(body, 10), str(tmp_path))
+    assert mime == "image/jpeg"
+    assert path.endswith(".jpg")
+    assert read(path) == IMAGE
+
+
+def test_no_inline_image(tmp_path):
+    body = b'{"candidates": [{"content": {"parts": [{"text": "I can\'t draw that"}]}}]}'
+    assert save_inline_image(chunked(body, 7), str(tmp_path)) is None
+
+
+def test_same_image_twice_shares_one_file(tmp_path):
+    first, _ = save_inline_image([response_body()], str(tmp_path))
+    second, _ = save_inline_image(chunked(response_body(), 100), str(tmp_path))
+    assert first == second
+    assert os.listdir(tmp_path) == [os.path.basename(first)]
+
+
+def test_large_image(tmp_path):
+    data = os.urandom(3 * 1024 * 1024)
+    path, _ = save_inline_image(chunked(response_body(data), 65536), str(tmp_path))
+    assert read(path) == data
+
+
+@pytest.mark.parametrize("keep", [0.1, 0.5, 0.99])
+def test_truncated_inside_data(tmp_path, keep):
+    body = response_body()
+    end = body.index(b'"data": "') + 9 + int(len(base64.b64encode(IMAGE)) * keep)
+    with pytest.raises(InlineImageError, match="Response ended inside the image data"):
+        save_inline_image(chunked(body[:end], 64), str(tmp_path))
+    assert not stray_files(tmp_path)
+
+
+def test_truncated_before_data(tmp_path):
+    body = response_body()
+    assert save_inline_image(chunked(body[:body.index(b'"data"')], 16), str(tmp_path)) is None
+
+
+def test_malformed_base64(tmp_path):
+    body = response_body().replace(b'"data": "', b'"data": "!!!!', 1)
+    with pytest.raises(InlineImageError, match="Malformed inline image data"):
+        save_inline_image(chunked(body, 64), str(tmp_path))
+    assert not stray_files(tmp_path)
+
+
+def test_rest_of_body_is_drained(tmp_path):
+    chunks = chunked(response_body(), 32)
+    consumed = []
+
+    def source():
+        for chunk in chunks:
+            consumed.append(chunk)
+            yield chunk
+
+    save_inline_image(source(), str(tmp_path))
+    assert len(consumed) == len(chunks)
@@ -0,0 +1,63 @@
+import io
+import os
+
+import pytest
+
+from thumbnails import ThumbnailService
+from upload_store import UploadStore
+
+Image = pytest.importorskip("PIL.Image")
+
+
+def png(size=(800, 600)):
+    out = io.BytesIO()
+    Image.new("RGB", size, (20, 120, 200)).save(out, format="PNG")
+    return out.getvalue()
+
+
+@pytest.fixture
+def store(tmp_path):
+    return UploadStore(str(tmp_path / "uploads"))
+
+
+@pytest.fixture
+def service(tmp_path, store):
+    return ThumbnailService(str(tmp_path / "thumbnails"), {"uploads": store.root})
+
+
+def upload(store, data):
+    incoming = store.begin()
+    incoming.write(data)
+    return incoming.commit("png")
+
+
+def leftovers(directory):
+    return [name for _, _, names in os.walk(directory) for name in names if name.endswith(".tmp")]
+
+
+def test_builds_thumbnail(service, store):
+    stored = upload(store, png())
+    path = service.ensure(stored.path, "sm")
+    with Image.open(path) as img:
+        assert max(img.size) == 160
+
+
+# Passes the upload parser's magic-byte check, but isn't an image
+@pytest.mark.parametrize("data", [
+    b"\x89PNG\r\n\x1a\n" + os.urandom(4096),
+    png()[:300],
+], ids=["garbage-body", "truncated"])
+def test_corrupt_upload_has_no_thumbnail(service, store, tmp_path, data):
+    stored = upload(store, data)
+
+    assert service.ensure(stored.path, "sm") is None
+    assert service.ensure(stored.path, "md") is None
+    assert not os.path.exists(service.thumb_path(stored.path, "sm"))
+    assert not leftovers(tmp_path / "thumbnails")
+
+
+def test_corrupt_upload_skips_ready_callback(service, store):
+    stored = upload(store, b"\x89PNG\r\n\x1a\n" + b"\x00" * 512)
+    ready = []
+    service._build_all(stored.path, on_ready=lambda **kw: ready.append(kw))
+    assert ready == []
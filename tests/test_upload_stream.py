@@ -0,0 +1,160 @@
+import os
+
+import pytest
+from flask import Flask
+
+import upload_stream
+from upload_stream import parse_upload_request, UploadRejected
+from upload_store import UploadStore
+
+BOUNDARY = "----imageworks-test-boundary"
+PNG = b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 40
+JPEG = b"\xff\xd8\xff\xe0" + b"\x00\x10JFIF" + b"\xab" * 5000
+ALLOWED = {"png", "jpg", "webp"}
+
+
+def multipart(*parts, close=True):
+    """Body with (name, value) text fields and (name, filename, bytes) file parts."""
+    body = b""
+    for part in parts:
+        body += f"--{BOUNDARY}\r\n".encode()
+        if len(part) == 2:
+            name, value = part
+            body += f'Content-Disposition: form-data; name="{name}"\r\n\r\n'.encode() + value.encode()
+        else:
+            name, filename, data = part
+            body += (f'Content-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f"Content-Type: application/octet-stream\r\n\r\n").encode() + data
+        body += b"\r\n"
+    if close:
+        body += f"--{BOUNDARY}--\r\n".encode()
+    return body
+
+
+@pytest.fixture
+def store(tmp_path):
+    return UploadStore(str(tmp_path / "uploads"))
+
+
+@pytest.fixture
+def parse(store):
+    app = Flask(__name__)
+
+    def parse(body, fields=("image",), **limits):
+        with app.test_request_context("/upload", method="POST", data=body,
+                                      content_type=f"multipart/form-data; boundary={BOUNDARY}"):
+            return parse_upload_request(store, fields, ALLOWED, **limits)
+    return parse
+
+
+def leftover_temp_files(store):
+    return [name for name in os.listdir(store.root) if name.startswith(".incoming-")]
+
+
+# Small chunks put the boundary, the part headers and the magic bytes
+# across chunk edges at every possible offset
+@pytest.mark.parametrize("chunk_size", [1, 5, 11, 64, upload_stream.CHUNK_SIZE])
+def test_boundary_split_across_chunks(parse, store, monkeypatch, chunk_size):
+    monkeypatch.setattr(upload_stream, "CHUNK_SIZE", chunk_size)
+    body = multipart(("prompt", "a red car"), ("image", "photo.bin", PNG), ("extra", "x.jpg", JPEG))
+
+    parsed = parse(body)
+
+    assert parsed.form == {"prompt": "a red car"}
+    assert list(parsed.files) == ["image"]
+    stored = parsed.files["image"]
+    assert stored.mime == "image/png"
+    assert stored.id.endswith(".png")
+    with open(stored.abs_path, "rb") as f:
+        assert f.read() == PNG
+    assert parsed.filenames == {"image": "photo.bin"}
+    assert not leftover_temp_files(store)
+
+
+def test_data_that_looks_like_a_boundary_is_kept(parse):
+    data = PNG + f"\r\n--{BOUNDARY}-not-quite".encode() + b"\x00" * 10
+    stored = parse(multipart(("image", "a.png", data))).files["image"]
+    with open(stored.abs_path, "rb") as f:
+        assert f.read() == data
+
+
+def test_type_comes_from_magic_bytes_not_filename(parse):
+    stored = parse(multipart(("image", "holiday.png", JPEG))).files["image"]
+    assert stored.id.endswith(".jpg")
+    assert stored.mime == "image/jpeg"
+
+
+@pytest.mark.parametrize("data", [b"GIF89a" + b"\x00" * 64, b"<svg xmlns='http://www.w3.org/2000/svg'/>", b"PK\x03\x04"])
+def test_non_image_rejected_by_magic_bytes(parse, store, data):
+    with pytest.raises(UploadRejected) as e:
+        parse(multipart(("image", "a.png", data)))
+    assert e.value.status == 415
+    assert not leftover_temp_files(store)
+
+
+def test_allowed_extensions_apply_to_sniffed_type(store):
+    app = Flask(__name__)
+    with app.test_request_context("/upload", method="POST", data=multipart(("image", "a.png", JPEG)),
+                                  content_type=f"multipart/form-data; boundary={BOUNDARY}"):
+        with pytest.raises(UploadRejected) as e:
+            parse_upload_request(store, ("image",), {"png"})
+    assert e.value.status == 415
+
+
+def test_empty_file_part_is_no_file(parse):
+    parsed = parse(multipart(("image", "", b""), ("prompt", "hi")))
+    assert parsed.files == {}
+    assert parsed.form == {"prompt": "hi"}
+
+
+def test_file_over_limit(parse, store, monkeypatch):
+    monkeypatch.setattr(upload_stream, "CHUNK_SIZE", 1024)
+    with pytest.raises(UploadRejected) as e:
+        parse(multipart(("image", "a.png", PNG)), max_file_bytes=len(PNG) - 1)
+    assert e.value.status == 413
+    assert not leftover_temp_files(store)
+
+
+def test_request_over_limit_by_content_length(parse):
+    body = multipart(("image", "a.png", PNG))
+    with pytest.raises(UploadRejected) as e:
+        parse(body, max_request_bytes=len(body) - 1)
+    assert e.value.status == 413
+
+
+def test_request_over_limit_without_content_length(store, monkeypatch):
+    # A chunked request has no Content-Length; the bytes read are counted instead
+    monkeypatch.setattr(upload_stream, "CHUNK_SIZE", 512)
+    body = multipart(("image", "a.png", PNG))
+    app = Flask(__name__)
+    with app.test_request_context("/upload", method="POST", data=body,
+                                  content_type=f"multipart/form-data; boundary={BOUNDARY}") as ctx:
+        ctx.request.environ.pop("CONTENT_LENGTH")
+        ctx.request.environ["wsgi.input_terminated"] = True
+        with pytest.raises(UploadRejected) as e:
+            parse_upload_request(store, ("image",), ALLOWED, max_request_bytes=len(body) // 2)
+    assert e.value.status == 413
+    assert not leftover_temp_files(store)
+
+
+def test_oversized_text_field(parse):
+    with pytest.raises(UploadRejected) as e:
+        parse(multipart(("prompt", "x" * (upload_stream.MAX_FIELD_BYTES + 1))))
+    assert e.value.status == 413
+
+
+@pytest.mark.parametrize("cut", [100, 1000, -len(f"\r\n--{BOUNDARY}--\r\n")])
+def test_truncated_body(parse, store, cut):
+    body = multipart(("image", "a.png", PNG))[:cut]
+    with pytest.raises(UploadRejected) as e:
+        parse(body)
+    assert e.value.status == 400
+    assert not leftover_temp_files(store)
+
+
+def test_not_multipart(store):
+    app = Flask(__name__)
+    with app.test_request_context("/upload", method="POST", data=b"{}", content_type="application/json"):
+        with pytest.raises(UploadRejected) as e:
+            parse_upload_request(store, ("image",), ALLOWED)
+    assert e.value.status == 400
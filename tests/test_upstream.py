@@ -0,0 +1,71 @@
+import pytest
+
+import upstream
+from upstream import GeminiClient, UpstreamError
+
+google_errors = pytest.importorskip("google.api_core.exceptions")
+
+
+class FakeTextModel:
+    """Raises or answers from a script, one entry per call."""
+
+    def __init__(self, *script):
+        self.script = list(script)
+        self.options = []
+
+    def generate_content(self, contents, request_options=None):
+        self.options.append(request_options)
+        answer = self.script.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return upstream._StubTextResponse(answer)
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(upstream, "UPSTREAM_BACKOFF_BASE", 0.001)
+    return GeminiClient(max_retries=2, read_timeout=7)
+
+
+def test_text_call_has_timeout_and_no_sdk_retries(client):
+    model = FakeTextModel(" enhanced ")
+    client.use_text_model(model)
+    assert client.generate_text("p") == "enhanced"
+    assert model.options == [{"timeout": 7, "retry": None}]
+
+
+def test_text_call_retries_429_and_5xx(client):
+    model = FakeTextModel(google_errors.ResourceExhausted("quota"), google_errors.ServiceUnavailable("down"), "ok")
+    client.use_text_model(model)
+    assert client.generate_text("p") == "ok"
+    assert len(model.options) == 3
+
+
+def test_text_call_gives_up_after_max_retries(client):
+    model = FakeTextModel(*[google_errors.ServiceUnavailable("down")] * 3)
+    client.use_text_model(model)
+    with pytest.raises(UpstreamError) as e:
+        client.generate_text("p")
+    assert e.value.status == 503
+    assert len(model.options) == 3
+
+
+@pytest.mark.parametrize("error, status", [
+    (google_errors.DeadlineExceeded("slow"), 504),
+    (google_errors.InvalidArgument("bad"), 400),
+    (ValueError("no text part"), 502),
+])
+def test_text_errors_not_retried(client, error, status):
+    model = FakeTextModel(error)
+    client.use_text_model(model)
+    with pytest.raises(UpstreamError) as e:
+        client.generate_text("p")
+    assert e.value.status == status
+    assert len(model.options) == 1
+
+
+def test_slot_released_on_unexpected_error(client):
+    client.use_text_model(FakeTextModel(KeyError("bug")))
+    with pytest.raises(KeyError):
+        client.generate_text("p")
+    assert client._slots.acquire(blocking=False)
@@ -0,0 +1,164 @@
+# =============================================================================
+# Thumbnails / Derivatives
+# =============================================================================
+# History cards only need small images, but used to load the full-size
+# output and input files. This service builds resized copies in fixed size
+# classes:
+#
+#   thumbnails/<size>/<root>/<path>.<fmt>     e.g. thumbnails/sm/generated/ab12...ef.png.webp
+#
+# They are built in the background as soon as an output / upload is
+# recorded, and on first request otherwise (then kept on disk).
+#
+# "refs" are what the app stores in History: "uploads/ab/cd/<digest>.png",
+# or a URL such as "http://127.0.0.1:5000/generated/<file>".
+
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from werkzeug.security import safe_join
+
+from upload_store import UploadStore
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:          # thumbnails are optional; originals are served instead
+    Image = ImageOps = None
+
+log = logging.getLogger(__name__)
+
+SIZE_CLASSES = {
+    "sm": 160,
+    "md": 480
+}
+
+THUMBNAIL_FORMAT = os.environ.get("THUMBNAIL_FORMAT", "webp").lower()     # webp | jpeg
+THUMBNAIL_QUALITY = int(os.environ.get("THUMBNAIL_QUALITY", 75))
+THUMBNAIL_WORKERS = int(os.environ.get("THUMBNAIL_WORKERS", 2))
+
+EXTENSIONS = {"webp": "webp", "jpeg": "jpg"}
+
+
+class ThumbnailService:
+    def __init__(self, out_dir, roots, public_base_url=""):
+        """roots maps the first path segment of a ref ("uploads", "generated") to its folder."""
+        self.out_dir = out_dir
+        self.roots = roots
+        self.public_base_url = public_base_url
+        self.ext = EXTENSIONS.get(THUMBNAIL_FORMAT, "webp")
+        self._executor = ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS, thread_name_prefix="thumbs")
+        self._lock = threading.Lock()
+        self._in_progress = set()
+
+    @property
+    def enabled(self):
+        return Image is not None
+
+    # ---------------- REFS / PATHS ----------------
+
+    def normalize_ref(self, ref):
+        """"http://host/generated/x.png" -> "generated/x.png"; None if not one of our files."""
+        if not ref or not isinstance(ref, str):
+            return None
+        path = urlparse(ref).path if "://" in ref else ref
+        path = path.lstrip("/")
+        root = path.split("/", 1)[0]
+        if root not in self.roots or "/" not in path:
+            return None
+        return path
+
+    def source_path(self, ref):
+        root, rel = ref.split("/", 1)
+        return safe_join(self.roots[root], rel)
+
+    def thumb_path(self, ref, size):
+        return safe_join(self.out_dir, size, f"{ref}.{self.ext}")
+
+    def thumb_urls(self, ref):
+        """{"sm": url, "md": url} for a ref, or None if it isn't one of our files."""
+        ref = self.normalize_ref(ref)
+        if not ref:
+            return None
+        return {size: f"{self.public_base_url}/thumbs/{size}/{ref}" for size in SIZE_CLASSES}
+
+    # ---------------- BUILD ----------------
+
+    def ensure(self, ref, size):
+        """Path of the thumbnail (built now if missing or stale), or None."""
+        ref = self.normalize_ref(ref)
+        if not ref or size not in SIZE_CLASSES or not self.enabled:
+            return None
+
+        source = self.source_path(ref)
+        target = self.thumb_path(ref, size)
+        if not source or not target or not os.path.isfile(source):
+            return None
+
+        try:
+            # Content-addressed sources (uploads/, generated/<sha256>) never
+            # change, and their mtime is bumped on reuse (storage_gc.py), so
+            # only legacy paths are checked for staleness
+            built = os.path.getmtime(target)
+            if UploadStore.digest_of(ref) or built >= os.path.getmtime(source):
+                return target
+        except OSError:
+            pass
+
+        if not self._build(source, target, SIZE_CLASSES[size]):
+            return None
+        return target
+
+    def _build(self, source, target, edge):
+        """False if Pillow can't read source (uploads are only checked by their magic bytes)."""
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp = f"{target}.{threading.get_ident()}.tmp"
+
+        try:
+            with Image.open(source) as img:
+                img = ImageOps.exif_transpose(img)
+                img.thumbnail((edge, edge))
+                if self.ext == "jpg" and img.mode not in ("RGB", "L"):
+                    img = img.convert("RGB")
+                elif img.mode == "P":
+                    img = img.convert("RGBA")
+                img.save(tmp, format=THUMBNAIL_FORMAT.upper(), quality=THUMBNAIL_QUALITY)
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            # UnidentifiedImageError and truncated data are OSErrors
+            log.warning("Cannot build thumbnail of %s: %s", source, e)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return False
+
+        os.replace(tmp, target)
+        return True
+
+    def schedule(self, refs, on_ready=None):
+        """
+        Build every size class for refs in the background. on_ready(ref=...,
+        thumbs={size: url}) is called once a ref's thumbnails are on disk.
+        """
+        if not self.enabled:
+            return
+        for ref in refs:
+            ref = self.normalize_ref(ref)
+            if not ref:
+                continue
+            with self._lock:
+                if ref in self._in_progress:
+                    continue
+                self._in_progress.add(ref)
+            self._executor.submit(self._build_all, ref, on_ready)
+
+    def _build_all(self, ref, on_ready=None):
+        try:
+            built = [self.ensure(ref, size) for size in SIZE_CLASSES]
+            if on_ready is not None and all(built):
+                on_ready(ref=ref, thumbs=self.thumb_urls(ref))
+        except Exception:
+            log.exception("Thumbnail build failed for %s", ref)
+        finally:
+            with self._lock:
+                self._in_progress.discard(ref)
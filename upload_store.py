@@ -0,0 +1,123 @@
+# =============================================================================
+# Content-Addressed Upload Store
+# =============================================================================
+# Uploads are stored once per SHA-256 digest in a sharded layout:
+#
+#   uploads/ab/cd/abcd1234...ef.png
+#
+# The id handed back ("ab/cd/abcd...ef.png") is stable, so re-uploading the
+# same screenshot gives the same id and History rows can share one file.
+# Two users uploading "image.png" can no longer overwrite each other.
+#
+# Every write goes through begin() / IncomingFile: upload_stream.py pushes
+# each multipart chunk in as it arrives, hashing while it writes a temp
+# file; commit() renames it into place, or drops it when that content is
+# already stored.
+
+import os
+import uuid
+import hashlib
+from collections import namedtuple
+
+EXTENSION_ALIASES = {"jpeg": "jpg"}
+
+MIME_TYPES = {
+    "png": "image/png",
+    "jpg": "image/jpeg",
+    "webp": "image/webp",
+    "gif": "image/gif"
+}
+
+# id:      path relative to the store root, e.g. "ab/cd/<digest>.png"
+# path:    path relative to the app folder, what History.input_image stores
+# existed: True when the content was already in the store
+StoredUpload = namedtuple("StoredUpload", "id digest path abs_path size mime existed")
+
+
+class UploadStore:
+    def __init__(self, root, url_prefix="uploads"):
+        self.root = root
+        self.url_prefix = url_prefix
+        os.makedirs(root, exist_ok=True)
+
+    # ---------------- PATHS ----------------
+
+    @staticmethod
+    def extension_for(filename):
+        ext = filename.rsplit(".", 1)[1].lower() if filename and "." in filename else "bin"
+        return EXTENSION_ALIASES.get(ext, ext)
+
+    @staticmethod
+    def make_id(digest, ext):
+        return f"{digest[:2]}/{digest[2:4]}/{digest}.{ext}"
+
+    def abs_path(self, upload_id):
+        return os.path.join(self.root, *upload_id.split("/"))
+
+    @staticmethod
+    def digest_of(path):
+        """Digest encoded in a store path, or None for legacy (non-store) paths."""
+        name = os.path.basename(path).split(".", 1)[0]
+        if len(name) == 64 and all(c in "0123456789abcdef" for c in name):
+            return name
+        return None
+
+    def _stored(self, digest, ext, existed):
+        upload_id = self.make_id(digest, ext)
+        abs_path = self.abs_path(upload_id)
+        if existed:
+            # Referenced again: restart the storage sweeper's grace period (storage_gc.py)
+            os.utime(abs_path)
+        return StoredUpload(
+            id=upload_id,
+            digest=digest,
+            path=f"{self.url_prefix}/{upload_id}",
+            abs_path=abs_path,
+            size=os.path.getsize(abs_path),
+            mime=MIME_TYPES.get(ext, "application/octet-stream"),
+            existed=existed
+        )
+
+    # ---------------- WRITES ----------------
+
+    def begin(self):
+        """Start a write (see IncomingFile); the only way files get into the store."""
+        return IncomingFile(self)
+
+
+class IncomingFile:
+    """
+    A file being written into the store chunk by chunk. Data goes to a temp
+    file while it is hashed; commit() renames it to its digest path (or
+    drops it if that digest is already stored), abort() throws it away.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.size = 0
+        self._hash = hashlib.sha256()
+        self._tmp_path = os.path.join(store.root, f".incoming-{uuid.uuid4().hex}")
+        self._file = open(self._tmp_path, "wb")
+
+    def write(self, chunk):
+        self._hash.update(chunk)
+        self._file.write(chunk)
+        self.size += len(chunk)
+
+    def commit(self, ext):
+        self._file.close()
+        digest = self._hash.hexdigest()
+        target = self.store.abs_path(self.store.make_id(digest, ext))
+
+        if os.path.exists(target):
+            os.remove(self._tmp_path)
+            return self.store._stored(digest, ext, existed=True)
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(self._tmp_path, target)
+        return self.store._stored(digest, ext, existed=False)
+
+    def abort(self):
+        self._file.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
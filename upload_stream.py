@@ -0,0 +1,209 @@
+# =============================================================================
+# Streaming Multipart Upload Parser
+# =============================================================================
+# request.files makes Werkzeug parse (and buffer) the whole multipart body
+# before the endpoint runs. For the upload endpoints we read request.stream
+# ourselves in CHUNK_SIZE pieces and push each file part straight into the
+# UploadStore, so memory per request stays flat whatever the upload size.
+#
+#   - per-file cap (MAX_UPLOAD_FILE_MB) and per-request cap (MAX_UPLOAD_REQUEST_MB)
+#   - the file type is sniffed from the magic bytes of the first chunk and
+#     non-images are rejected before the rest of the part is read
+#   - the stored extension comes from the sniffed type, not the filename
+#
+# Endpoints must not touch request.form / request.files before calling
+# parse_upload_request(), or Werkzeug will have consumed the stream already.
+
+import os
+from collections import namedtuple
+
+from flask import request
+from werkzeug.exceptions import RequestEntityTooLarge, ClientDisconnected
+from werkzeug.sansio.multipart import MultipartDecoder, NeedData, Field, File, Data, Epilogue
+
+import metrics
+
+CHUNK_SIZE = 64 * 1024
+SNIFF_BYTES = 12
+MAX_FIELD_BYTES = 64 * 1024
+
+MAX_UPLOAD_FILE_MB = int(os.environ.get("MAX_UPLOAD_FILE_MB", 15))
+MAX_UPLOAD_REQUEST_MB = int(os.environ.get("MAX_UPLOAD_REQUEST_MB", 40))
+MAX_UPLOAD_FILE_BYTES = MAX_UPLOAD_FILE_MB * 1024 * 1024
+MAX_UPLOAD_REQUEST_BYTES = MAX_UPLOAD_REQUEST_MB * 1024 * 1024
+
+UPLOAD_BYTES = metrics.counter("imageworks_upload_bytes_total",
+                               "Request body bytes read by the streaming upload parser.", ["route"])
+UPLOAD_FILE_BYTES = metrics.histogram("imageworks_upload_file_bytes",
+                                      "Size of stored upload files.", ["route"], metrics.SIZE_BUCKETS)
+UPLOADS_REJECTED = metrics.counter("imageworks_uploads_rejected_total",
+                                   "Uploads refused, by HTTP status.", ["route", "status"])
+
+# form:      dict of text fields
+# files:     dict field name -> StoredUpload
+# filenames: dict field name -> filename sent by the client
+ParsedUpload = namedtuple("ParsedUpload", "form files filenames")
+
+
+class UploadRejected(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def sniff_image_type(head):
+    """Image extension from the first bytes of a file, or None."""
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpg"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+class _FilePart:
+    """State for the file part currently being received."""
+
+    def __init__(self, name, filename):
+        self.name = name
+        self.filename = filename
+        self.head = b""
+        self.incoming = None
+        self.ext = None
+        self.size = 0
+
+
+def parse_upload_request(store, file_fields, allowed_extensions,
+                         max_file_bytes=MAX_UPLOAD_FILE_BYTES,
+                         max_request_bytes=MAX_UPLOAD_REQUEST_BYTES):
+    """
+    Stream the current multipart request into store. Only parts named in
+    file_fields are stored; other file parts are read and discarded.
+    Raises UploadRejected (with an HTTP status) on bad input.
+    """
+    route = metrics.current_route()
+    try:
+        parsed = _parse(store, file_fields, allowed_extensions, max_file_bytes, max_request_bytes)
+    except UploadRejected as e:
+        UPLOADS_REJECTED.inc(route, e.status)
+        raise
+
+    for stored in parsed.files.values():
+        UPLOAD_FILE_BYTES.observe(stored.size, route)
+    return parsed
+
+
+def _parse(store, file_fields, allowed_extensions, max_file_bytes, max_request_bytes):
+    if request.mimetype != "multipart/form-data":
+        raise UploadRejected("Expected multipart/form-data", 400)
+
+    boundary = request.mimetype_params.get("boundary")
+    if not boundary:
+        raise UploadRejected("Missing multipart boundary", 400)
+
+    if request.content_length and request.content_length > max_request_bytes:
+        raise UploadRejected(f"Upload too large (max {max_request_bytes // (1024 * 1024)} MB)", 413)
+
+    # The decoder buffer is drained after every chunk, so it never holds much
+    # more than CHUNK_SIZE; text field sizes are capped below.
+    decoder = MultipartDecoder(boundary.encode("latin-1"))
+    stream = request.stream
+
+    form, files, filenames = {}, {}, {}
+    field_name, field_data, field_size = None, [], 0
+    part = None
+    received = 0
+
+    try:
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            received += len(chunk)
+            if received > max_request_bytes:
+                raise UploadRejected(f"Upload too large (max {max_request_bytes // (1024 * 1024)} MB)", 413)
+            decoder.receive_data(chunk or None)
+
+            event = decoder.next_event()
+            while not isinstance(event, (NeedData, Epilogue)):
+                if isinstance(event, Field):
+                    field_name, field_data, field_size = event.name, [], 0
+                    part = None
+                elif isinstance(event, File):
+                    field_name = None
+                    part = _FilePart(event.name, event.filename)
+                elif isinstance(event, Data):
+                    if part is not None:
+                        _receive_file_data(store, part, event, file_fields, allowed_extensions, max_file_bytes)
+                        if not event.more_data:
+                            _finish_file(part, files, filenames)
+                            part = None
+                    elif field_name is not None:
+                        field_size += len(event.data)
+                        if field_size > MAX_FIELD_BYTES:
+                            raise UploadRejected(f"{field_name}: field too large", 413)
+                        field_data.append(event.data)
+                        if not event.more_data:
+                            form[field_name] = b"".join(field_data).decode("utf-8", "replace")
+                            field_name = None
+                event = decoder.next_event()
+
+            if isinstance(event, Epilogue) or not chunk:
+                break
+    except (RequestEntityTooLarge, ClientDisconnected) as e:
+        _abort(part)
+        raise UploadRejected("Upload too large or incomplete", 413 if isinstance(e, RequestEntityTooLarge) else 400)
+    except UploadRejected:
+        _abort(part)
+        raise
+    except ValueError as e:
+        # MultipartDecoder raises ValueError on malformed bodies
+        _abort(part)
+        raise UploadRejected(f"Malformed upload: {e}", 400)
+    finally:
+        UPLOAD_BYTES.inc(metrics.current_route(), amount=received)
+
+    if part is not None:
+        _abort(part)
+        raise UploadRejected("Upload ended before the file was complete", 400)
+
+    return ParsedUpload(form, files, filenames)
+
+
+def _receive_file_data(store, part, event, file_fields, allowed_extensions, max_file_bytes):
+    if part.name not in file_fields:
+        return  # not a field this endpoint wants, drop it
+
+    part.size += len(event.data)
+    if part.size > max_file_bytes:
+        raise UploadRejected(f"{part.name}: file too large (max {max_file_bytes // (1024 * 1024)} MB)", 413)
+
+    if part.incoming is None:
+        # Hold back the first bytes until we can tell what kind of file this is
+        part.head += event.data
+        if len(part.head) < SNIFF_BYTES and event.more_data:
+            return
+        if not part.head:
+            return  # empty part: "no file selected"
+
+        part.ext = sniff_image_type(part.head)
+        if part.ext is None or part.ext not in allowed_extensions:
+            raise UploadRejected(f"{part.name}: only PNG, JPEG or WebP images are accepted", 415)
+
+        part.incoming = store.begin()
+        part.incoming.write(part.head)
+        return
+
+    part.incoming.write(event.data)
+
+
+def _finish_file(part, files, filenames):
+    if part.incoming is None:
+        return
+    files[part.name] = part.incoming.commit(part.ext)
+    filenames[part.name] = part.filename
+
+
+def _abort(part):
+    if part is not None and part.incoming is not None:
+        part.incoming.abort()
@@ -0,0 +1,372 @@
+# =============================================================================
+# Upstream Gemini Client
+# =============================================================================
+# One shared client for every call the app makes to Gemini:
+#   - a persistent requests.Session (keep-alive, pooled connections), so we
+#     don't pay a TCP + TLS handshake on every generation
+#   - connect / read timeouts on every request
+#   - a global cap on in-flight upstream requests
+#   - jittered exponential backoff on 429 / 5xx and connection errors
+#   - a reused genai.GenerativeModel for text calls (prompt enhancer), with
+#     the same read timeout (as its deadline), in-flight cap and backoff;
+#     the SDK's own retries are off so they can't stack with ours, and its
+#     errors come out as UpstreamError like everything else
+#
+# Set UPSTREAM_STUB=1 to swap the network for StubTransport, which answers
+# locally with a tiny PNG. Handy for tests and offline benchmarks.
+
+import os
+import time
+import json
+import base64
+import random
+import logging
+import threading
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+GEMINI_BASE_URL = os.environ.get("GEMINI_BASE_URL", "https://generativelanguage.googleapis.com/v1beta")
+GEMINI_IMAGE_MODEL = os.environ.get("GEMINI_IMAGE_MODEL", "gemini-2.5-flash-image")
+GEMINI_TEXT_MODEL = os.environ.get("GEMINI_TEXT_MODEL", "gemini-2.5-flash")
+
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", 5))
+UPSTREAM_READ_TIMEOUT = float(os.environ.get("UPSTREAM_READ_TIMEOUT", 120))
+UPSTREAM_MAX_IN_FLIGHT = int(os.environ.get("UPSTREAM_MAX_IN_FLIGHT", 8))
+UPSTREAM_ACQUIRE_TIMEOUT = float(os.environ.get("UPSTREAM_ACQUIRE_TIMEOUT", 30))
+UPSTREAM_MAX_RETRIES = int(os.environ.get("UPSTREAM_MAX_RETRIES", 3))
+UPSTREAM_BACKOFF_BASE = float(os.environ.get("UPSTREAM_BACKOFF_BASE", 0.5))
+UPSTREAM_BACKOFF_MAX = float(os.environ.get("UPSTREAM_BACKOFF_MAX", 8))
+UPSTREAM_STUB = os.environ.get("UPSTREAM_STUB", "0") == "1"
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+UPSTREAM_SECONDS = metrics.histogram("imageworks_upstream_request_duration_seconds",
+                                     "Gemini call latency up to the response headers, per attempt.",
+                                     ["model", "status"])
+UPSTREAM_DOWNLOAD_SECONDS = metrics.histogram("imageworks_upstream_download_duration_seconds",
+                                              "Time spent reading streamed Gemini responses.", ["model"])
+UPSTREAM_REQUEST_BYTES = metrics.histogram("imageworks_upstream_request_bytes",
+                                           "Size of request bodies sent to Gemini.", ["model"],
+                                           metrics.SIZE_BUCKETS)
+UPSTREAM_RESPONSE_BYTES = metrics.histogram("imageworks_upstream_response_bytes",
+                                            "Size of Gemini response bodies.", ["model"],
+                                            metrics.SIZE_BUCKETS)
+UPSTREAM_RETRIES = metrics.counter("imageworks_upstream_retries_total",
+                                   "Gemini calls retried after a 429 / 5xx / connection error.", ["model"])
+
+# 1x1 transparent PNG used by the stub transport
+STUB_PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+)
+
+
+class UpstreamError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+# =============================================================================
+# STUB TRANSPORT (offline)
+# =============================================================================
+
+class StubTransport:
+    """
+    Drop-in replacement for requests.Session.post that never touches the
+    network. Every generateContent call gets a 200 with one inline image.
+    """
+
+    def __init__(self, latency=0.0, image_bytes=STUB_PNG, mime_type="image/png"):
+        self.latency = latency
+        self.image_bytes = image_bytes
+        self.mime_type = mime_type
+        self.calls = 0
+
+    def post(self, url, json=None, headers=None, timeout=None, stream=False):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        body = (
+            '{"candidates": [{"content": {"parts": [{"inline_data": {"mime_type": "%s", "data": "%s"}}]}}]}'
+            % (self.mime_type, base64.b64encode(self.image_bytes).decode("ascii"))
+        ).encode("ascii")
+
+        response = requests.models.Response()
+        response.status_code = 200
+        response.url = url
+        response.headers["Content-Type"] = "application/json"
+        response._content = body
+        response._content_consumed = True      # lets iter_content() serve _content
+        return response
+
+    def close(self):
+        pass
+
+
+class _StubTextResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class StubTextModel:
+    """Stands in for genai.GenerativeModel when UPSTREAM_STUB=1."""
+
+    def generate_content(self, contents, request_options=None):
+        text = contents if isinstance(contents, str) else str(contents)
+        if "\nPrompts:\n" in text:
+            # Batch enhancement: JSON array in, JSON array out
+            prompts = json.loads(text.rsplit("\nPrompts:\n", 1)[-1])
+            return _StubTextResponse(json.dumps([self._enhance(p) for p in prompts]))
+        prompt = text.rsplit("Simple prompt:", 1)[-1].split("\n", 1)[0].strip()
+        return _StubTextResponse(self._enhance(prompt))
+
+    @staticmethod
+    def _enhance(prompt):
+        return f"{prompt}, highly detailed, cinematic lighting, masterpiece"
+
+
+# =============================================================================
+# CLIENT
+# =============================================================================
+
+class GeminiClient:
+    def __init__(self, api_key=None, transport=None,
+                 max_in_flight=UPSTREAM_MAX_IN_FLIGHT,
+                 connect_timeout=UPSTREAM_CONNECT_TIMEOUT,
+                 read_timeout=UPSTREAM_READ_TIMEOUT,
+                 max_retries=UPSTREAM_MAX_RETRIES):
+        self._api_key = api_key
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.max_in_flight = max_in_flight
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._transport = transport
+        self._text_model = None
+        self._lock = threading.Lock()
+
+    @property
+    def api_key(self):
+        # Read lazily: .env is loaded by app.py after this module is imported
+        return self._api_key or os.environ.get("NANOBANANA_KEY", "")
+
+    @property
+    def transport(self):
+        """The pooled session (created on first use) or the injected stub."""
+        if self._transport is None:
+            with self._lock:
+                if self._transport is None:
+                    if UPSTREAM_STUB:
+                        self._transport = StubTransport()
+                    else:
+                        session = requests.Session()
+                        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=self.max_in_flight,
+                                              max_retries=0, pool_block=True)
+                        session.mount("https://", adapter)
+                        session.mount("http://", adapter)
+                        self._transport = session
+        return self._transport
+
+    def use_transport(self, transport):
+        """Swap the transport (tests / benchmarks)."""
+        with self._lock:
+            self._transport = transport
+
+    # ---------------- generateContent ----------------
+
+    def generate_content(self, payload, model=GEMINI_IMAGE_MODEL):
+        """
+        POST payload to models/<model>:generateContent and return the
+        requests.Response (status 200, body already read). Retries 429/5xx
+        with backoff and raises UpstreamError once retries are exhausted.
+        """
+        return self._post(payload, model, stream=False)
+
+    @contextmanager
+    def stream_content(self, payload, model=GEMINI_IMAGE_MODEL):
+        """
+        Like generate_content, but the body is left unread for the caller to
+        consume with iter_content(). The in-flight slot is held until the
+        with-block exits, since the download is part of the upstream call.
+        """
+        response = self._post(payload, model, stream=True)
+        started = time.perf_counter()
+        try:
+            yield response
+        finally:
+            UPSTREAM_DOWNLOAD_SECONDS.observe(time.perf_counter() - started, model)
+            received = _bytes_read(response)
+            if received is not None:
+                UPSTREAM_RESPONSE_BYTES.observe(received, model)
+            response.close()
+            self._slots.release()
+
+    def _post(self, payload, model, stream):
+        url = f"{GEMINI_BASE_URL}/models/{model}:generateContent"
+        headers = {"Content-Type": "application/json", "x-goog-api-key": self.api_key}
+
+        attempt = 0
+        while True:
+            retry_after = None
+
+            if not self._slots.acquire(timeout=UPSTREAM_ACQUIRE_TIMEOUT):
+                raise UpstreamError("Too many upstream requests in flight", status=503)
+            started = time.perf_counter()
+            try:
+                response = self.transport.post(url, json=payload, headers=headers,
+                                               timeout=self.timeout, stream=stream)
+                UPSTREAM_SECONDS.observe(time.perf_counter() - started, model, response.status_code)
+                if attempt == 0:
+                    _observe_request_size(response, model)
+                if response.status_code == 200:
+                    if not stream:
+                        UPSTREAM_RESPONSE_BYTES.observe(len(response.content), model)
+                    if not stream:
+                        self._slots.release()
+                    return response
+
+                status = response.status_code
+                retry_after = response.headers.get("Retry-After")
+                response.close()
+                error = UpstreamError(f"Gemini returned HTTP {status}", status=status)
+                retryable = status in RETRY_STATUSES
+            except requests.ConnectionError as e:
+                # Includes ConnectTimeout. Read timeouts are not retried: the
+                # request may well still be running upstream.
+                UPSTREAM_SECONDS.observe(time.perf_counter() - started, model, "error")
+                error = UpstreamError(f"Gemini connection failed: {e}")
+                retryable = True
+            except BaseException:
+                self._slots.release()
+                raise
+
+            self._slots.release()
+            self._wait_to_retry(error, retryable, attempt, model, retry_after)
+            attempt += 1
+
+    def _wait_to_retry(self, error, retryable, attempt, model, retry_after=None):
+        """Raise error if the call can't be retried, else sleep out the backoff."""
+        if not retryable or attempt >= self.max_retries:
+            raise error
+
+        UPSTREAM_RETRIES.inc(model)
+        delay = self._backoff(attempt, retry_after)
+        log.warning("Gemini call failed (%s), retry %d in %.2fs", error, attempt + 1, delay)
+        time.sleep(delay)
+
+    @staticmethod
+    def _backoff(attempt, retry_after=None):
+        """Full-jitter exponential backoff, honouring Retry-After when given."""
+        if retry_after:
+            try:
+                return min(float(retry_after), UPSTREAM_BACKOFF_MAX)
+            except ValueError:
+                pass
+        return random.uniform(0, min(UPSTREAM_BACKOFF_MAX, UPSTREAM_BACKOFF_BASE * (2 ** attempt)))
+
+    # ---------------- text model ----------------
+
+    def text_model(self):
+        """Shared genai.GenerativeModel for text calls, built once."""
+        if self._text_model is None:
+            with self._lock:
+                if self._text_model is None:
+                    if UPSTREAM_STUB or isinstance(self._transport, StubTransport):
+                        self._text_model = StubTextModel()
+                    else:
+                        # Imported and configured on first use: the SDK is slow to import
+                        import google.generativeai as genai
+                        genai.configure(api_key=self.api_key)
+                        self._text_model = genai.GenerativeModel(GEMINI_TEXT_MODEL)
+        return self._text_model
+
+    def generate_text(self, prompt):
+        """
+        Run prompt through the shared text model, under the in-flight cap.
+        Retries 429/5xx and connection errors with backoff; raises
+        UpstreamError once retries are exhausted or for anything else the
+        SDK reports.
+        """
+        # retry=None turns off the SDK's own retries (up to 600 s on 503)
+        options = {"timeout": self.timeout[1], "retry": None}
+        model = GEMINI_TEXT_MODEL
+
+        attempt = 0
+        while True:
+            if not self._slots.acquire(timeout=UPSTREAM_ACQUIRE_TIMEOUT):
+                raise UpstreamError("Too many upstream requests in flight", status=503)
+            started = time.perf_counter()
+            try:
+                text = self.text_model().generate_content(prompt, request_options=options).text.strip()
+                UPSTREAM_SECONDS.observe(time.perf_counter() - started, model, 200)
+                return text
+            except Exception as e:
+                error, retryable = _text_error(e)
+                if error is None:
+                    raise
+                UPSTREAM_SECONDS.observe(time.perf_counter() - started, model, error.status or "error")
+            finally:
+                self._slots.release()
+
+            self._wait_to_retry(error, retryable, attempt, model)
+            attempt += 1
+
+    def use_text_model(self, model):
+        with self._lock:
+            self._text_model = model
+
+
+def _text_error(e):
+    """(UpstreamError, retryable) for an exception from the genai SDK, or (None, False) if it isn't one."""
+    try:
+        from google.api_core import exceptions as google_errors
+    except ImportError:         # only the stub text model is in use
+        google_errors = None
+
+    if google_errors is not None:
+        if isinstance(e, google_errors.DeadlineExceeded):
+            # Like a read timeout in _post: the call may still be running upstream
+            return UpstreamError(f"Gemini timed out: {e}", status=504), False
+        if isinstance(e, google_errors.GoogleAPICallError):
+            status = e.code if isinstance(e.code, int) else None
+            return UpstreamError(f"Gemini returned HTTP {status}: {e.message}", status=status), \
+                status in RETRY_STATUSES
+        if isinstance(e, google_errors.RetryError):
+            return UpstreamError(f"Gemini call failed: {e}"), True
+        from google.auth.exceptions import GoogleAuthError
+        if isinstance(e, GoogleAuthError):
+            return UpstreamError(f"Gemini authentication failed: {e}", status=502), False
+    if isinstance(e, (requests.ConnectionError, ConnectionError)):
+        return UpstreamError(f"Gemini connection failed: {e}"), True
+    if isinstance(e, ValueError):
+        # response.text with no text part, e.g. a blocked prompt
+        return UpstreamError(f"Gemini returned no text: {e}", status=502), False
+    return None, False
+
+
+def _observe_request_size(response, model):
+    body = getattr(getattr(response, "request", None), "body", None)
+    if body is not None:
+        UPSTREAM_REQUEST_BYTES.observe(len(body), model)
+
+
+def _bytes_read(response):
+    """Bytes of a streamed body read so far (urllib3 keeps count), or None."""
+    raw = getattr(response, "raw", None)
+    if raw is None:
+        content = getattr(response, "_content", None)      # StubTransport
+        return len(content) if isinstance(content, bytes) else None
+    try:
+        return raw.tell()
+    except (AttributeError, OSError):
+        return None
+
+
+# Shared instance used by the app
+client = GeminiClient()